@@ -6,6 +6,10 @@ from source_code_builder import *
 
 
 class AstNode(object):
+  # Nodes use __slots__ instead of a per-instance __dict__, the AST dominates
+  # the memory usage of the compiler on large sources. Subclasses must list
+  # every attribute they set.
+  __slots__ = ('_symbol_chain',)
 
   def __init__(self, symbol_chain=None):
     self._symbol_chain = symbol_chain
@@ -27,6 +31,8 @@ class AstNode(object):
 
 class ProgramNode(AstNode):
 
+  __slots__ = ('_var_decls', '_type_decls', '_function_decls')
+
   def __init__(self, var_decls, type_decls, function_decls):
     self._var_decls = var_decls
     self._type_decls = type_decls
@@ -54,6 +60,8 @@ class ScopeVarsetError(Exception):
 
 class ScopeVarset(object):
 
+  __slots__ = ('_declared_vars', '_captured_vars', '_free_vars')
+
   def __init__(self):
     self._declared_vars = []
     self._captured_vars = []
@@ -88,6 +96,8 @@ class ScopeVarset(object):
 
 class BlockNode(AstNode):
 
+  __slots__ = ('_stmts', '_scope_varset')
+
   def __init__(self, stmts):
     iter(stmts)
     self._stmts = stmts
@@ -112,6 +122,8 @@ class BlockNode(AstNode):
 
 class VarSpecNode(AstNode):
 
+  __slots__ = ('_var', '_init_expr')
+
   def __init__(self, var, type, init_expr=None):
     assert isinstance(var, IdentifierNode)
     assert isinstance(type, NodeType)
@@ -139,6 +151,8 @@ class VarSpecNode(AstNode):
 
 class AssignmentNode(AstNode):
 
+  __slots__ = ('_var', '_expr')
+
   def __init__(self, var, expr):
     self._var = var
     self._expr = expr
@@ -151,12 +165,17 @@ class AssignmentNode(AstNode):
   def expr(self):
     return self._expr
 
+  def set_expr(self, expr):
+    self._expr = expr
+
   def visit(self, visitor):
-    visitor.visit_assignment(self)
+    return visitor.visit_assignment(self)
 
 
 class ReturnNode(AstNode):
 
+  __slots__ = ('_expr',)
+
   def __init__(self, expr):
     super(ReturnNode, self).__init__()
     self._expr = expr
@@ -165,12 +184,17 @@ class ReturnNode(AstNode):
   def expr(self):
     return self._expr
 
+  def set_expr(self, expr):
+    self._expr = expr
+
   def visit(self, visitor):
     return visitor.visit_return(self)
 
 
 class ExpressionStmtNode(AstNode):
 
+  __slots__ = ('_expr',)
+
   def __init__(self, expr):
     self._expr = expr
 
@@ -178,12 +202,17 @@ class ExpressionStmtNode(AstNode):
   def expr(self):
     return self._expr
 
+  def set_expr(self, expr):
+    self._expr = expr
+
   def visit(self, visitor):
     return visitor.visit_expression_stmt(self)
 
 
 class UnaryExprWithOpNode(AstNode):
 
+  __slots__ = ('_op', '_expr', '_type')
+
   def __init__(self, op, expr):
     self._op = op
     self._expr = expr
@@ -192,6 +221,9 @@ class UnaryExprWithOpNode(AstNode):
   def expr(self):
     return self._expr
 
+  def set_expr(self, expr):
+    self._expr = expr
+
   @property
   def op(self):
     return self._op
@@ -209,6 +241,8 @@ class UnaryExprWithOpNode(AstNode):
 
 class BinaryExprNode(AstNode):
 
+  __slots__ = ('_lhs', '_rhs', '_op', '_type')
+
   def __init__(self, lhs, op, rhs):
     self._lhs = lhs
     self._rhs = rhs
@@ -219,10 +253,16 @@ class BinaryExprNode(AstNode):
   def lhs(self):
     return self._lhs
 
+  def set_lhs(self, lhs):
+    self._lhs = lhs
+
   @property
   def rhs(self):
     return self._rhs
 
+  def set_rhs(self, rhs):
+    self._rhs = rhs
+
   @property
   def op(self):
     return self._op
@@ -240,6 +280,8 @@ class BinaryExprNode(AstNode):
 
 class IntLitNode(AstNode):
 
+  __slots__ = ('_val',)
+
   def __init__(self, val):
     self._val = val
 
@@ -257,6 +299,8 @@ class IntLitNode(AstNode):
 
 class FloatLitNode(AstNode):
 
+  __slots__ = ('_val',)
+
   def __init__(self, val):
     self._val = val
 
@@ -274,6 +318,8 @@ class FloatLitNode(AstNode):
 
 class IdentifierNode(AstNode):
 
+  __slots__ = ('_name', '_type')
+
   def __init__(self, name, type=None):
     assert isinstance(name, str)
     self._name = name
@@ -297,12 +343,24 @@ class IdentifierNode(AstNode):
     return visitor.visit_identifier(self)
 
 
+# A tail call of the calling function itself, it jumps back to its start.
+SELF_TAIL_CALL = 'self'
+# A tail call of a function with the same C signature as the caller, it
+# reuses the stack frame of the caller.
+SIBLING_TAIL_CALL = 'sibling'
+
+
 class FunctionCallNode(AstNode):
 
+  __slots__ = ('_func_expr', '_args', '_callee', '_tail_call', '_site')
+
   def __init__(self, func_expr, args):
     iter(args)
     self._func_expr = func_expr
     self._args = args
+    self._callee = None
+    self._tail_call = None
+    self._site = None
 
   @property
   def func_expr(self):
@@ -319,6 +377,32 @@ class FunctionCallNode(AstNode):
     iter(args)
     self._args = args
 
+  @property
+  def callee(self):
+    # Name of the function the closure |func_expr| is statically known to
+    # call, or None.
+    return self._callee
+
+  def set_callee(self, name):
+    self._callee = name
+
+  @property
+  def tail_call(self):
+    # None, SELF_TAIL_CALL or SIBLING_TAIL_CALL.
+    return self._tail_call
+
+  def set_tail_call(self, kind):
+    assert kind in (None, SELF_TAIL_CALL, SIBLING_TAIL_CALL)
+    self._tail_call = kind
+
+  @property
+  def site(self):
+    # The profile key of the call site, see fo_profile.
+    return self._site
+
+  def set_site(self, site):
+    self._site = site
+
   @property
   def type(self):
     # return self._type
@@ -329,11 +413,13 @@ class FunctionCallNode(AstNode):
       # raise
 
   def visit(self, visitor):
-    visitor.visit_function_call(self)
+    return visitor.visit_function_call(self)
 
 
 class FunctionDeclNode(AstNode):
 
+  __slots__ = ('_name', '_signature', '_body', '_type', '_scope_varset')
+
   def __init__(self, name, signature, body):
     assert isinstance(name, str)
     # signature is a 2-tuple of (params, return_type)
@@ -392,6 +478,8 @@ class FunctionDeclNode(AstNode):
 # closure
 class FunctionLitNode(AstNode):
 
+  __slots__ = ('_name', '_signature', '_body', '_type', '_scope_varset')
+
   def __init__(self, signature, body):
     # signature is a 2-tuple of (params, return_type)
     assert len(signature) == 2
@@ -467,7 +555,7 @@ class _SourceCodeVisitor(object):
   def visit_var_spec(self, node):
     self._builder.append('var')
     node.var.visit(self)
-    self._builder.append(node.type)
+    self._builder.append(node.var_spec_type)
     if node.init_expr is not None:
       self._builder.append('=')
       node.init_expr.visit(self)
@@ -513,7 +601,8 @@ class _SourceCodeVisitor(object):
     self._builder.append('{}'.format(node.val))
 
   def visit_float_lit(self, node):
-    self._builder.append('{}'.format(node.val))
+    # repr() keeps all the digits.
+    self._builder.append(repr(node.val))
 
   def visit_identifier(self, node):
     self._builder.append(node.name)
@@ -0,0 +1,134 @@
+'''Compiles many Fo programs in parallel.
+
+Usage: python fo_batch.py [-j N] [-o OUT_DIR] [--instrument]
+                           [--profile-use PROFILE] FILE.fo [FILE.fo ...]
+
+Every FILE.fo is compiled into OUT_DIR/FILE.c, or next to the source if
+OUT_DIR is not given. The files are spread across a pool of worker processes;
+each worker builds its parser once and reuses it for all the files it gets.
+Results and errors are reported in the order of the input files.
+
+With --instrument, the programs count their calls into a profile when they
+run, see fo_profile. The profiles given with --profile-use then steer the
+optimizations of all the files; they are meant for a single program.
+'''
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import fo_compiler
+import fo_lexer
+import fo_parser
+import fo_profile
+
+# Built lazily, once per worker process.
+_worker_parser = None
+_worker_lexer = None
+# The paths of the loaded profile files, and the profile.
+_worker_profile_paths = None
+_worker_profile = None
+
+
+def _output_path(path, out_dir):
+  base = os.path.splitext(os.path.basename(path))[0] + '.c'
+  return os.path.join(out_dir or os.path.dirname(path), base)
+
+
+def _get_worker_profile(profile_paths):
+  global _worker_profile_paths, _worker_profile
+  if not profile_paths:
+    return None
+  if profile_paths != _worker_profile_paths:
+    _worker_profile = fo_profile.load_profile(profile_paths)
+    _worker_profile_paths = profile_paths
+  return _worker_profile
+
+
+def _compile_file(args):
+  global _worker_parser, _worker_lexer
+  path, out_dir, instrument, profile_paths = args
+  if _worker_parser is None:
+    _worker_parser = fo_parser.FoParser()
+    _worker_lexer = fo_lexer.FoLexer()
+
+  out_path = _output_path(path, out_dir)
+  try:
+    profile = _get_worker_profile(profile_paths)
+    with open(path) as f:
+      source = f.read()
+    # The C code is streamed to the file, it is never held in memory.
+    with open(out_path, 'w') as f:
+      fo_compiler.compile_source(
+          source, parser=_worker_parser, lexer=_worker_lexer, out=f,
+          instrument=instrument, profile=profile)
+  except Exception as e:
+    if os.path.exists(out_path):
+      os.remove(out_path)
+    return (path, None, '{}: {}'.format(type(e).__name__, e))
+  return (path, out_path, None)
+
+
+def compile_files(paths, out_dir=None, jobs=None, instrument=False,
+                  profile_paths=None):
+  '''Compiles |paths| with |jobs| worker processes (one per core if None).
+
+  If |instrument| is true, the generated C counts the calls into a profile.
+  The profile files at |profile_paths| steer the optimizations.
+
+  Returns a list of (path, output path, error) in the order of |paths|.
+  Exactly one of output path and error is None.
+  '''
+  if not paths:
+    return []
+  jobs = jobs or multiprocessing.cpu_count()
+  profile_paths = tuple(profile_paths or ())
+  tasks = [(p, out_dir, instrument, profile_paths) for p in paths]
+  # Batches the small compile tasks to amortize the IPC cost.
+  chunksize = max(1, len(tasks) // (4 * jobs))
+  with ProcessPoolExecutor(max_workers=jobs) as executor:
+    return list(executor.map(_compile_file, tasks, chunksize=chunksize))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Compiles Fo programs in parallel.')
+  parser.add_argument('files', nargs='+', help='Fo source files')
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='number of worker processes, one per core if '
+                      'not given')
+  parser.add_argument('-o', '--out-dir', default=None,
+                      help='directory of the generated C files')
+  parser.add_argument('--instrument', action='store_true',
+                      help='count the calls at run time into a profile')
+  parser.add_argument('--profile-use', action='append', default=[],
+                      metavar='PROFILE',
+                      help='optimize with the profile written by an '
+                      'instrumented build, can be repeated')
+  args = parser.parse_args()
+  if args.instrument and args.profile_use:
+    parser.error('--instrument and --profile-use cannot be combined')
+
+  if args.out_dir:
+    outputs = [_output_path(p, args.out_dir) for p in args.files]
+    if len(set(outputs)) != len(outputs):
+      parser.error('files with the same name would overwrite each other '
+                   'in {}'.format(args.out_dir))
+    if not os.path.isdir(args.out_dir):
+      os.makedirs(args.out_dir)
+
+  num_errors = 0
+  for path, out_path, error in compile_files(
+          args.files, out_dir=args.out_dir, jobs=args.jobs,
+          instrument=args.instrument, profile_paths=args.profile_use):
+    if error is None:
+      print('{} -> {}'.format(path, out_path))
+    else:
+      num_errors += 1
+      print('{}: {}'.format(path, error), file=sys.stderr)
+  if num_errors:
+    print('{} of {} files failed'.format(num_errors, len(args.files)),
+          file=sys.stderr)
+    sys.exit(1)
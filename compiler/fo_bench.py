@@ -0,0 +1,357 @@
+'''Benchmarks for the Fo compiler.
+
+Usage: python fo_bench.py [<benchmark> ...] [--runs N]
+'''
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fo_ast
+import fo_compiler
+import fo_parser
+import fo_types
+import scoped_env
+import source_code_builder
+
+_COMPILER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_SAMPLE_SOURCE = '''
+func main() {
+  var i int = -2;
+  var j int = -22;
+  var k int = func(i int, j int) int {
+    return i + j * -2;
+  }(i, j);
+}
+'''
+
+
+def _report(name, samples):
+  samples = sorted(samples)
+  print('{:<24} min {:.4f}s  median {:.4f}s  ({} runs)'.format(
+      name, samples[0], samples[len(samples) // 2], len(samples)))
+
+
+'''Startup
+'''
+
+_FIRST_AST_SCRIPT = '''
+import fo_parser
+fo_parser.FoParser().parse({!r})
+'''.format(_SAMPLE_SOURCE)
+
+
+def _time_first_ast(cache_dir):
+  env = dict(os.environ)
+  env['FO_TABLE_CACHE_DIR'] = cache_dir
+  env['PYTHONPATH'] = os.pathsep.join(
+      [_COMPILER_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+  with open(os.devnull, 'w') as devnull:
+    start = time.time()
+    subprocess.check_call(
+        [sys.executable, '-c', _FIRST_AST_SCRIPT],
+        env=env, stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+
+def bench_startup(runs):
+  '''Time-to-first-AST of a fresh compiler process, without (cold) and with
+  (warm) the lexer/parser table cache.
+  '''
+  cold, warm = [], []
+  for _ in range(runs):
+    cache_dir = tempfile.mkdtemp()
+    try:
+      cold.append(_time_first_ast(cache_dir))
+      warm.append(_time_first_ast(cache_dir))
+    finally:
+      shutil.rmtree(cache_dir, ignore_errors=True)
+  _report('startup cold', cold)
+  _report('startup warm', warm)
+
+
+'''AST memory
+'''
+
+
+def _make_program_source(num_funcs):
+  funcs = []
+  for i in range(num_funcs):
+    funcs.append('''
+func f{0}(a int, b int) int {{
+  var c int = a * {0} + b;
+  var d int = func(x int) int {{
+    return x - c;
+  }}(a + b);
+  c = c + d * (a - b);
+  return c;
+}}'''.format(i))
+  return ''.join(funcs)
+
+
+def _iter_ast_nodes(root):
+  stack = [root]
+  while stack:
+    obj = stack.pop()
+    if isinstance(obj, (list, tuple)):
+      stack.extend(obj)
+      continue
+    if not isinstance(obj, fo_ast.AstNode):
+      continue
+    yield obj
+    for cls in type(obj).__mro__:
+      for name in getattr(cls, '__slots__', ()):
+        stack.append(getattr(obj, name, None))
+
+
+class _DictLayout(object):
+  pass
+
+
+def _dict_layout_bytes(node):
+  # The size |node| would have as a plain object with a __dict__.
+  obj = _DictLayout()
+  for cls in type(node).__mro__:
+    for name in getattr(cls, '__slots__', ()):
+      if hasattr(node, name):
+        setattr(obj, name, getattr(node, name))
+  return sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+
+
+def bench_ast_memory(runs):
+  '''Bytes per AST node of a parsed program, with the slotted node classes
+  and with the equivalent __dict__ based layout.
+  '''
+  ast = fo_parser.FoParser().parse(_make_program_source(500))
+  nodes = list(_iter_ast_nodes(ast))
+  slotted = sum(sys.getsizeof(n) for n in nodes)
+  with_dict = sum(_dict_layout_bytes(n) for n in nodes)
+  print('{} AST nodes'.format(len(nodes)))
+  print('{:<24} {:.1f} bytes/node'.format(
+      'ast __dict__ layout', float(with_dict) / len(nodes)))
+  print('{:<24} {:.1f} bytes/node'.format(
+      'ast __slots__ layout', float(slotted) / len(nodes)))
+
+
+'''Flatten
+'''
+
+
+def _make_flatten_program(num_stmts, stmts_per_func=100):
+  # Builds the AST directly, the parser is not what is measured here.
+  int_type = fo_types.make_int_type()
+
+  def ident(name):
+    return fo_ast.IdentifierNode(name)
+
+  def int_lit(v):
+    return fo_ast.IntLitNode(v)
+
+  funcs = []
+  for f in range(num_stmts // stmts_per_func):
+    name = 'f{}'.format(f)
+    params = [(fo_ast.IdentifierNode('x', int_type), int_type),
+              (fo_ast.IdentifierNode('y', int_type), int_type)]
+    body = []
+    for i in range(stmts_per_func // 2):
+      var = 'v{}'.format(i)
+      init = fo_ast.BinaryExprNode(
+          fo_ast.BinaryExprNode(ident('x'), '+', int_lit(i)), '*',
+          fo_ast.BinaryExprNode(ident('y'), '-', int_lit(i)))
+      body.append(fo_ast.VarSpecNode(ident(var), int_type, init))
+      call = fo_ast.FunctionCallNode(ident(name), [
+          fo_ast.UnaryExprWithOpNode('-', ident(var)),
+          fo_ast.BinaryExprNode(ident('x'), '+', ident(var))])
+      body.append(fo_ast.AssignmentNode(ident('x'), call))
+    body.append(fo_ast.ReturnNode(ident('x')))
+    funcs.append(fo_ast.FunctionDeclNode(name, (params, int_type), body))
+  return fo_ast.ProgramNode([], [], funcs)
+
+
+def bench_flatten(runs):
+  '''Time of the flatten pass over a synthetic 100k-statement program.
+  '''
+  samples = []
+  for _ in range(runs):
+    ast = _make_flatten_program(100000)
+    program_context = fo_compiler._ProgramContext()
+    fo_compiler.assign_function_lit_name(ast, program_context)
+    start = time.time()
+    fo_compiler.flatten(ast, program_context)
+    samples.append(time.time() - start)
+  _report('flatten 100k stmts', samples)
+
+
+'''Types
+'''
+
+
+def _make_deep_func_type(depth, num_params=4):
+  # func(int, ..., func(int, ..., func(...) int) int) int
+  t = fo_types.make_func_type([], fo_types.make_int_type())
+  for _ in range(depth):
+    params = [fo_types.make_int_type()] * (num_params - 1) + [t]
+    t = fo_types.make_func_type(params, fo_types.make_int_type())
+  return t
+
+
+def bench_types(runs):
+  '''Time to build and to compare deeply nested function types, as done by
+  the type inference pass.
+  '''
+  num_ops = 100000
+  make, compare = [], []
+  for _ in range(runs):
+    start = time.time()
+    for _ in range(num_ops // 1000):
+      a = _make_deep_func_type(8)
+    make.append(time.time() - start)
+
+    b = _make_deep_func_type(8)
+    start = time.time()
+    for _ in range(num_ops):
+      assert a == b
+    compare.append(time.time() - start)
+  _report('types make depth8 x100', make)
+  _report('types eq depth8 x100k', compare)
+
+
+'''Scopes
+'''
+
+
+class _BenchScopeNode(scoped_env.ScopedEnvNode):
+
+  def __init__(self):
+    super(_BenchScopeNode, self).__init__()
+    self._kv = {}
+
+  def contains(self, key):
+    return key in self._kv
+
+  def get(self, key):
+    return self._kv[key]
+
+  def put(self, key, value):
+    self._kv[key] = value
+
+
+def _time_env_lookups(env_class, depth, num_lookups):
+  env = env_class()
+  scopes = []
+  for i in range(depth):
+    scope = env.scope(_BenchScopeNode())
+    scope.__enter__()
+    scopes.append(scope)
+    env.put('v{}'.format(i), i)
+  start = time.time()
+  for _ in range(num_lookups):
+    env.get('v0')
+  elapsed = time.time() - start
+  for scope in reversed(scopes):
+    scope.__exit__(None, None, None)
+  return elapsed
+
+
+def _make_nested_program(depth, reads_per_level=10):
+  # A function with |depth| nested blocks, every block reads the parameter
+  # and the variables of the enclosing blocks, and a closure at the bottom
+  # captures them.
+  lines = ['func f(a int) int {', 'var v0 int = a;']
+  for i in range(1, depth):
+    reads = ' + '.join(['a'] * reads_per_level)
+    lines.append('{{ var v{} int = v{} + {};'.format(i, i - 1, reads))
+  lines.append('var g func() int = func() int {{ return v0 + v{}; }};'.format(
+      depth - 1))
+  lines.append('a = g();')
+  lines.append('}' * (depth - 1))
+  lines.append('return a; }')
+  return '\n'.join(lines)
+
+
+def bench_scopes(runs):
+  '''Time of the scope lookups: 10k lookups of the bottom scope of a
+  depth 500 ScopedEnv and FlatScopedEnv, and of the uniquify_vars and
+  reveal_vars passes over a function with 150 nested blocks.
+  '''
+  linked, flat, passes = [], [], []
+  source = _make_nested_program(150)
+  for _ in range(runs):
+    linked.append(_time_env_lookups(scoped_env.ScopedEnv, 500, 10000))
+    flat.append(_time_env_lookups(scoped_env.FlatScopedEnv, 500, 10000))
+
+    ast = fo_parser.FoParser().parse(source)
+    program_context = fo_compiler._ProgramContext()
+    fo_compiler.assign_function_lit_name(ast, program_context)
+    fo_compiler.flatten(ast, program_context)
+    start = time.time()
+    fo_compiler.uniquify_vars(ast, program_context)
+    fo_compiler.reveal_vars(ast, program_context)
+    passes.append(time.time() - start)
+  _report('scopes linked depth500', linked)
+  _report('scopes flat depth500', flat)
+  _report('scopes passes depth150', passes)
+
+
+'''Code emission
+'''
+
+
+def _emit(builder, num_tokens, tokens_per_line):
+  for _ in range(num_tokens // tokens_per_line):
+    builder.new_line()
+    for _ in range(tokens_per_line):
+      builder.append('x_uniq0')
+
+
+def bench_emit(runs):
+  '''Time to emit 1M tokens with SourceCodeBuilder, on short and on very long
+  lines, built into a string and streamed to a file.
+  '''
+  num_tokens = 1000000
+  for tokens_per_line in (10, 100000):
+    build, stream = [], []
+    for _ in range(runs):
+      start = time.time()
+      builder = source_code_builder.SourceCodeBuilder()
+      _emit(builder, num_tokens, tokens_per_line)
+      builder.build()
+      build.append(time.time() - start)
+
+      with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        builder = source_code_builder.SourceCodeBuilder(sink=devnull)
+        _emit(builder, num_tokens, tokens_per_line)
+        builder.build()
+        stream.append(time.time() - start)
+    _report('emit {}/line string'.format(tokens_per_line), build)
+    _report('emit {}/line stream'.format(tokens_per_line), stream)
+
+
+_BENCHMARKS = {
+    'ast_memory': bench_ast_memory,
+    'emit': bench_emit,
+    'flatten': bench_flatten,
+    'scopes': bench_scopes,
+    'startup': bench_startup,
+    'types': bench_types,
+}
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Fo compiler benchmarks.')
+  parser.add_argument('benchmarks', nargs='*',
+                      help='benchmarks to run, all of them if none is given. '
+                      'One of: {}'.format(', '.join(sorted(_BENCHMARKS))))
+  parser.add_argument('--runs', type=int, default=5)
+  args = parser.parse_args()
+  for name in args.benchmarks:
+    if name not in _BENCHMARKS:
+      parser.error('unknown benchmark: {}'.format(name))
+  for name in args.benchmarks or sorted(_BENCHMARKS):
+    _BENCHMARKS[name](args.runs)
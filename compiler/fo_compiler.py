@@ -1,12 +1,18 @@
 from __future__ import print_function
+from collections import deque
 from contextlib import contextmanager
 from copy import deepcopy
+import math
+import operator
+import re
+import time
 
 from scoped_env import *
 from fo_ast import *
 from fo_types import *
 from fo_type_analyzer import *
 import fo_parser
+import fo_profile
 from source_code_builder import *
 
 _GLOBAL_ENV = 'global_'
@@ -14,9 +20,29 @@ _GLOBAL_ENV = 'global_'
 
 class _ProgramContext(object):
 
-  def __init__(self):
+  def __init__(self, instrument=False, profile=None):
+    # Whether the generated C counts the calls, see fo_profile.
+    self._instrument = instrument
+    # The fo_profile.Profile the optimizations follow, or None.
+    self._profile = profile
     self._functions = {}
     self._var_types = {}
+    # Filled in by |analyze_escapes|.
+    self._non_escaping_closures = set()
+    self._stack_captured_vars = set()
+    # source variable name -> number of unique names made from it
+    self._var_name_counts = {}
+    # (caller name, callee name) of the call sites |inline_functions|
+    # inlined, in the order they were inlined.
+    self._inlined_calls = []
+
+  @property
+  def instrument(self):
+    return self._instrument
+
+  @property
+  def profile(self):
+    return self._profile
 
   @property
   def functions(self):
@@ -26,6 +52,26 @@ class _ProgramContext(object):
   def var_types(self):
     return self._var_types
 
+  @property
+  def non_escaping_closures(self):
+    # Names of the function literals whose closure is only ever called by
+    # the function that creates it.
+    return self._non_escaping_closures
+
+  @property
+  def stack_captured_vars(self):
+    # Captured variables that live on the stack of their function, the
+    # closures capturing them hold their address.
+    return self._stack_captured_vars
+
+  @property
+  def var_name_counts(self):
+    return self._var_name_counts
+
+  @property
+  def inlined_calls(self):
+    return self._inlined_calls
+
   def add_var_type(self, var_name, t):
     assert isinstance(t, NodeType)
     assert not is_placeholder_type(t)
@@ -38,7 +84,7 @@ class _ProgramContext(object):
   def __str__(self):
     builder = SourceCodeBuilder()
     with builder.indent():
-      for func_name, func in self._functions.iteritems():
+      for func_name, func in sorted(self._functions.items()):
         builder.new_line()
         num_free_vars = len(func.scope_varset.free_vars)
         num_captured_vars = len(func.scope_varset.captured_vars)
@@ -179,8 +225,15 @@ class _FlattenScopeNode(ScopedEnvNode):
   def has_assigned_var_name(self):
     return self._assigned_var_name is not None
 
-  def set_assigned_var_name(self, name):
+  @contextmanager
+  def assigned_var(self, name):
+    # Temporarily sets the variable the flattened expression is assigned to.
+    old_name = self._assigned_var_name
     self._assigned_var_name = name
+    try:
+      yield
+    finally:
+      self._assigned_var_name = old_name
 
   @property
   def scope_name(self):
@@ -237,12 +290,6 @@ class _FlattenVisitor(object):
     self._env = ScopedEnv()
     self._program_context = program_context
 
-  def _copy_top_scope_node(self):
-    top = self._env.top
-    assert top is not None
-    return self._make_scope_node(
-        top._assigned_var_name, top.scope_name, top.stmts)
-
   def _make_scope_node(self, assigned_var_name, scope_name, stmts):
     return _FlattenScopeNode(assigned_var_name, scope_name, stmts)
 
@@ -263,10 +310,12 @@ class _FlattenVisitor(object):
     # into
     # var foo T;
     # foo = init_expr();
-    var = IdentifierNode(node.var.name, node.var_spec_type)
-    self._env.top.stmts.append(VarSpecNode(deepcopy(var), var.type))
+    name, var_type = node.var.name, node.var_spec_type
+    self._env.top.stmts.append(
+        VarSpecNode(IdentifierNode(name, var_type), var_type))
     if node.init_expr is not None:
-      fake_assignment = AssignmentNode(deepcopy(var), node.init_expr)
+      fake_assignment = AssignmentNode(
+          IdentifierNode(name, var_type), node.init_expr)
       fake_assignment.visit(self)
 
   def visit_block(self, node):
@@ -288,10 +337,7 @@ class _FlattenVisitor(object):
       # except:
       self._env.top.stmts.append(node)
     else:
-      new_top = self._copy_top_scope_node()
-      new_top.set_assigned_var_name(node.var.name)
-
-      with self._env.scope(new_top):
+      with self._env.top.assigned_var(node.var.name):
         node.expr.visit(self)
 
   def visit_return(self, node):
@@ -433,6 +479,8 @@ def flatten(ast, program_context):
 '''Uniquify
 '''
 
+_UNIQ_SUFFIX_RE = re.compile(r'_uniq[0-9]+$')
+
 
 class _UniquifyScopeEnvNode(ScopedEnvNode):
 
@@ -451,25 +499,31 @@ class _UniquifyScopeEnvNode(ScopedEnvNode):
     assert key not in self._local_kv
     self._local_kv[key] = value
 
-  def put_var(self, key):
-    count = self._global_key_count.get(key, 0)
-    self._global_key_count[key] = count + 1
-    value = '{}_uniq{}'.format(key, count)
-    self.put(key, value)
+  def alloc_name(self, key):
+    # A name that is already unique, as in an inlined function body, gets a
+    # new name made from its source name.
+    source_key = _UNIQ_SUFFIX_RE.sub('', key)
+    count = self._global_key_count.get(source_key, 0)
+    self._global_key_count[source_key] = count + 1
+    return '{}_uniq{}'.format(source_key, count)
 
 
 class _UniquifyVisitor(object):
 
   def __init__(self, program_context):
-    self._global_key_count = {}
-    self._env = ScopedEnv(self._make_scope_node())
+    # Shared by all the renamings, so that the names never collide.
+    self._global_key_count = program_context.var_name_counts
+    self._env = FlatScopedEnv(self._make_scope_node())
     for func_name in program_context.functions:
       # |func_name| is mapped to its own name.
-      self._env.top.put(func_name, func_name)
+      self._env.put(func_name, func_name)
 
   def _make_scope_node(self):
     return _UniquifyScopeEnvNode(self._global_key_count)
 
+  def _put_var(self, key):
+    self._env.put(key, self._env.top.alloc_name(key))
+
   def visit_program(self, node):
     for f in node.function_decls:
       f.visit(self)
@@ -477,7 +531,7 @@ class _UniquifyVisitor(object):
   def visit_var_spec(self, node):
     if node.init_expr:
       node.init_expr.visit(self)
-    self._env.top.put_var(node.var.name)
+    self._put_var(node.var.name)
     node.var.visit(self)
 
   def visit_block(self, node):
@@ -515,7 +569,7 @@ class _UniquifyVisitor(object):
   def visit_function_decl(self, node):
     with self._env.scope(self._make_scope_node()):
       for p, t in node.parameters:
-        self._env.top.put_var(p.name)
+        self._put_var(p.name)
         p.visit(self)
 
       for stmt in node.body:
@@ -524,7 +578,7 @@ class _UniquifyVisitor(object):
   def visit_function_lit(self, node):
     with self._env.scope(self._make_scope_node()):
       for p, t in node.parameters:
-        self._env.top.put_var(p.name)
+        self._put_var(p.name)
         p.visit(self)
 
       for stmt in node.body:
@@ -576,7 +630,7 @@ class _RevealVarsVisitor(object):
 
   def __init__(self, program_context):
     self._program_context = program_context
-    self._env = ScopedEnv()
+    self._env = FlatScopedEnv()
 
   def visit_program(self, node):
     for f in node.function_decls:
@@ -820,15 +874,29 @@ def _is_valid_type(t):
   return t is not None and not is_placeholder_type(t)
 
 
+class TypeInferenceError(Exception):
+  pass
+
+
 class _IterAssignTypeVisitor(object):
 
   def __init__(self, program_context):
     self._program_context = program_context
-    self._num_untyped = 0
-
-  @property
-  def num_untyped(self):
-    return self._num_untyped
+    self._pending_names = set()
+    self._typed_names = []
+
+  def visit_unit(self, stmt):
+    # Visits a single statement. Returns the names of the identifiers that
+    # are still untyped, and the names that are typed for the first time.
+    self._pending_names = set()
+    self._typed_names = []
+    stmt.visit(self)
+    return self._pending_names, self._typed_names
+
+  def _add_var_type(self, var_name, t):
+    if var_name not in self._program_context.var_types:
+      self._typed_names.append(var_name)
+    self._program_context.add_var_type(var_name, t)
 
   def visit_program(self, node):
     for f in node.function_decls:
@@ -836,20 +904,11 @@ class _IterAssignTypeVisitor(object):
 
   def visit_var_spec(self, node):
     var = node.var
-    # if self._check_mode:
-    #   assert self._var_has_valid_type(var)
-    #   if node.init_expr:
-    #     assert var.type == node.init_expr.type
-    #   return
     if node.init_expr is not None:
       node.init_expr.visit(self)
       if _is_valid_type(node.init_expr.type):
-        self._program_context.add_var_type(var.name, node.init_expr.type)
-      # else:
-      #   self._num_untyped += 1
+        self._add_var_type(var.name, node.init_expr.type)
     var.visit(self)
-    # if not _is_valid_type(var.type):
-    #   self._num_untyped += 1
 
   def visit_block(self, node):
     for stmt in node.stmts:
@@ -859,12 +918,8 @@ class _IterAssignTypeVisitor(object):
     var = node.var
     node.expr.visit(self)
     if _is_valid_type(node.expr.type):
-      self._program_context.add_var_type(var.name, node.expr.type)
-    # else:
-    #   self._num_untyped += 1
+      self._add_var_type(var.name, node.expr.type)
     var.visit(self)
-    # if not _is_valid_type(var.type):
-    #   self._num_untyped += 1
 
   def visit_return(self, node):
     if node.expr is not None:
@@ -877,8 +932,6 @@ class _IterAssignTypeVisitor(object):
     node.expr.visit(self)
     if _is_valid_type(node.expr.type):
       node.set_type(node.expr.type)
-    else:
-      self._num_untyped += 1
 
   def visit_binary_expr(self, node):
     lhs, rhs = node.lhs, node.rhs
@@ -887,8 +940,6 @@ class _IterAssignTypeVisitor(object):
     if _is_valid_type(lhs.type) and _is_valid_type(rhs.type):
       assert lhs.type == rhs.type
       node.set_type(lhs.type)
-    else:
-      self._num_untyped += 1
 
   def visit_int_lit(self, node):
     pass
@@ -897,59 +948,954 @@ class _IterAssignTypeVisitor(object):
     pass
 
   def visit_identifier(self, node):
-    # node.set_name(self._env.get(node.name))
+    func = self._program_context.functions.get(node.name)
+    if func is not None:
+      # A function used as a value.
+      node.set_type(func.type)
+      return
     stored_type = self._program_context.var_types.get(node.name, None)
     var_type = node.type
     if _is_valid_type(var_type):
-      self._program_context.add_var_type(node.name, var_type)
+      self._add_var_type(node.name, var_type)
       if stored_type is not None:
         assert stored_type == var_type
     else:
       if stored_type is not None:
         node.set_type(stored_type)
       else:
-        self._num_untyped += 1
+        self._pending_names.add(node.name)
 
-  def visit_function_decl(self, node):
+  def _visit_function(self, node):
+    # Only the parameters are typed here, the statements in the body are
+    # scheduled as units of their own by |_collect_type_units|.
     for p, t in node.parameters:
-      self._program_context.add_var_type(p.name, t)
+      self._add_var_type(p.name, t)
       p.visit(self)
 
-    for stmt in node.body:
-      stmt.visit(self)
+  def visit_function_decl(self, node):
+    return self._visit_function(node)
 
   def visit_function_lit(self, node):
-    for p, t in node.parameters:
-      self._program_context.add_var_type(p.name, t)
-      p.visit(self)
-
-    for stmt in node.body:
-      stmt.visit(self)
+    return self._visit_function(node)
 
   def visit_function_call(self, node):
     for a in node.args:
       a.visit(self)
-    # if not isinstance(node.func_expr, FunctionDeclNode):
-    # assert node.func_expr.name in self._program_context.functions
     func_expr = node.func_expr
     assert isinstance(node.func_expr, IdentifierNode)
     try:
       f = self._program_context.functions[func_expr.name]
       func_expr.set_type(f.type)
-      # func_expr.visit(self)
     except KeyError:
       pass
     func_expr.visit(self)
 
 
+def _collect_type_units(stmts, units):
+  for stmt in stmts:
+    if isinstance(stmt, BlockNode):
+      _collect_type_units(stmt.stmts, units)
+      continue
+    units.append(stmt)
+    # After flattening, a function literal can only be the RHS of an
+    # assignment.
+    if isinstance(stmt, AssignmentNode) and isinstance(
+            stmt.expr, FunctionLitNode):
+      _collect_type_units(stmt.expr.body, units)
+
+
 def assign_check_types(ast, program_context):
+  # Worklist based inference. Every statement is visited once, and is only
+  # visited again when one of the identifiers it is waiting on gets typed.
   program_context._var_types = {}
-  done = False
-  while not done:
-    visitor = _IterAssignTypeVisitor(program_context)
-    ast.visit(visitor)
-    done = visitor.num_untyped == 0
-    print(visitor.num_untyped)
+  visitor = _IterAssignTypeVisitor(program_context)
+  # Types all the function parameters.
+  ast.visit(visitor)
+
+  units = []
+  for f in ast.function_decls:
+    _collect_type_units(f.body, units)
+
+  worklist = deque(range(len(units)))
+  queued = set(worklist)
+  # name -> indices of the units waiting on it
+  waiting = {}
+  # unit index -> names it is still waiting on
+  pending = {}
+  while worklist:
+    i = worklist.popleft()
+    queued.discard(i)
+    pending_names, typed_names = visitor.visit_unit(units[i])
+    if pending_names:
+      pending[i] = pending_names
+      for name in pending_names:
+        waiting.setdefault(name, set()).add(i)
+    else:
+      pending.pop(i, None)
+    for name in typed_names:
+      for j in waiting.pop(name, ()):
+        if j not in queued:
+          queued.add(j)
+          worklist.append(j)
+
+  if pending:
+    untyped = set()
+    for names in pending.values():
+      untyped.update(names)
+    raise TypeInferenceError(
+        'Cannot infer the types of: {}'.format(', '.join(sorted(untyped))))
+
+
+'''Call site numbering pass
+'''
+
+
+def number_call_sites(ast, program_context):
+  '''Gives every call its profile key, from the order of the calls in each
+  function. It runs before any optimization, so that the keys of an
+  instrumented and of a profile-guided compilation of a program match.
+  '''
+  for func in program_context.functions.values():
+    calls = (_get_call(stmt) for stmt in _iter_stmts(func.body))
+    for n, call in enumerate(c for c in calls if c is not None):
+      call.set_site(fo_profile.site_key(func.name, n))
+
+
+'''Inlining pass
+'''
+
+# Largest function body, in statements, that is inlined.
+_MAX_INLINED_SIZE = 12
+# The same, at the call sites the profile shows are hot.
+_MAX_HOT_INLINED_SIZE = 40
+# Number of statements inlining may add to a single function.
+_MAX_INLINING_GROWTH = 100
+
+
+def _collect_closure_targets(program_context, usage):
+  # Returns {variable name: the function its closure calls} for the
+  # variables assigned once, either a function literal or a function name.
+  functions = program_context.functions
+  targets = {}
+  for func in functions.values():
+    for stmt in _iter_stmts(func.body):
+      if not isinstance(stmt, AssignmentNode):
+        continue
+      expr = stmt.expr
+      if isinstance(expr, IdentifierNode):
+        expr = functions.get(expr.name)
+      if _is_func_node(expr) and usage.is_single_assigned(stmt.var.name):
+        targets[stmt.var.name] = expr
+  return targets
+
+
+def _build_call_graph(program_context):
+  # Returns {function name: [(statement, callee), ...]}, the statements of
+  # every function that call a statically known function.
+  functions = program_context.functions
+  targets = _collect_closure_targets(
+      program_context, _count_var_usage(program_context))
+  graph = {}
+  for name, func in functions.items():
+    call_sites = graph[name] = []
+    for stmt in _iter_stmts(func.body):
+      call = _get_call(stmt)
+      if call is None:
+        continue
+      callee = functions.get(call.func_expr.name) or targets.get(
+          call.func_expr.name)
+      if callee is not None:
+        call_sites.append((stmt, callee))
+  return graph
+
+
+def _find_recursive_functions(graph):
+  # The functions that can reach themselves through calls.
+  recursive = set()
+  for name in graph:
+    seen = set()
+    stack = [callee.name for _, callee in graph[name]]
+    while stack:
+      callee_name = stack.pop()
+      if callee_name == name:
+        recursive.add(name)
+        break
+      if callee_name not in seen:
+        seen.add(callee_name)
+        stack.extend(c.name for _, c in graph[callee_name])
+  return recursive
+
+
+def _callees_first(graph):
+  # The function names in post order, every function comes after the
+  # functions it calls, except along cycles.
+  order = []
+  visited = set()
+  for root in sorted(graph):
+    if root in visited:
+      continue
+    visited.add(root)
+    stack = [(root, iter(graph[root]))]
+    while stack:
+      name, call_sites = stack[-1]
+      for _, callee in call_sites:
+        if callee.name not in visited:
+          visited.add(callee.name)
+          stack.append((callee.name, iter(graph[callee.name])))
+          break
+      else:
+        stack.pop()
+        order.append(name)
+  return order
+
+
+def _body_size(func):
+  # Declarations without an initializer do not generate any code.
+  return sum(1 for stmt in _iter_stmts(func.body)
+             if not isinstance(stmt, VarSpecNode) or stmt.init_expr)
+
+
+def _can_inline(func, recursive, max_size):
+  if func.name in recursive or _body_size(func) > max_size:
+    return False
+  if func.scope_varset.free_vars or func.scope_varset.captured_vars:
+    return False
+  body = func.body
+  for stmt in _iter_stmts(body):
+    # The function literals would have to be copied too.
+    if isinstance(stmt, AssignmentNode) and isinstance(
+            stmt.expr, FunctionLitNode):
+      return False
+    # Straight-line code, only a final return can be turned into an
+    # assignment.
+    if isinstance(stmt, ReturnNode) and stmt is not body[-1]:
+      return False
+  return True
+
+
+def _declared_vars(func):
+  names = func.parameter_names
+  names.extend(stmt.var.name for stmt in _iter_stmts(func.body)
+               if isinstance(stmt, VarSpecNode))
+  return names
+
+
+def _inline_call(stmt, callee, renamer, program_context):
+  # Returns the statements replacing |stmt|, a statement calling |callee|.
+  # The body is copied with fresh variable names, the parameters become
+  # local variables assigned with the arguments.
+  call = _get_call(stmt)
+  inlined = deepcopy(callee)
+  inlined.visit(renamer)
+  var_types = program_context.var_types
+  for name, new_name in zip(_declared_vars(callee), _declared_vars(inlined)):
+    program_context.add_var_type(new_name, var_types[name])
+
+  stmts = []
+  for (p, t), a in zip(inlined.parameters, call.args):
+    stmts.append(VarSpecNode(IdentifierNode(p.name, t), t))
+    stmts.append(AssignmentNode(IdentifierNode(p.name, t), a))
+  body = inlined.body
+  ret = None
+  if body and isinstance(body[-1], ReturnNode):
+    body, ret = body[:-1], body[-1]
+  stmts.extend(body)
+  if isinstance(stmt, ReturnNode):
+    stmts.append(ret or ReturnNode(None))
+  elif ret is not None and ret.expr is not None:
+    if isinstance(stmt, AssignmentNode):
+      stmts.append(AssignmentNode(stmt.var, ret.expr))
+    else:
+      stmts.append(ExpressionStmtNode(ret.expr))
+  return stmts
+
+
+def _inline_calls(stmts, call_sites, state):
+  result = []
+  for stmt in stmts:
+    if isinstance(stmt, BlockNode):
+      stmt.set_stmts(_inline_calls(stmt.stmts, call_sites, state))
+    elif stmt in call_sites and state.can_inline(stmt, call_sites[stmt]):
+      result.extend(state.inline(stmt, call_sites[stmt]))
+      continue
+    result.append(stmt)
+  return result
+
+
+class _InlineState(object):
+  # The inlining done in a single function.
+
+  def __init__(self, caller, recursive, renamer, program_context):
+    self._caller = caller
+    self._recursive = recursive
+    self._renamer = renamer
+    self._program_context = program_context
+    self._growth = 0
+
+  def can_inline(self, stmt, callee):
+    max_size = _MAX_INLINED_SIZE
+    profile = self._program_context.profile
+    site = _get_call(stmt).site
+    if profile is not None and site is not None:
+      # The code that never runs is not worth growing.
+      if profile.is_cold(site):
+        return False
+      if profile.is_hot(site):
+        max_size = _MAX_HOT_INLINED_SIZE
+    return (callee is not self._caller and
+            _can_inline(callee, self._recursive, max_size) and
+            self._growth + _body_size(callee) <= _MAX_INLINING_GROWTH)
+
+  def inline(self, stmt, callee):
+    self._growth += _body_size(callee)
+    self._program_context.inlined_calls.append(
+        (self._caller.name, callee.name))
+    return _inline_call(stmt, callee, self._renamer, self._program_context)
+
+
+def inline_functions(ast, program_context):
+  '''Inlines the calls of small functions.
+
+  The calls of functions, and of closures known to call a given function,
+  are replaced by a copy of the function body when the function is not
+  recursive, has at most |_MAX_INLINED_SIZE| statements, and neither has
+  free variables nor creates closures. The variables of the copy get fresh
+  unique names. Callees are processed before their callers, and the code
+  inlined into a function is bounded by |_MAX_INLINING_GROWTH| statements.
+  The inlined call sites are recorded in |program_context.inlined_calls|.
+
+  With a profile, the call sites that never ran are not inlined, and the hot
+  ones inline functions up to |_MAX_HOT_INLINED_SIZE| statements. Nothing is
+  inlined in an instrumented program, so that its call sites are the ones
+  the profile is used with.
+  '''
+  if program_context.instrument:
+    return
+  graph = _build_call_graph(program_context)
+  recursive = _find_recursive_functions(graph)
+  renamer = _UniquifyVisitor(program_context)
+  functions = program_context.functions
+  for name in _callees_first(graph):
+    if not graph[name]:
+      continue
+    func = functions[name]
+    state = _InlineState(func, recursive, renamer, program_context)
+    func.set_body(_inline_calls(func.body, dict(graph[name]), state))
+
+
+'''Constant folding pass
+'''
+
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+
+class _VarUsageVisitor(object):
+  # Counts how many times every variable is read and assigned. Names are
+  # unique after |uniquify_vars|, so the counts are program wide.
+
+  def __init__(self):
+    self._reads = {}
+    self._assigns = {}
+    # Reads as the callee of a function call.
+    self._calls = {}
+    self._params = set()
+    # Variables shared with closures. Some of their uses are not in the AST
+    # (closure and context tuples), so they are never optimized away.
+    self._captured = set()
+
+  @property
+  def reads(self):
+    return self._reads
+
+  @property
+  def assigns(self):
+    return self._assigns
+
+  @property
+  def calls(self):
+    return self._calls
+
+  @property
+  def params(self):
+    return self._params
+
+  @property
+  def captured(self):
+    return self._captured
+
+  def is_local(self, name):
+    # Whether all the uses of |name| are visible in the AST.
+    return name not in self._captured and name not in self._params
+
+  def is_single_assigned(self, name):
+    return self.is_local(name) and self._assigns.get(name, 0) == 1
+
+  def is_dead(self, name):
+    return self.is_local(name) and self._reads.get(name, 0) == 0
+
+  def is_unused(self, name):
+    return self.is_dead(name) and self._assigns.get(name, 0) == 0
+
+  def remove(self, stmt):
+    # Forgets the uses in |stmt|, which is being removed from the program.
+    removed = _VarUsageVisitor()
+    stmt.visit(removed)
+    for name, count in removed.reads.items():
+      self._reads[name] -= count
+    for name, count in removed.assigns.items():
+      self._assigns[name] -= count
+    for name, count in removed.calls.items():
+      self._calls[name] -= count
+
+  def remove_assignment(self, name):
+    # Forgets an assignment to |name| whose expression is kept.
+    self._assigns[name] -= 1
+
+  def _count(self, counts, name):
+    counts[name] = counts.get(name, 0) + 1
+
+  def visit_var_spec(self, node):
+    if node.init_expr is not None:
+      node.init_expr.visit(self)
+      self._count(self._assigns, node.var.name)
+
+  def visit_block(self, node):
+    self._captured.update(node.scope_varset.captured_vars)
+    for stmt in node.stmts:
+      stmt.visit(self)
+
+  def visit_assignment(self, node):
+    node.expr.visit(self)
+    self._count(self._assigns, node.var.name)
+
+  def visit_return(self, node):
+    if node.expr is not None:
+      node.expr.visit(self)
+
+  def visit_expression_stmt(self, node):
+    node.expr.visit(self)
+
+  def visit_unary_expr_with_op(self, node):
+    node.expr.visit(self)
+
+  def visit_binary_expr(self, node):
+    node.lhs.visit(self)
+    node.rhs.visit(self)
+
+  def visit_int_lit(self, node):
+    pass
+
+  def visit_float_lit(self, node):
+    pass
+
+  def visit_identifier(self, node):
+    self._count(self._reads, node.name)
+
+  def count_function(self, node):
+    self._params.update(node.parameter_names)
+    self._captured.update(node.scope_varset.captured_vars)
+    self._captured.update(node.scope_varset.free_vars)
+    for stmt in node.body:
+      stmt.visit(self)
+
+  def visit_function_lit(self, node):
+    # The body is counted as a function of its own, so that removing the
+    # statement creating the closure does not uncount it.
+    pass
+
+  def visit_function_call(self, node):
+    for a in node.args:
+      a.visit(self)
+    if isinstance(node.func_expr, IdentifierNode):
+      self._count(self._calls, node.func_expr.name)
+    node.func_expr.visit(self)
+
+
+def _count_var_usage(program_context):
+  visitor = _VarUsageVisitor()
+  for func in program_context.functions.values():
+    visitor.count_function(func)
+  return visitor
+
+
+def _is_lit(node):
+  return isinstance(node, IntLitNode) or isinstance(node, FloatLitNode)
+
+
+def _is_lit_of(node, val):
+  # -0.0 == 0, but it is not an identity element.
+  return _is_lit(node) and node.val == val and math.copysign(1, node.val) > 0
+
+
+def _copy_lit(node):
+  return type(node)(node.val)
+
+
+def _make_lit(val):
+  # Returns None if |val| cannot be represented the way C computes it.
+  if isinstance(val, float):
+    if math.isinf(val) or math.isnan(val):
+      return None
+    return FloatLitNode(val)
+  # Signed overflow is undefined in C. INT64_MIN has no literal either.
+  if not _INT64_MIN < val <= _INT64_MAX:
+    return None
+  return IntLitNode(val)
+
+
+def _c_int_div(a, b):
+  # C truncates towards zero, Python floors.
+  q = abs(a) // abs(b)
+  return q if (a < 0) == (b < 0) else -q
+
+
+def _c_int_mod(a, b):
+  return a - b * _c_int_div(a, b)
+
+
+_INT_BINARY_OPS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': _c_int_div,
+    '%': _c_int_mod,
+}
+
+_FLOAT_BINARY_OPS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+
+
+def _fold_binary_expr(node):
+  # Returns the literal |node| evaluates to, or None.
+  lhs, rhs = node.lhs, node.rhs
+  if not _is_lit(lhs) or type(lhs) is not type(rhs):
+    return None
+  if isinstance(lhs, IntLitNode):
+    op = _INT_BINARY_OPS.get(node.op)
+  else:
+    op = _FLOAT_BINARY_OPS.get(node.op)
+  if op is None or (node.op in ('/', '%') and rhs.val == 0):
+    return None
+  return _make_lit(op(lhs.val, rhs.val))
+
+
+def _simplify_binary_expr(node):
+  # Returns the simpler expression |node| is equivalent to, or None.
+  lhs, rhs, op = node.lhs, node.rhs, node.op
+  is_int = node.type == make_int_type()
+  if op == '*':
+    if _is_lit_of(rhs, 1):
+      return lhs
+    if _is_lit_of(lhs, 1):
+      return rhs
+    # x * 0.0 is not 0.0 for NaNs, infinities and negative numbers.
+    if is_int and (_is_lit_of(lhs, 0) or _is_lit_of(rhs, 0)):
+      return IntLitNode(0)
+  elif op == '/':
+    if _is_lit_of(rhs, 1):
+      return lhs
+  elif op == '-':
+    if _is_lit_of(rhs, 0):
+      return lhs
+  elif op == '+' and is_int:
+    # -0.0 + 0.0 is 0.0, so this only holds for ints.
+    if _is_lit_of(rhs, 0):
+      return lhs
+    if _is_lit_of(lhs, 0):
+      return rhs
+  return None
+
+
+class _FoldConstantsVisitor(object):
+  # Visits the statements in execution order. The language has no branches
+  # or loops, so once a single-assigned variable is assigned, it keeps its
+  # value for the rest of the program. The visit methods of expressions
+  # return the expression that replaces them.
+
+  def __init__(self, usage, propagate_copies=False):
+    self._usage = usage
+    self._propagate_copies = propagate_copies
+    # variable name -> the literal it holds
+    self._consts = {}
+    # variable name -> the IdentifierNode of the variable it is a copy of
+    self._copies = {}
+    # variable name -> (op, IdentifierNode), the variable holds |op| applied
+    # to a variable whose value does not change anymore.
+    self._negations = {}
+    # Single-assigned variables whose assignment was visited.
+    self._assigned = set()
+
+  def _is_stable(self, name):
+    # Whether |name| holds its final value.
+    usage = self._usage
+    if name in usage.params:
+      return name not in usage.captured and usage.assigns.get(name, 0) == 0
+    return name in self._assigned
+
+  def visit_program(self, node):
+    for f in node.function_decls:
+      f.visit(self)
+
+  def visit_var_spec(self, node):
+    if node.init_expr is not None:
+      node.init_expr.visit(self)
+
+  def visit_block(self, node):
+    for stmt in node.stmts:
+      stmt.visit(self)
+
+  def visit_assignment(self, node):
+    expr = node.expr.visit(self)
+    node.set_expr(expr)
+
+    name = node.var.name
+    if not self._usage.is_single_assigned(name):
+      return
+    self._assigned.add(name)
+    if _is_lit(expr):
+      self._consts[name] = expr
+    elif (self._propagate_copies and isinstance(expr, IdentifierNode) and
+          self._is_stable(expr.name)):
+      self._copies[name] = expr
+    elif (isinstance(expr, UnaryExprWithOpNode) and
+          isinstance(expr.expr, IdentifierNode) and
+          self._is_stable(expr.expr.name)):
+      self._negations[name] = (expr.op, expr.expr)
+
+  def visit_return(self, node):
+    if node.expr is not None:
+      node.set_expr(node.expr.visit(self))
+
+  def visit_expression_stmt(self, node):
+    node.set_expr(node.expr.visit(self))
+
+  def visit_unary_expr_with_op(self, node):
+    expr = node.expr.visit(self)
+    node.set_expr(expr)
+    op = node.op
+    if op == '+':
+      return expr
+    if op == '-' and _is_lit(expr):
+      return _make_lit(-expr.val) or node
+    # -(-x) is x, and so is !(!x) for bools.
+    if op == '-' or (op == '!' and expr.type == make_bool_type()):
+      if isinstance(expr, IdentifierNode) and expr.name in self._negations:
+        inner_op, inner_expr = self._negations[expr.name]
+        if inner_op == op:
+          return IdentifierNode(inner_expr.name, inner_expr.type)
+    return node
+
+  def visit_binary_expr(self, node):
+    node.set_lhs(node.lhs.visit(self))
+    node.set_rhs(node.rhs.visit(self))
+    return _fold_binary_expr(node) or _simplify_binary_expr(node) or node
+
+  def visit_int_lit(self, node):
+    return node
+
+  def visit_float_lit(self, node):
+    return node
+
+  def visit_identifier(self, node):
+    const = self._consts.get(node.name)
+    if const is not None:
+      return _copy_lit(const)
+    copy = self._copies.get(node.name)
+    if copy is not None:
+      return IdentifierNode(copy.name, copy.type)
+    return node
+
+  def _visit_function(self, node):
+    for stmt in node.body:
+      stmt.visit(self)
+    return node
+
+  def visit_function_decl(self, node):
+    return self._visit_function(node)
+
+  def visit_function_lit(self, node):
+    return self._visit_function(node)
+
+  def visit_function_call(self, node):
+    node.set_args([a.visit(self) for a in node.args])
+    return node
+
+
+def _is_pure_expr(expr, program_context):
+  # Whether |expr| can be dropped when its value is not used.
+  if _is_lit(expr) or isinstance(expr, BinaryExprNode):
+    return True
+  if isinstance(expr, UnaryExprWithOpNode):
+    # Receiving from a channel has side effects.
+    return expr.op != '<-'
+  # Assigning a function only allocates a closure.
+  return isinstance(expr, IdentifierNode) or isinstance(expr, FunctionLitNode)
+
+
+def _remove_dead_stores(stmts, usage, program_context):
+  # Walks |stmts| backwards, so that removing a store also makes the stores
+  # it was the only reader of dead.
+  kept = []
+  for stmt in reversed(stmts):
+    if isinstance(stmt, BlockNode):
+      stmt.set_stmts(_remove_dead_stores(stmt.stmts, usage, program_context))
+    elif isinstance(stmt, AssignmentNode) and usage.is_dead(stmt.var.name):
+      if _is_pure_expr(stmt.expr, program_context):
+        usage.remove(stmt)
+        continue
+      if isinstance(stmt.expr, FunctionCallNode):
+        # Only the side effects of the call are needed.
+        usage.remove_assignment(stmt.var.name)
+        stmt = ExpressionStmtNode(stmt.expr)
+    elif isinstance(stmt, ExpressionStmtNode):
+      if _is_pure_expr(stmt.expr, program_context):
+        usage.remove(stmt)
+        continue
+    elif isinstance(stmt, VarSpecNode):
+      if stmt.init_expr is None and usage.is_unused(stmt.var.name):
+        continue
+    kept.append(stmt)
+  kept.reverse()
+  return kept
+
+
+def fold_constants(ast, program_context):
+  '''Folds constant expressions, simplifies x * 1, x + 0, x - 0, -(-x) and
+  the like, and propagates the constants into the variables that are only
+  assigned once. The stores and variables that end up unused are removed.
+  '''
+  ast.visit(_FoldConstantsVisitor(_count_var_usage(program_context)))
+  usage = _count_var_usage(program_context)
+  for func in program_context.functions.values():
+    func.set_body(_remove_dead_stores(func.body, usage, program_context))
+
+
+'''Dead temporary elimination pass
+'''
+
+
+def _merge_target(stmt):
+  # Returns the identifier |stmt| is a plain copy or return of, or None.
+  if isinstance(stmt, AssignmentNode) or isinstance(stmt, ReturnNode):
+    if isinstance(stmt.expr, IdentifierNode):
+      return stmt.expr
+  return None
+
+
+def _can_merge(temp_stmt, use_stmt, usage, program_context):
+  target = _merge_target(use_stmt)
+  if target is None or target.name != temp_stmt.var.name:
+    return False
+  name = target.name
+  if not usage.is_single_assigned(name) or usage.reads.get(name, 0) != 1:
+    return False
+  if (isinstance(use_stmt, AssignmentNode) and
+          use_stmt.var.name in usage.captured):
+    # The store into a captured variable goes through its box, which must
+    # only be loaded once |expr| is evaluated.
+    return False
+  if isinstance(use_stmt, ReturnNode):
+    # A closure can only be created by an assignment.
+    expr = temp_stmt.expr
+    if isinstance(expr, FunctionLitNode) or (
+            isinstance(expr, IdentifierNode) and
+            expr.name in program_context.functions):
+      return False
+  return True
+
+
+def _merge_temporaries(stmts, usage, program_context):
+  # Rewrites |t = expr; v = t;| into |v = expr;|, and |t = expr; return t;|
+  # into |return expr;|, if that is the only read of |t|. Only declarations
+  # may be between the two statements, so |expr| is evaluated at the same
+  # point as before.
+  result = []
+  # Index in |result| of the assignment right before the current statement.
+  last_assignment = None
+  for stmt in stmts:
+    if isinstance(stmt, VarSpecNode) and stmt.init_expr is None:
+      result.append(stmt)
+      continue
+    if isinstance(stmt, BlockNode):
+      stmt.set_stmts(_merge_temporaries(stmt.stmts, usage, program_context))
+    elif last_assignment is not None:
+      temp_stmt = result[last_assignment]
+      if _can_merge(temp_stmt, stmt, usage, program_context):
+        usage.remove_assignment(temp_stmt.var.name)
+        usage.remove(ExpressionStmtNode(stmt.expr))
+        stmt.set_expr(temp_stmt.expr)
+        del result[last_assignment]
+
+    if isinstance(stmt, AssignmentNode):
+      last_assignment = len(result)
+    else:
+      last_assignment = None
+    result.append(stmt)
+  return result
+
+
+def eliminate_temporaries(ast, program_context):
+  '''Removes the temporaries created by |flatten|.
+
+  Copies of variables that do not change anymore are propagated, a
+  temporary that is assigned once and read once by the next statement is
+  merged into it, and the stores and declarations left unused are removed.
+  Variables shared with closures are left alone. Straight-line code makes
+  the use counts an exact liveness information.
+  '''
+  ast.visit(_FoldConstantsVisitor(
+      _count_var_usage(program_context), propagate_copies=True))
+  usage = _count_var_usage(program_context)
+  for func in program_context.functions.values():
+    func.set_body(_merge_temporaries(func.body, usage, program_context))
+    func.set_body(_remove_dead_stores(func.body, usage, program_context))
+
+
+'''Escape analysis pass
+'''
+
+
+def _iter_stmts(stmts):
+  # Yields |stmts| and the statements of the nested blocks, in order. The
+  # bodies of function literals are not included.
+  for stmt in stmts:
+    if isinstance(stmt, BlockNode):
+      for s in _iter_stmts(stmt.stmts):
+        yield s
+    else:
+      yield stmt
+
+
+def _collect_closure_bindings(stmts, bindings):
+  # After flattening, a function literal can only be the RHS of an
+  # assignment.
+  for stmt in _iter_stmts(stmts):
+    if isinstance(stmt, AssignmentNode) and isinstance(
+            stmt.expr, FunctionLitNode):
+      bindings[stmt.expr.name] = stmt.var.name
+
+
+def analyze_escapes(ast, program_context):
+  '''Finds the captured variables that never outlive their stack frame.
+
+  The closure of a function literal does not escape if it is stored in a
+  local variable that is assigned once, and only ever read to be called. A
+  captured variable can then live on the stack of its function if all the
+  closures capturing it, at any nesting depth, do not escape: they are all
+  called and done before the function returns.
+  '''
+  usage = _count_var_usage(program_context)
+  # function literal name -> name of the variable holding its closure
+  bindings = {}
+  for func in program_context.functions.values():
+    _collect_closure_bindings(func.body, bindings)
+
+  non_escaping = program_context.non_escaping_closures
+  non_escaping.clear()
+  for func_name, var_name in bindings.items():
+    if (usage.is_single_assigned(var_name) and
+            usage.reads.get(var_name, 0) == usage.calls.get(var_name, 0)):
+      non_escaping.add(func_name)
+
+  heap_vars = set()
+  for func_name, func in program_context.functions.items():
+    if func_name not in non_escaping:
+      heap_vars.update(func.scope_varset.free_vars)
+  stack_vars = program_context.stack_captured_vars
+  stack_vars.clear()
+  stack_vars.update(usage.captured - heap_vars)
+
+
+'''Closure call resolution pass
+'''
+
+
+def _get_call(stmt):
+  # After flattening, calls are only found at the top of statements.
+  expr = getattr(stmt, 'expr', None)
+  if isinstance(expr, FunctionCallNode):
+    return expr
+  return None
+
+
+def resolve_closure_calls(ast, program_context):
+  '''Turns the calls through closures that are known to call a given
+  function into direct calls.
+
+  A variable assigned once, either a function literal or a function name,
+  always holds a closure of that function. The calls through it call the
+  function directly and pass the closure as the context tuple. If the
+  function has no free variables, the call passes NULL instead, and the
+  closure is not allocated at all when nothing else uses it.
+  '''
+  functions = program_context.functions
+  targets = _collect_closure_targets(
+      program_context, _count_var_usage(program_context))
+  for func in functions.values():
+    for stmt in _iter_stmts(func.body):
+      call = _get_call(stmt)
+      if call is None or call.func_expr.name not in targets:
+        continue
+      target = targets[call.func_expr.name]
+      if target.scope_varset.free_vars:
+        call.set_callee(target.name)
+      else:
+        call.set_func_expr(IdentifierNode(target.name, target.type))
+
+  usage = _count_var_usage(program_context)
+  for func in functions.values():
+    func.set_body(_remove_dead_stores(func.body, usage, program_context))
+
+
+'''Tail call pass
+'''
+
+
+def _c_signature(func_type):
+  # The C types of the return value and of the parameters.
+  return (_strfy_type(get_func_ret_type(func_type)),
+          tuple(_strfy_type(t) for t in get_func_param_types(func_type)))
+
+
+def _declares_stack_captured_vars(stmts, program_context):
+  for stmt in stmts:
+    if isinstance(stmt, BlockNode):
+      if _declares_stack_captured_vars(stmt.stmts, program_context):
+        return True
+    elif (isinstance(stmt, VarSpecNode) and
+          stmt.var.name in program_context.stack_captured_vars):
+      return True
+  return False
+
+
+def mark_tail_calls(ast, program_context):
+  '''Marks the calls in return position.
+
+  A call of the function itself becomes a jump back to its start, so that
+  self recursion runs in constant stack. A call of another function with
+  the same C signature is a sibling call that reuses the stack frame of the
+  caller, unless the caller has variables on its stack that closures point
+  to.
+  '''
+  for func in program_context.functions.values():
+    signature = _c_signature(func.type)
+    can_reuse_frame = not _declares_stack_captured_vars(
+        func.body, program_context)
+    for stmt in _iter_stmts(func.body):
+      if not isinstance(stmt, ReturnNode) or not isinstance(
+              stmt.expr, FunctionCallNode):
+        continue
+      call = stmt.expr
+      if func.name in (call.callee, call.func_expr.name):
+        call.set_tail_call(SELF_TAIL_CALL)
+      elif can_reuse_frame and _c_signature(
+              call.func_expr.type) == signature:
+        call.set_tail_call(SIBLING_TAIL_CALL)
 
 
 '''
@@ -976,22 +1922,109 @@ def _strfy_type(t):
   return _GC_HEADER_T
 
 
-def _strfy_to_c_func_ptr_type(t):
-  assert is_func_type(t)
-  result = _strfy_type(get_func_ret_type(t))
-  result += '(*)(' + _GC_HEADER_T
-  for pt in get_func_param_types(t):
-    result += ', ' + _strfy_type(pt)
-  result += ')'
-  return result
+class _SignatureTable(object):
+  # Interns the C function pointer types. Fo function types with the same C
+  # signature share a single typedef.
+
+  def __init__(self):
+    # C signature -> typedef name
+    self._names = {}
+    self._typedefs = []
+
+  @property
+  def typedefs(self):
+    # The typedefs, in the order the signatures were interned.
+    return self._typedefs
+
+  def intern(self, t):
+    assert is_func_type(t)
+    ret_type, param_types = _c_signature(t)
+    name = self._names.get((ret_type, param_types))
+    if name is None:
+      name = 'funct{}_t'.format(len(self._typedefs))
+      self._names[(ret_type, param_types)] = name
+      self._typedefs.append('typedef {} (*{})({});'.format(
+          ret_type, name, ', '.join((_GC_HEADER_T,) + param_types)))
+    return name
+
+
+def _static_closure_name(func_name):
+  return func_name + '_static_closure'
+
+
+def _tail_entry_label(func_name):
+  return func_name + '_tail_entry'
+
+
+_PROFILE_NAMES = 'fo_profile_names'
+_PROFILE_COUNTERS = 'fo_profile_counters'
+_PROFILE_TARGETS = 'fo_profile_targets'
+
+
+def _collect_profile_keys(program_context, funcs):
+  # Returns the sorted profile keys the instrumented |funcs| count, see
+  # fo_profile.
+  keys = set()
+  for func in funcs:
+    keys.add(fo_profile.function_key(func.name))
+    for stmt in _iter_stmts(func.body):
+      call = _get_call(stmt)
+      if call is None or call.site is None:
+        continue
+      keys.add(call.site)
+      for target in _closure_call_candidates(program_context, call):
+        keys.add(fo_profile.target_key(call.site, target))
+  return sorted(keys)
+
+
+def _closure_call_candidates(program_context, call):
+  # The sorted names of the functions a call through a closure may call:
+  # all those with its C signature. Empty for the other calls.
+  functions = program_context.functions
+  if call.func_expr.name in functions or call.callee is not None:
+    return []
+  signature = _c_signature(call.func_expr.type)
+  return sorted(name for name, func in functions.items()
+                if _c_signature(func.type) == signature)
+
+
+def _collect_static_closures(program_context, funcs):
+  # Returns the sorted names of the functions without free variables that
+  # |funcs| use as values. Their closures are shared static objects.
+  functions = program_context.functions
+  usage = _VarUsageVisitor()
+  for func in funcs:
+    usage.count_function(func)
+  result = set()
+  for name in functions:
+    if usage.reads.get(name, 0) > usage.calls.get(name, 0):
+      result.add(name)
+  for func in funcs:
+    for stmt in _iter_stmts(func.body):
+      if isinstance(stmt, AssignmentNode) and isinstance(
+              stmt.expr, FunctionLitNode):
+        result.add(stmt.expr.name)
+  return sorted(name for name in result
+                if not functions[name].scope_varset.free_vars)
 
 
 class _CodeGenVisitor(object):
 
-  def __init__(self, program_context):
+  def __init__(self, program_context, function_names=None, out=None):
     self._program_context = program_context
+    # The functions to define, all of them if None.
+    self._function_names = function_names
     self._env = ScopedEnv()
-    self._builder = SourceCodeBuilder()
+    self._builder = SourceCodeBuilder(sink=out)
+    # Captured variables boxed on the heap. Names are unique, so every
+    # access to them, in any function, goes through the box.
+    self._heap_captured_vars = set()
+    self._current_func = None
+    self._signatures = _SignatureTable()
+    # profile key -> index of its counter, when instrumenting.
+    self._profile_counters = {}
+    # call site through closures -> its profile_target_t table.
+    self._profile_targets = {}
 
   def build(self):
     return self._builder.build()
@@ -1004,26 +2037,183 @@ class _CodeGenVisitor(object):
         '#include "runtime/memory.h"',
         '#include "runtime/tuple.h"',
     ]
+    if self._program_context.instrument:
+      headers.append('#include "runtime/profile.h"')
     for h in headers:
       self._builder.append(h)
       self._builder.new_line()
 
-    for func_name, func_node in self._program_context.functions.iteritems():
+    stack_vars = self._program_context.stack_captured_vars
+    for func in self._program_context.functions.values():
+      for var_name in func.scope_varset.free_vars:
+        if var_name not in stack_vars:
+          self._heap_captured_vars.add(var_name)
+
+    # Callees are defined before their callers, in an order that only
+    # depends on the program, so the same program always gives the same C.
+    functions = [self._program_context.functions[name] for name in
+                 _callees_first(_build_call_graph(self._program_context))]
+    defined = functions
+    if self._function_names is not None:
+      defined = [f for f in functions if f.name in self._function_names]
+    for func in defined:
+      for stmt in _iter_stmts(func.body):
+        call = _get_call(stmt)
+        if call is not None and self._is_indirect_call(call):
+          self._signatures.intern(call.func_expr.type)
+    if self._signatures.typedefs:
+      self._builder.new_line()
+    for typedef in self._signatures.typedefs:
+      self._builder.new_line()
+      self._builder.append(typedef)
+
+    # Closures and recursive functions can still be called before their
+    # definition.
+    self._builder.new_line()
+    for func_node in functions:
+      self._declare_function(func_node)
+
+    if self._program_context.instrument:
+      self._declare_profile_counters(defined)
+
+    static_closures = _collect_static_closures(
+        self._program_context, defined)
+    if static_closures:
+      self._builder.new_line()
+    for func_name in static_closures:
+      self._builder.new_line()
+      self._builder.append('DECLARE_STATIC_CLOSURE({});'.format(
+          _static_closure_name(func_name)))
+
+    for func_node in defined:
       self._builder.new_line()
       self._define_function(func_node)
 
-  def _declare_function(self, node):
-    # if we define all the functions in topological sorted order, then this
-    # is no longer necessary.
-    assert _is_func_node(node)
+    if static_closures:
+      self._builder.new_line()
+    for func_name in static_closures:
+      self._builder.new_line()
+      self._builder.append('DEFINE_STATIC_CLOSURE({}, {});'.format(
+          _static_closure_name(func_name), func_name))
+
+  def _declare_profile_counters(self, funcs):
+    keys = _collect_profile_keys(self._program_context, funcs)
+    if not keys:
+      return
+    self._profile_counters = dict((k, i) for i, k in enumerate(keys))
     self._builder.new_line()
-    self._builder.append(_strfy_type(node.return_type))
-    self._builder.append(node.name)
-    self._builder.append('(')
+    self._builder.new_line()
+    self._builder.append(
+        'static const char* const {}[] = {{'.format(_PROFILE_NAMES))
+    with self._builder.indent(4):
+      for key in keys:
+        self._builder.new_line()
+        self._builder.append('"{}",'.format(key), append_whitespace=False)
+    self._builder.new_line()
+    self._builder.append('};')
+    self._builder.new_line()
+    self._builder.append(
+        'static uint64_t* {} = NULL;'.format(_PROFILE_COUNTERS))
+
+    for func in funcs:
+      for stmt in _iter_stmts(func.body):
+        call = _get_call(stmt)
+        if call is None or call.site is None:
+          continue
+        candidates = _closure_call_candidates(self._program_context, call)
+        if candidates:
+          self._declare_profile_targets(call.site, candidates)
+
+  def _declare_profile_targets(self, site, candidates):
+    # The table of the functions the call through closures at |site| may
+    # call, see count_profile_target().
+    table = '{}_{}'.format(_PROFILE_TARGETS, self._profile_counters[site])
+    self._profile_targets[site] = (table, len(candidates))
+    self._builder.new_line()
+    self._builder.append(
+        'static profile_target_t {}[] = {{'.format(table))
+    with self._builder.indent(4):
+      for target in candidates:
+        self._builder.new_line()
+        self._builder.append('{{(val_t){}, {}}},'.format(
+            target, self._profile_counters[
+                fo_profile.target_key(site, target)]),
+            append_whitespace=False)
+    self._builder.new_line()
+    self._builder.append('};')
 
-  def _define_function(self, node):
+  def _count(self, key):
+    # Appends the statement counting |key|, if it is instrumented.
+    i = self._profile_counters.get(key)
+    if i is None:
+      return
+    self._builder.append('PROFILE_COUNT({}, {}, {}, {});'.format(
+        _PROFILE_COUNTERS, _PROFILE_NAMES, len(self._profile_counters), i))
+
+  def _count_call(self, call):
+    # Also registers the counters.
+    self._count(call.site)
+    if call.site not in self._profile_targets:
+      return
+    # Which function the closure holds.
+    table, num_targets = self._profile_targets[call.site]
+    self._builder.new_line()
+    self._builder.append(
+        'count_profile_target({}, {}, {}, get_tuple_at({}, 0));'.format(
+            _PROFILE_COUNTERS, table, num_targets,
+            self._get_id_cexpr(call.func_expr.name)))
+
+  def _visit_stmt(self, stmt):
+    call = _get_call(stmt)
+    if self._profile_counters and call is not None:
+      self._builder.new_line()
+      self._count_call(call)
+    self._builder.new_line()
+    stmt.visit(self)
+
+  def _function_attribute(self, node):
+    # FO_HOT or FO_COLD, from the profile.
+    profile = self._program_context.profile
+    if profile is None:
+      return None
+    key = fo_profile.function_key(node.name)
+    if profile.is_cold(key):
+      return 'FO_COLD'
+    if profile.is_hot(key):
+      return 'FO_HOT'
+    return None
+
+  def _likely_target(self, node):
+    # The function the profile shows a call through a closure nearly always
+    # calls, or None.
+    profile = self._program_context.profile
+    if (profile is None or node.site is None or
+            not self._is_indirect_call(node)):
+      return None
+    target = profile.likely_target(node.site)
+    if target is None:
+      return None
+    func = self._program_context.functions.get(target)
+    # The program may have changed since it was profiled.
+    if func is None or _c_signature(func.type) != _c_signature(
+            node.func_expr.type):
+      return None
+    return target
+
+  def _is_indirect_call(self, node):
+    # Whether |node| calls the function pointer stored in a closure.
+    return (node.func_expr.name not in self._program_context.functions and
+            node.callee is None)
+
+  def _declare_function(self, node):
     assert _is_func_node(node)
+    self._append_function_head(node)
+    self._builder.append(';')
+
+  def _append_function_head(self, node, attribute=None):
     self._builder.new_line()
+    if attribute is not None:
+      self._builder.append(attribute)
     self._builder.append(_strfy_type(node.return_type))
     self._builder.append(node.name)
     self._builder.append('(')
@@ -1039,31 +2229,61 @@ class _CodeGenVisitor(object):
       self._builder.append(',')
       self._builder.append('{} {}'.format(_strfy_type(t), p.name))
     self._builder.append(')')
+
+  def _define_function(self, node):
+    assert _is_func_node(node)
+    self._append_function_head(node, self._function_attribute(node))
     self._builder.append('{')
+    self._current_func = node
     with self._builder.indent():
+      if any(_get_call(stmt) is not None and
+             _get_call(stmt).tail_call == SELF_TAIL_CALL
+             for stmt in _iter_stmts(node.body)):
+        self._builder.new_line()
+        # The free variables are loaded again, the context may change.
+        self._builder.append('{}:;'.format(_tail_entry_label(node.name)))
+      if self._profile_counters:
+        self._builder.new_line()
+        self._count(fo_profile.function_key(node.name))
       with self._env.scope(_CodeGenScopeNode(node)):
         for i, var_name in enumerate(node.scope_varset.free_vars):
           self._builder.new_line()
+          if var_name in self._program_context.stack_captured_vars:
+            # The address of the variable on the stack of its function.
+            var_type = '{}*'.format(_strfy_type(
+                self._program_context.var_types[var_name]))
+          else:
+            var_type = _GC_HEADER_T
           # context_tuple[0] stores the function pointer
           self._builder.append(
               '{0} {1} = ({0})get_tuple_at(context_tuple, {2});'.format(
-                  _GC_HEADER_T, var_name, i + 1))
+                  var_type, var_name, i + 1))
         for stmt in node.body:
-          self._builder.new_line()
-          stmt.visit(self)
+          self._visit_stmt(stmt)
+    self._current_func = None
     self._builder.new_line()
     self._builder.append('}')
 
   def _get_id_cexpr(self, name):
-    scope_varset = self._env.top.ast_node.scope_varset
-    if name in scope_varset.captured_vars or name in scope_varset.free_vars:
-      return '*GC_TO_OBJ(FAKE_TYPE, {})'.format(name)
+    if name in self._heap_captured_vars:
+      return '*GC_TO_OBJ({}, {})'.format(
+          _strfy_type(self._program_context.var_types[name]), name)
+    if name in self._current_func.scope_varset.free_vars:
+      # A stack captured variable of an enclosing function.
+      return '(*{})'.format(name)
+    return name
+
+  def _get_captured_var_cval(self, name):
+    # The value a closure tuple stores for the captured variable |name|.
+    if (name in self._program_context.stack_captured_vars and
+            name not in self._current_func.scope_varset.free_vars):
+      return '&' + name
     return name
 
   def visit_var_spec(self, node):
     name = node.var.name
-    if name in self._env.top.ast_node.scope_varset.captured_vars:
-      l = '{} {} = gc_alloc_trivial(sizeof(val_t), get_trivial_obj_operators());'.format(
+    if name in self._heap_captured_vars:
+      l = '{} {} = gc_alloc_trivial(sizeof(val_t));'.format(
           _GC_HEADER_T, name)
       self._builder.append(l)
     else:
@@ -1080,8 +2300,7 @@ class _CodeGenVisitor(object):
     with self._builder.indent():
       with self._env.scope(_CodeGenScopeNode(node)):
         for stmt in node.stmts:
-          self._builder.new_line()
-          stmt.visit(self)
+          self._visit_stmt(stmt)
     self._builder.new_line()
     self._builder.append('}')
 
@@ -1103,23 +2322,55 @@ class _CodeGenVisitor(object):
     if is_func_ref():
       self.visit_assign_function(node)
       return
+    name = node.var.name
+    if name in self._heap_captured_vars and _get_call(node) is not None:
+      with self._box_store(name) as tmp:
+        self._builder.append('{} ='.format(tmp))
+        node.expr.visit(self)
+        self._builder.append(';')
+      return
     node.var.visit(self)
     self._builder.append('=')
     node.expr.visit(self)
     self._builder.append(';')
 
-  def visit_assign_function(self, node):
+  @contextmanager
+  def _box_store(self, name):
+    # Any allocation can run the GC, which moves the box of the heap
+    # captured variable |name|: the value is computed into a temporary,
+    # which is stored into the box afterwards.
+    tmp = '{}_value'.format(name)
+    self._builder.append('{')
+    with self._builder.indent():
+      self._builder.new_line()
+      self._builder.append('{} {};'.format(
+          _strfy_type(self._program_context.var_types[name]), tmp))
+      self._builder.new_line()
+      yield tmp
+      self._builder.new_line()
+      self._builder.append('{} = {};'.format(self._get_id_cexpr(name), tmp))
+    self._builder.new_line()
+    self._builder.append('}')
 
-    var_cexpr = self._get_id_cexpr(node.var.name)
-    # node.var.visit(self)
-    self._builder.append(var_cexpr + ' =')
+  def visit_assign_function(self, node):
+    name = node.var.name
     func = node.expr
     if isinstance(func, IdentifierNode):
       func = self._program_context.functions[func.name]
+    if not func.scope_varset.free_vars:
+      self._builder.append('{} = &{};'.format(
+          self._get_id_cexpr(name), _static_closure_name(func.name)))
+      return
+    if name in self._heap_captured_vars:
+      with self._box_store(name) as tmp:
+        self._alloc_closure(tmp, func)
+      return
+    self._alloc_closure(self._get_id_cexpr(name), func)
+
+  def _alloc_closure(self, var_cexpr, func):
     free_vars = func.scope_varset.free_vars
     num_slots = 1 + len(free_vars)
-    # TODO: consider the case where |node.var| is captured
-    self._builder.append('alloc_tuple({});'.format(num_slots))
+    self._builder.append('{} = alloc_tuple({});'.format(var_cexpr, num_slots))
     self._builder.append(
         'set_tuple_at({}, 0, (val_t){}, false);'.format(
             var_cexpr, func.name))
@@ -1129,19 +2380,54 @@ class _CodeGenVisitor(object):
       self._builder.new_line()
       self._builder.append(
           'set_tuple_at({}, {}, (val_t){}, /*needs_gc=*/false);'.format(
-              var_cexpr, i + 1, fvar))
-    # return self.visit_assignment(node)
+              var_cexpr, i + 1, self._get_captured_var_cval(fvar)))
 
   def visit_return(self, node):
+    tail_call = None
+    if isinstance(node.expr, FunctionCallNode):
+      tail_call = node.expr.tail_call
+    if tail_call == SELF_TAIL_CALL:
+      self._self_tail_call(node.expr)
+      return
+    if tail_call == SIBLING_TAIL_CALL:
+      self._builder.append('FO_MUSTTAIL')
     self._builder.append('return')
     if node.expr is not None:
       node.expr.visit(self)
     self._builder.append(';')
 
+  def _self_tail_call(self, node):
+    # Evaluates all the arguments first, then overwrites the parameters and
+    # jumps back to the start of the function.
+    func = self._current_func
+    assignments = []
+    self._builder.append('{')
+    with self._builder.indent():
+      if node.callee is not None:
+        tmp = '{}_tail_context'.format(func.name)
+        self._builder.new_line()
+        self._builder.append('{} {} ='.format(_GC_HEADER_T, tmp))
+        node.func_expr.visit(self)
+        self._builder.append(';')
+        assignments.append(('context_tuple', tmp))
+      for i, ((p, t), a) in enumerate(zip(func.parameters, node.args)):
+        tmp = '{}_tail_arg{}'.format(func.name, i)
+        self._builder.new_line()
+        self._builder.append('{} {} ='.format(_strfy_type(t), tmp))
+        a.visit(self)
+        self._builder.append(';')
+        assignments.append((p.name, tmp))
+      for var, tmp in assignments:
+        self._builder.new_line()
+        self._builder.append('{} = {};'.format(var, tmp))
+      self._builder.new_line()
+      self._builder.append('goto {};'.format(_tail_entry_label(func.name)))
+    self._builder.new_line()
+    self._builder.append('}')
+
   def visit_expression_stmt(self, node):
-    self._builder.append('(')
     node.expr.visit(self)
-    self._builder.append(')')
+    self._builder.append(';')
 
   def visit_unary_expr_with_op(self, node):
     self._builder.append(node.op + ' (')
@@ -1159,10 +2445,15 @@ class _CodeGenVisitor(object):
     self._builder.append(str(node.val))
 
   def visit_float_lit(self, node):
-    self._builder.append(str(node.val))
+    # repr() round-trips, str() may drop digits on Python 2.
+    self._builder.append(repr(node.val))
 
   def visit_identifier(self, node):
     name = node.name
+    if name in self._program_context.functions:
+      # Only functions without free variables are referred to by name.
+      self._builder.append('&' + _static_closure_name(name))
+      return
     self._builder.append(self._get_id_cexpr(name))
 
   def visit_function_decl(self, node):
@@ -1174,41 +2465,121 @@ class _CodeGenVisitor(object):
 
   def visit_function_call(self, node):
     func_expr = node.func_expr
-    is_plain_function = False
-    try:
-      is_plain_function = isinstance(
-          self._program_context.functions[
-              func_expr.name], FunctionDeclNode)
-    except:
-      is_plain_function = False
-
-    if is_plain_function:
-      self._builder.append(func_expr.name)
-    else:
-      self._builder.append(
-          '(({})get_tuple_at('.format(
-              _strfy_to_c_func_ptr_type(
-                  func_expr.type)))
-      func_expr.visit(self)
-      self._builder.append(', 0))')
+    if func_expr.name in self._program_context.functions:
+      # A function called by name has no free variables, it does not need a
+      # context tuple.
+      self._append_call(func_expr.name, 'NULL', node.args)
+      return
+    context = self._get_id_cexpr(func_expr.name)
+    if node.callee is not None:
+      self._append_call(node.callee, context, node.args)
+      return
+    func_ptr = '(({})get_tuple_at({}, 0))'.format(
+        self._signatures.intern(func_expr.type), context)
+    target = None
+    if node.tail_call is None:
+      # FO_MUSTTAIL needs a plain call.
+      target = self._likely_target(node)
+    if target is None:
+      self._append_call(func_ptr, context, node.args)
+      return
+    # Calls the likely function directly, the guard is almost always true.
+    self._builder.append(
+        '(FO_LIKELY(get_tuple_at({}, 0) == (val_t){}) ?'.format(
+            context, target))
+    self._append_call(target, context, node.args)
+    self._builder.append(':')
+    self._append_call(func_ptr, context, node.args)
+    self._builder.append(')')
 
+  def _append_call(self, func, context, args):
+    self._builder.append(func)
     self._builder.append('(')
-    if is_plain_function:
-      self._builder.append('NULL')
-    else:
-      func_expr.visit(self)
-
-    for a in node.args:
+    self._builder.append(context)
+    for a in args:
       self._builder.append(',')
       a.visit(self)
-    self._builder.append(');')
+    self._builder.append(')')
+
 
+def code_gen(ast, program_context, function_names=None, out=None):
+  '''Generates the C code of |ast|, after |run_passes|.
 
-def code_gen(ast, program_context):
-  visitor = _CodeGenVisitor(program_context)
+  If |function_names| is given, only these functions are defined, and the
+  others are only declared. The C code is a translation unit of its own.
+  If |out| is given, the code is streamed to it, a file-like object, line by
+  line, and None is returned.
+  '''
+  visitor = _CodeGenVisitor(program_context, function_names, out)
   ast.visit(visitor)
   return visitor.build()
 
+
+_PASSES = [
+    ('assign_function_lit_name', assign_function_lit_name),
+    ('flatten', flatten),
+    ('uniquify_vars', uniquify_vars),
+    ('reveal_vars', reveal_vars),
+    ('fix_ast', lambda ast, program_context: fix_ast(ast)),
+    ('assign_check_types', assign_check_types),
+    ('number_call_sites', number_call_sites),
+    ('inline_functions', inline_functions),
+    ('fold_constants', fold_constants),
+    ('eliminate_temporaries', eliminate_temporaries),
+    ('analyze_escapes', analyze_escapes),
+    ('resolve_closure_calls', resolve_closure_calls),
+    ('mark_tail_calls', mark_tail_calls),
+]
+
+
+def run_passes(ast, timings=None, instrument=False, profile=None):
+  '''Runs all the passes over |ast|, which is changed in place.
+
+  Returns the program context |code_gen| needs. If |timings| is a dict, the
+  seconds spent in each pass are stored in it, keyed by the pass name. If
+  |instrument| is true, the generated C counts the calls for a profile, and
+  |profile|, a fo_profile.Profile, steers the optimizations.
+  '''
+  if timings is None:
+    timings = {}
+  program_context = _ProgramContext(instrument=instrument, profile=profile)
+  for name, run_pass in _PASSES:
+    start = time.time()
+    run_pass(ast, program_context)
+    timings[name] = time.time() - start
+  return program_context
+
+
+def compile_source(source, parser=None, lexer=None, timings=None,
+                   inlined_calls=None, out=None, instrument=False,
+                   profile=None):
+  '''Compiles Fo |source| into C.
+
+  |parser| and |lexer| are created if not given. If |timings| is a dict, the
+  seconds spent in each pass are stored in it, keyed by the pass name. If
+  |inlined_calls| is a list, the (caller, callee) names of the inlined call
+  sites are appended to it. The C code is returned, or streamed to |out| if
+  it is given, see |code_gen|. See |run_passes| for |instrument| and
+  |profile|.
+  '''
+  if timings is None:
+    timings = {}
+  parser = parser or fo_parser.FoParser()
+
+  start = time.time()
+  ast = parser.parse(source, lexer=lexer)
+  timings['parse'] = time.time() - start
+
+  program_context = run_passes(
+      ast, timings, instrument=instrument, profile=profile)
+  if inlined_calls is not None:
+    inlined_calls.extend(program_context.inlined_calls)
+
+  start = time.time()
+  result = code_gen(ast, program_context, out=out)
+  timings['code_gen'] = time.time() - start
+  return result
+
 if __name__ == '__main__':
   test_data = '''
   func makeClosure(i int) func() {
@@ -1234,31 +2605,5 @@ if __name__ == '__main__':
   }
   '''
 
-  # test_data = '''
-  # func main() {
-  #   var k int = func(i int, j int) int {
-  #     return i + j * -2;
-  #   }(2, 22);
-  #   func() { return 42; }();
-  # }
-  # '''
-
-  parser = fo_parser.FoParser()
-  ast = parser.parse(test_data)
-
-  program_context = _ProgramContext()
-  assign_function_lit_name(ast, program_context)
-  # print(program_context.functions.keys())
-  # fix_function_call(ast, program_context)
-  flatten(ast, program_context)
-  uniquify_vars(ast, program_context)
-  reveal_vars(ast, program_context)
-  fix_ast(ast)
-  assign_check_types(ast, program_context)
-
-  # print(program_context)
-  # print()
-  # print(gen_source_code(ast))
-
   print('/********** Fo Generated C Code **********/')
-  print(code_gen(ast, program_context))
+  print(compile_source(test_data))
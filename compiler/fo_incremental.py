@@ -0,0 +1,290 @@
+'''Incremental compilation of Fo programs, one C file per function.
+
+Usage: python fo_incremental.py [-o OUT_DIR] [--cache-dir DIR] FILE.fo
+
+Every top-level function is compiled into a C translation unit of its own,
+OUT_DIR/<function>.c, which also defines the function literals it contains.
+A unit is keyed by a fingerprint of:
+  - the source of the function, as printed back from its AST, so that
+    formatting and comments do not matter,
+  - the source of every function it refers to, directly or not. These are
+    its free names: their signatures decide how it calls them, and the
+    inliner may copy their bodies into it,
+  - |UNIT_CACHE_VERSION| and the source of the compiler.
+
+The units are stored in the cache directory under their fingerprint. Only the
+functions whose unit is not cached are compiled, together with the functions
+they refer to, and an output file is only rewritten when its content
+changes, so that the C build is incremental too.
+
+The cache lives in $FO_TABLE_CACHE_DIR/units, or ~/.cache/fo/units if it is
+not set. Setting FO_TABLE_CACHE_DIR to an empty string disables the cache.
+'''
+from __future__ import print_function
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+
+import fo_ast
+import fo_compiler
+import fo_parser
+import fo_table_cache
+import fo_types
+import scoped_env
+import source_code_builder
+
+# Bump this whenever the layout of the units changes.
+UNIT_CACHE_VERSION = 1
+
+# The modules whose source decides the generated C.
+_COMPILER_MODULES = [fo_ast, fo_compiler, fo_parser, fo_types, scoped_env,
+                     source_code_builder]
+
+_compiler_signature = None
+
+
+def _get_compiler_signature():
+  global _compiler_signature
+  if _compiler_signature is None:
+    h = hashlib.sha1()
+    for module in _COMPILER_MODULES:
+      # __file__ can be the .pyc.
+      path = os.path.splitext(module.__file__)[0] + '.py'
+      with open(path, 'rb') as f:
+        h.update(f.read())
+    _compiler_signature = h.hexdigest()
+  return _compiler_signature
+
+
+def get_cache_dir():
+  cache_dir = fo_table_cache.get_cache_dir()
+  return cache_dir and os.path.join(cache_dir, 'units')
+
+
+class _UnitVisitor(object):
+  # Collects the names a top-level function refers to, and the function
+  # literals it contains.
+
+  def __init__(self):
+    self._names = set()
+    self._function_lits = []
+
+  @property
+  def names(self):
+    return self._names
+
+  @property
+  def function_lits(self):
+    return self._function_lits
+
+  def visit_var_spec(self, node):
+    if node.init_expr is not None:
+      node.init_expr.visit(self)
+
+  def visit_block(self, node):
+    for stmt in node.stmts:
+      stmt.visit(self)
+
+  def visit_assignment(self, node):
+    node.expr.visit(self)
+    node.var.visit(self)
+
+  def visit_return(self, node):
+    if node.expr is not None:
+      node.expr.visit(self)
+
+  def visit_expression_stmt(self, node):
+    node.expr.visit(self)
+
+  def visit_unary_expr_with_op(self, node):
+    node.expr.visit(self)
+
+  def visit_binary_expr(self, node):
+    node.lhs.visit(self)
+    node.rhs.visit(self)
+
+  def visit_int_lit(self, node):
+    pass
+
+  def visit_float_lit(self, node):
+    pass
+
+  def visit_identifier(self, node):
+    self._names.add(node.name)
+
+  def visit_function_decl(self, node):
+    for stmt in node.body:
+      stmt.visit(self)
+
+  def visit_function_lit(self, node):
+    self._function_lits.append(node)
+    for stmt in node.body:
+      stmt.visit(self)
+
+  def visit_function_call(self, node):
+    for a in node.args:
+      a.visit(self)
+    node.func_expr.visit(self)
+
+
+class _Unit(object):
+
+  __slots__ = ('decl', 'source', 'callees', 'function_lits', 'fingerprint')
+
+  def __init__(self, decl):
+    self.decl = decl
+    self.source = fo_ast.gen_source_code(decl)
+    visitor = _UnitVisitor()
+    decl.visit(visitor)
+    # Names of the other top-level functions it refers to, filled in by
+    # |_make_units|. Local variables shadowing them are counted too, which
+    # can only cause extra recompilations.
+    self.callees = visitor.names
+    self.function_lits = visitor.function_lits
+    self.fingerprint = None
+
+
+def _reachable(units, names):
+  # The names of the units reachable from |names|, them included.
+  result = set(names)
+  stack = list(names)
+  while stack:
+    for callee in units[stack.pop()].callees:
+      if callee not in result:
+        result.add(callee)
+        stack.append(callee)
+  return result
+
+
+def _make_units(ast):
+  units = dict((d.name, _Unit(d)) for d in ast.function_decls)
+  for name, unit in units.items():
+    unit.callees = set(n for n in unit.callees if n in units and n != name)
+  for name, unit in units.items():
+    parts = [str(UNIT_CACHE_VERSION), _get_compiler_signature(), unit.source]
+    for callee in sorted(_reachable(units, [name]) - set([name])):
+      parts.append(callee)
+      parts.append(units[callee].source)
+    h = hashlib.sha1()
+    h.update('\0'.join(parts).encode('utf-8'))
+    unit.fingerprint = h.hexdigest()
+  return units
+
+
+def _read_cached_unit(cache_dir, fingerprint):
+  if not cache_dir:
+    return None
+  try:
+    with open(os.path.join(cache_dir, fingerprint + '.c')) as f:
+      return f.read()
+  except IOError:
+    return None
+
+
+def _write_file(dir_name, base_name, content):
+  # Writes into a temporary file first, so that a concurrent reader never
+  # sees a partially written file.
+  fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'w') as f:
+      f.write(content)
+    os.rename(tmp_path, os.path.join(dir_name, base_name))
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+
+def _write_cached_unit(cache_dir, fingerprint, c_code):
+  if not cache_dir:
+    return
+  try:
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    _write_file(cache_dir, fingerprint + '.c', c_code)
+  except OSError:
+    # The cache is only an optimization.
+    pass
+
+
+def _write_if_changed(out_dir, base_name, content):
+  # Keeps the modification time of the files that did not change.
+  path = os.path.join(out_dir, base_name)
+  try:
+    with open(path) as f:
+      if f.read() == content:
+        return path
+  except IOError:
+    pass
+  _write_file(out_dir, base_name, content)
+  return path
+
+
+def compile_units(source, out_dir, cache_dir=None, parser=None, lexer=None):
+  '''Compiles Fo |source| into one C file per top-level function in
+  |out_dir|.
+
+  |cache_dir| defaults to |get_cache_dir()|. Returns the paths of the C
+  files, in the order of the functions in |source|, and the names of the
+  functions that were compiled because their unit was not cached.
+  '''
+  if cache_dir is None:
+    cache_dir = get_cache_dir()
+  parser = parser or fo_parser.FoParser()
+  ast = parser.parse(source, lexer=lexer)
+  units = _make_units(ast)
+
+  c_units = {}
+  dirty = []
+  for decl in ast.function_decls:
+    c_code = _read_cached_unit(cache_dir, units[decl.name].fingerprint)
+    if c_code is None:
+      dirty.append(decl.name)
+    else:
+      c_units[decl.name] = c_code
+
+  if dirty:
+    # The functions a dirty function refers to are needed for its types, and
+    # by the inliner.
+    needed = _reachable(units, dirty)
+    program = fo_ast.ProgramNode(
+        ast.var_decls, ast.type_decls,
+        [d for d in ast.function_decls if d.name in needed])
+    program_context = fo_compiler.run_passes(program)
+    for name in dirty:
+      unit = units[name]
+      # The function literals are named by the first pass.
+      function_names = set([name] + [f.name for f in unit.function_lits])
+      c_code = fo_compiler.code_gen(program, program_context, function_names)
+      _write_cached_unit(cache_dir, unit.fingerprint, c_code)
+      c_units[name] = c_code
+
+  paths = [_write_if_changed(out_dir, d.name + '.c', c_units[d.name])
+           for d in ast.function_decls]
+  return paths, dirty
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Compiles a Fo program into one C file per function, '
+      'reusing the cached functions that did not change.')
+  parser.add_argument('file', help='Fo source file')
+  parser.add_argument('-o', '--out-dir', default=None,
+                      help='directory of the generated C files, next to the '
+                      'source if not given')
+  parser.add_argument('--cache-dir', default=None,
+                      help='directory of the cached units, {} if not '
+                      'given'.format(get_cache_dir() or 'none'))
+  args = parser.parse_args()
+
+  out_dir = args.out_dir or os.path.dirname(os.path.abspath(args.file))
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+  with open(args.file) as f:
+    source = f.read()
+  paths, compiled = compile_units(source, out_dir, cache_dir=args.cache_dir)
+  for path in paths:
+    print(path)
+  print('{} of {} functions compiled'.format(len(compiled), len(paths)),
+        file=sys.stderr)
@@ -5,6 +5,8 @@ from contextlib import contextmanager
 import ply.lex as lex
 from ply.lex import TOKEN
 
+import fo_table_cache
+
 
 class LexingError(Exception):
   pass
@@ -106,7 +108,10 @@ def FoLexer(**kwargs):
   def token(self):
     return self._lexer.token()
 
-  return lex.lex(**kwargs)
+  signature = fo_table_cache.grammar_signature(locals(), 't_', tokens)
+  with fo_table_cache.lexer_tables(signature, kwargs) as tables:
+    tables.lexer = lex.lex(**tables.kwargs)
+    return tables.lexer
 
 
 def fo_lexer(source_code, **kwargs):
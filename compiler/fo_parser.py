@@ -2,6 +2,7 @@ from __future__ import print_function
 import ply.yacc as yacc
 
 import fo_lexer
+import fo_table_cache
 from fo_ast import *
 from fo_types import *
 
@@ -387,11 +388,18 @@ def FoParser(**kwargs):
       self._yacc = yacc
 
     def parse(self, source, lexer=None):
-      lexer = lexer or fo_lexer.FoLexer()
+      if lexer is None:
+        lexer = fo_lexer.FoLexer()
+      else:
+        # |lexer| may be reused across sources.
+        lexer.lineno = 1
       ast = self._yacc.parse(input=source, lexer=lexer)
       return ast
 
-  return ParserImpl(yacc.yacc(**kwargs))
+  signature = fo_table_cache.grammar_signature(
+      locals(), 'p_', tokens, precedence)
+  with fo_table_cache.parser_tables(signature, kwargs) as yacc_kwargs:
+    return ParserImpl(yacc.yacc(**yacc_kwargs))
 
 if __name__ == '__main__':
   test_data = '''
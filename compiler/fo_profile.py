@@ -0,0 +1,83 @@
+'''Execution profiles of Fo programs, for profile-guided optimization.
+
+A program compiled with --instrument counts, at run time:
+  - the calls of every function, under the function name,
+  - the executions of every call site, under "<function>#<n>", the n-th
+    call of the function, numbered before any optimization,
+  - for the calls through closures, the calls of every function the closure
+    may hold, under "<function>#<n>><target>".
+The counts are written to a profile file (see runtime/profile.h), which is
+given back to the compiler with --profile-use. Fo names never contain '#' or
+'>'.
+'''
+
+# A function or call site is hot if it runs at least this fraction of the
+# most run one.
+_HOT_FRACTION = 0.01
+# A target of a call through closures is the likely one if it gets at least
+# this fraction of the calls.
+_LIKELY_TARGET_FRACTION = 0.9
+
+
+def function_key(func_name):
+  return func_name
+
+
+def site_key(func_name, n):
+  return '{}#{}'.format(func_name, n)
+
+
+def target_key(site, target_name):
+  return '{}>{}'.format(site, target_name)
+
+
+class Profile(object):
+
+  def __init__(self, counts):
+    # key -> count
+    self._counts = counts
+    self._max_count = max(counts.values()) if counts else 0
+    # call site -> [(target, count), ...]
+    self._targets = {}
+    for key, count in counts.items():
+      site, sep, target = key.partition('>')
+      if sep:
+        self._targets.setdefault(site, []).append((target, count))
+
+  def count(self, key):
+    # None if |key| is not in the profile, as for code added since.
+    return self._counts.get(key)
+
+  def is_hot(self, key):
+    count = self._counts.get(key)
+    return bool(count) and count >= self._max_count * _HOT_FRACTION
+
+  def is_cold(self, key):
+    # Profiled, and never run.
+    return self._counts.get(key) == 0
+
+  def likely_target(self, site):
+    # The function that nearly all the calls at |site| called, or None.
+    total = self._counts.get(site)
+    if not total:
+      return None
+    for target, count in sorted(self._targets.get(site, ())):
+      if count >= total * _LIKELY_TARGET_FRACTION:
+        return target
+    return None
+
+
+def load_profile(paths):
+  '''Loads the profile files at |paths|, from runs of the same program, and
+  sums their counts.
+  '''
+  counts = {}
+  for path in paths:
+    with open(path) as f:
+      for line in f:
+        line = line.strip()
+        if not line:
+          continue
+        key, count = line.rsplit(' ', 1)
+        counts[key] = counts.get(key, 0) + int(count)
+  return Profile(counts)
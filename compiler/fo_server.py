@@ -0,0 +1,145 @@
+'''Long-lived Fo compile server.
+
+The parser, the lexer and the type singletons are built once and stay resident
+across requests, so that editor and build integrations do not pay the compiler
+start-up cost for every file.
+
+Requests and responses are JSON objects, one per line:
+
+  request:  {"source": "<Fo source>"}
+  response: {"ok": true, "source_hash": "...", "cache_hit": false,
+             "c_code": "...", "timings": {"parse": 0.001, ...}}
+            {"ok": false, "source_hash": "...", "error": "..."}
+
+They are exchanged over stdin/stdout, or over a Unix socket with --socket.
+'''
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import sys
+from collections import OrderedDict
+
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+
+import fo_compiler
+import fo_lexer
+import fo_parser
+
+
+def _source_hash(source):
+  # On Python 2 |source| is already a byte string.
+  data = source if isinstance(source, bytes) else source.encode('utf-8')
+  return hashlib.sha1(data).hexdigest()
+
+
+class CompileServer(object):
+
+  def __init__(self, cache_size=256):
+    self._parser = fo_parser.FoParser()
+    self._lexer = fo_lexer.FoLexer()
+    self._cache_size = cache_size
+    # source hash -> C code, in least recently used order
+    self._cache = OrderedDict()
+
+  def compile(self, source):
+    if not isinstance(source, str):
+      # JSON strings are unicode on Python 2.
+      source = source.encode('utf-8')
+    source_hash = _source_hash(source)
+
+    c_code = self._cache.pop(source_hash, None)
+    if c_code is not None:
+      self._cache[source_hash] = c_code
+      return OrderedDict([
+          ('ok', True),
+          ('source_hash', source_hash),
+          ('cache_hit', True),
+          ('c_code', c_code),
+          ('timings', OrderedDict()),
+      ])
+
+    timings = OrderedDict()
+    try:
+      c_code = fo_compiler.compile_source(
+          source, parser=self._parser, lexer=self._lexer, timings=timings)
+    except Exception as e:
+      return OrderedDict([
+          ('ok', False),
+          ('source_hash', source_hash),
+          ('error', '{}: {}'.format(type(e).__name__, e)),
+      ])
+
+    self._cache[source_hash] = c_code
+    if len(self._cache) > self._cache_size:
+      self._cache.popitem(last=False)
+    return OrderedDict([
+        ('ok', True),
+        ('source_hash', source_hash),
+        ('cache_hit', False),
+        ('c_code', c_code),
+        ('timings', timings),
+    ])
+
+  def handle_line(self, line):
+    try:
+      request = json.loads(line)
+      source = request['source']
+    except (ValueError, KeyError, TypeError) as e:
+      response = OrderedDict([
+          ('ok', False),
+          ('error', 'Bad request: {}'.format(e)),
+      ])
+    else:
+      response = self.compile(source)
+    return json.dumps(response)
+
+  def serve_stream(self, infile, outfile):
+    for line in iter(infile.readline, ''):
+      if not line.strip():
+        continue
+      outfile.write(self.handle_line(line) + '\n')
+      outfile.flush()
+
+  def serve_unix_socket(self, path):
+    server = self
+
+    class Handler(socketserver.StreamRequestHandler):
+
+      def handle(self):
+        for line in iter(self.rfile.readline, b''):
+          if not line.strip():
+            continue
+          response = server.handle_line(line.decode('utf-8')) + '\n'
+          self.wfile.write(response.encode('utf-8'))
+          self.wfile.flush()
+
+    if os.path.exists(path):
+      os.remove(path)
+    # Requests are served one at a time, the resident parser is not
+    # re-entrant.
+    unix_server = socketserver.UnixStreamServer(path, Handler)
+    try:
+      unix_server.serve_forever()
+    finally:
+      unix_server.server_close()
+      os.remove(path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Fo compile server.')
+  parser.add_argument('--socket', help='serve on this Unix socket path '
+                      'instead of stdin/stdout')
+  parser.add_argument('--cache-size', type=int, default=256,
+                      help='number of compiled sources to keep')
+  args = parser.parse_args()
+
+  server = CompileServer(cache_size=args.cache_size)
+  if args.socket:
+    server.serve_unix_socket(args.socket)
+  else:
+    server.serve_stream(sys.stdin, sys.stdout)
@@ -0,0 +1,172 @@
+'''On-disk cache of the PLY lexer and parser tables.
+
+The tables are keyed by a signature of the grammar (the rule docstrings and
+regexes, in definition order), the token list, the PLY version and
+|TABLE_CACHE_VERSION|. A table is generated once, and later processes load it
+with PLY's optimize mode on, which skips the grammar validation.
+
+The cache lives in $FO_TABLE_CACHE_DIR, or ~/.cache/fo if it is not set.
+Setting FO_TABLE_CACHE_DIR to an empty string disables the cache.
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import types
+from contextlib import contextmanager
+
+import ply
+
+# Bump this whenever the way tables are generated changes.
+TABLE_CACHE_VERSION = 1
+
+_CACHE_DIR_ENV = 'FO_TABLE_CACHE_DIR'
+
+# lextab module name -> loaded module, so that every FoLexer() in a process
+# does not re-read the same file.
+_loaded_lextabs = {}
+
+
+def get_cache_dir():
+  cache_dir = os.environ.get(_CACHE_DIR_ENV)
+  if cache_dir is None:
+    cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'fo')
+  return cache_dir
+
+
+def grammar_signature(namespace, prefix, tokens, precedence=()):
+  '''Hashes the rules in |namespace| whose names start with |prefix|.
+
+  Function rules are hashed in definition order, because PLY uses that order
+  both for the lexer master regex and for the grammar productions.
+  '''
+  funcs = []
+  strs = []
+  for name, rule in namespace.items():
+    if not name.startswith(prefix):
+      continue
+    if isinstance(rule, types.FunctionType):
+      funcs.append(rule)
+    elif isinstance(rule, str):
+      strs.append((name, rule))
+  funcs.sort(key=lambda f: f.__code__.co_firstlineno)
+  strs.sort()
+
+  parts = [str(TABLE_CACHE_VERSION), ply.__version__]
+  # The token list is partly built from a set, its order is not stable
+  # across processes.
+  parts.extend(sorted(tokens))
+  parts.extend(repr(p) for p in precedence)
+  for f in funcs:
+    parts.append(f.__name__)
+    parts.append(f.__doc__ or '')
+  for name, rule in strs:
+    parts.append(name)
+    parts.append(rule)
+
+  h = hashlib.sha1()
+  h.update('\0'.join(parts).encode('utf-8'))
+  return h.hexdigest()
+
+
+def _ensure_cache_dir():
+  cache_dir = get_cache_dir()
+  if not cache_dir:
+    return None
+  try:
+    os.makedirs(cache_dir)
+  except OSError:
+    if not os.path.isdir(cache_dir):
+      return None
+  return cache_dir
+
+
+def _load_module(name, path):
+  module = types.ModuleType(name)
+  module.__file__ = path
+  with open(path) as f:
+    code = compile(f.read(), path, 'exec')
+  exec(code, module.__dict__)
+  return module
+
+
+class LexerTables(object):
+  # What |lexer_tables| yields: the kwargs to pass to lex.lex(), and the
+  # lexer the caller builds with them.
+
+  def __init__(self, kwargs):
+    self.kwargs = kwargs
+    self.lexer = None
+
+
+@contextmanager
+def lexer_tables(signature, kwargs):
+  '''Yields a LexerTables, whose |lexer| the caller must set.
+
+  If |kwargs| is not empty, the caller chose its own table policy and the
+  cache is bypassed.
+  '''
+  cache_dir = None if kwargs else _ensure_cache_dir()
+  if cache_dir is None:
+    yield LexerTables(kwargs)
+    return
+
+  name = 'fo_lextab_{}'.format(signature)
+  path = os.path.join(cache_dir, name + '.py')
+  module = _loaded_lextabs.get(name)
+  if module is None and os.path.exists(path):
+    try:
+      module = _load_module(name, path)
+      _loaded_lextabs[name] = module
+    except (IOError, SyntaxError):
+      module = None
+  if module is not None:
+    yield LexerTables(dict(optimize=1, lextab=module))
+    return
+
+  # A fresh table is built with the validation of the rules. PLY only writes
+  # the tables in optimize mode, so it is written here.
+  tables = LexerTables({})
+  yield tables
+  if tables.lexer is None:
+    return
+  # Writes into a private directory first, so that concurrent compiler
+  # processes never see a partially written table.
+  tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+  try:
+    tables.lexer.writetab(name, tmp_dir)
+    os.rename(os.path.join(tmp_dir, name + '.py'), path)
+  except (IOError, OSError):
+    # The cache is only an optimization.
+    pass
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@contextmanager
+def parser_tables(signature, kwargs):
+  '''Yields the kwargs to pass to yacc.yacc().
+
+  If |kwargs| is not empty, the caller chose its own table policy and the
+  cache is bypassed.
+  '''
+  cache_dir = None if kwargs else _ensure_cache_dir()
+  if cache_dir is None:
+    yield kwargs
+    return
+
+  path = os.path.join(cache_dir, 'fo_parsetab_{}.pickle'.format(signature))
+  if os.path.exists(path):
+    yield dict(optimize=1, picklefile=path, debug=False)
+    return
+
+  fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.pickle')
+  os.close(fd)
+  os.remove(tmp_path)
+  try:
+    yield dict(picklefile=tmp_path, debug=False)
+    if os.path.exists(tmp_path):
+      os.rename(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
@@ -2,28 +2,47 @@ from __future__ import print_function
 
 
 class NodeType(object):
+  '''A Fo type.
+
+  Types are interned: structurally equal types are the same object, so
+  equality is an identity check and types can be used as dict keys. Use the
+  make_*_type() functions below instead of building NodeTypes directly.
+  '''
+  __slots__ = ('_type',)
 
   def __init__(self, t):
     self._type = t
 
-  def __eq__(self, other):
-    try:
-      return self._type == other._type
-    except:
-      print('self: {}, other: {}'.format(str(self), str(other)))
-      raise
-
-  def __ne__(self, other):
-    return self._type != other._type
+  # Interning makes the identity based __eq__ and __hash__ of object the
+  # right ones. Copies must not create new instances.
+  def __reduce__(self):
+    return (_intern, (self._type,))
 
   @property
   def type(self):
     return self._type
 
   def __str__(self):
+    if is_func_type(self):
+      _, param_types, ret_type = self._type
+      return 'func({}) {}'.format(
+          ', '.join(str(t) for t in param_types), ret_type)
     return str(self._type)
 
 
+# type key -> NodeType. A key is the type name for a named type, and
+# (_FUNC, param types tuple, return type) for a function type. As the nested
+# types are interned too, hashing a key never recurses into them.
+_interned_types = {}
+
+
+def _intern(t):
+  try:
+    return _interned_types[t]
+  except KeyError:
+    return _interned_types.setdefault(t, NodeType(t))
+
+
 class TypeAlias(object):
 
   def __init__(self, alias, t):
@@ -33,11 +52,12 @@ class TypeAlias(object):
     self._type = t
 
 _FUNC = 'func'
-_void_type = NodeType('void')
-_bool_type = NodeType('bool')
-_int_type = NodeType('int64_t')
-_float_type = NodeType('double')
-_placeholder_type = NodeType('__placeholder__')
+_void_type = _intern('void')
+_bool_type = _intern('bool')
+_int_type = _intern('int64_t')
+_float_type = _intern('double')
+_placeholder_type = _intern('__placeholder__')
+_primitive_types = frozenset([_void_type, _bool_type, _int_type, _float_type])
 
 
 class TypeMismatchError(Exception):
@@ -45,27 +65,23 @@ class TypeMismatchError(Exception):
 
 
 def is_primitive_type(t):
-  for it in [_void_type, _bool_type, _int_type, _float_type]:
-    if t == it:
-      return True
-  return False
+  return t in _primitive_types
 
 
 def make_type(type_name):
   if type_name == 'int':
     return _int_type
-  return NodeType(type_name)
+  if type_name == 'float':
+    return _float_type
+  return _intern(type_name)
 
 
 def make_func_type(param_types, ret_type):
-  return NodeType((_FUNC, param_types, ret_type))
+  return _intern((_FUNC, tuple(param_types), ret_type))
 
 
 def is_func_type(t):
-  try:
-    return t.type[0] == _FUNC
-  except:
-    return False
+  return isinstance(t, NodeType) and isinstance(t.type, tuple)
 
 
 def get_func_param_types(t):
@@ -86,7 +102,7 @@ def make_placeholder_type():
 
 
 def is_placeholder_type(t):
-  return t == _placeholder_type
+  return t is _placeholder_type
 
 
 def make_void_type():
@@ -78,3 +78,49 @@ class ScopedEnv(object):
       yield
     finally:
       self._pop()
+
+
+class FlatScopedEnv(ScopedEnv):
+  '''A ScopedEnv with O(1) lookups.
+
+  Every key maps to the stack of the nodes binding it, innermost last, and
+  every scope keeps an undo log of the keys bound in it, which are unbound
+  when the scope is popped. Lookups never walk the scope chain, whatever its
+  depth.
+
+  Bindings must be added through |put|, the ones put on a node directly are
+  not seen. The parent links are still set, for the users walking the chain.
+  '''
+
+  def __init__(self, top=None):
+    super(FlatScopedEnv, self).__init__()
+    # key -> nodes binding it, innermost last
+    self._bindings = {}
+    # One list of the keys bound in the scope, per scope.
+    self._undo_logs = []
+    if top is not None:
+      self._push(top)
+
+  def contains(self, key):
+    return key in self._bindings
+
+  def get_node(self, key):
+    nodes = self._bindings.get(key)
+    return nodes[-1] if nodes else None
+
+  def put(self, key, value):
+    self._top.put(key, value)
+    self._bindings.setdefault(key, []).append(self._top)
+    self._undo_logs[-1].append(key)
+
+  def _push(self, node):
+    super(FlatScopedEnv, self)._push(node)
+    self._undo_logs.append([])
+
+  def _pop(self):
+    for key in self._undo_logs.pop():
+      nodes = self._bindings[key]
+      nodes.pop()
+      if not nodes:
+        del self._bindings[key]
+    super(FlatScopedEnv, self)._pop()
@@ -2,29 +2,65 @@ from contextlib import contextmanager
 
 
 class SourceCodeBuilder(object):
+  '''Builds source code line by line.
 
-  def __init__(self):
+  The fragments of a line are kept in a list and only joined when the line
+  is done, so appending is O(1) however long the line gets. If |sink| is
+  given, every finished line is written to it right away, with write(), and
+  the builder only holds the current line.
+  '''
+
+  def __init__(self, sink=None):
+    self._sink = sink
+    # indent level -> indent string
+    self._indents = {}
     self.reset()
 
   @property
   def cur_line_length(self):
-    return len(self._lines[-1])
+    return self._line_length
 
   def reset(self):
     self._indent_lv = 0
+    # The finished lines, when there is no sink.
     self._lines = []
-    self.new_line()
+    self._line = []
+    self._line_length = 0
+    self._is_first_line = True
+    self._start_line()
+
+  def _start_line(self):
+    indent = self._make_indent()
+    self._line = [indent]
+    self._line_length = len(indent)
+
+  def _finish_line(self):
+    line = ''.join(self._line)
+    if self._sink is None:
+      self._lines.append(line)
+    else:
+      if not self._is_first_line:
+        self._sink.write('\n')
+      self._sink.write(line)
+    self._is_first_line = False
 
   def new_line(self):
-    self._lines.append(self._make_indent())
+    self._finish_line()
+    self._start_line()
 
   def append(self, s, append_whitespace=True):
-    ws = ' ' if append_whitespace else ''
-    self._lines[-1] = '{}{}{}'.format(self._lines[-1], s, ws)
+    # |s| can be any value, e.g. a type.
+    s = str(s)
+    self._line.append(s)
+    self._line_length += len(s)
+    if append_whitespace:
+      self._line.append(' ')
+      self._line_length += 1
 
   def clear_indent(self):
-    assert self._lines[-1] == self._make_indent()
-    self._lines[-1] = ''
+    assert len(self._line) == 1 and self._line[0] == self._make_indent()
+    self._line = []
+    self._line_length = 0
 
   @contextmanager
   def indent(self, sz=2):
@@ -35,8 +71,17 @@ class SourceCodeBuilder(object):
       self._indent_lv -= sz
 
   def build(self):
-    result = '\n'.join(self._lines)
-    return result
+    '''Returns the code. With a sink, writes the current line to it instead
+    and returns None; nothing can be appended afterwards.
+    '''
+    if self._sink is not None:
+      self._finish_line()
+      self._line = []
+      return None
+    return '\n'.join(self._lines + [''.join(self._line)])
 
   def _make_indent(self):
-    return ''.join([' '] * self._indent_lv)
+    try:
+      return self._indents[self._indent_lv]
+    except KeyError:
+      return self._indents.setdefault(self._indent_lv, ' ' * self._indent_lv)
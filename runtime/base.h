@@ -17,6 +17,28 @@ void die(const char* format, ...);
 
 void print_stack();
 
+// Guarantees that a call in return position reuses the stack frame of the
+// caller. Only valid when the caller and the callee have the same signature.
+#if defined(__has_attribute)
+#if __has_attribute(musttail)
+#define FO_MUSTTAIL __attribute__((musttail))
+#endif
+#endif
+#ifndef FO_MUSTTAIL
+#define FO_MUSTTAIL
+#endif
+
+// Hints from the profile of the program, see --profile-use.
+#if defined(__GNUC__)
+#define FO_HOT __attribute__((hot))
+#define FO_COLD __attribute__((cold))
+#define FO_LIKELY(b) __builtin_expect(!!(b), 1)
+#else
+#define FO_HOT
+#define FO_COLD
+#define FO_LIKELY(b) (b)
+#endif
+
 #define LOG(...) printf(__VA_ARGS__)
 #define ERRLOG(...) fprintf(stderr, __VA_ARGS__)
 
@@ -2,6 +2,7 @@
 
 #include <string.h>
 #include "runtime/memory.h"
+#include "runtime/profile.h"
 
 // Runtime memory
 
@@ -15,23 +16,46 @@ static intptr_t runtime_reserved_cur_;
 static size_t per_stack_size_;
 static intptr_t stacks_seg_begin_;
 
+static size_t nursery_size_;
+static intptr_t nursery_seg_begin_;
+static intptr_t nursery_cur_;
+static intptr_t nursery_end_;
+
+static char* heap_raw_begin_;
 static size_t per_heap_size_;
-static intptr_t heap_seg_begin_;
 static intptr_t from_heap_seg_begin_;
 static intptr_t to_heap_seg_begin_;
 
 static intptr_t heap_cur_;
 static intptr_t heap_end_;
 
+static char* alloc_semispaces(size_t heap_size) {
+  return (char*)malloc(heap_size * 2 + sizeof(val_t));
+}
+
+static void set_semispaces(char* raw_begin, size_t heap_size) {
+  heap_raw_begin_ = raw_begin;
+  per_heap_size_ = heap_size;
+  from_heap_seg_begin_ = roundup_aligned((intptr_t)raw_begin);
+  to_heap_seg_begin_ = from_heap_seg_begin_ + per_heap_size_;
+  heap_cur_ = from_heap_seg_begin_;
+  heap_end_ = from_heap_seg_begin_ + per_heap_size_;
+}
+
 void init_memory(size_t runtime_reserved_size, size_t stack_size,
-                 int num_stacks, size_t heap_size) {
+                 int num_stacks, size_t heap_size, size_t nursery_size) {
   runtime_reserved_size_ = roundup_aligned(runtime_reserved_size);
   per_stack_size_ = roundup_aligned(stack_size);
   per_heap_size_ = roundup_aligned(heap_size);
+  nursery_size_ = roundup_aligned(nursery_size);
 
   size_t size = runtime_reserved_size_ + per_stack_size_ * num_stacks +
-                heap_size * 2 + sizeof(val_t);
+                nursery_size_ + sizeof(val_t);
   memory_raw_begin_ = (char*)malloc(size);
+  heap_raw_begin_ = alloc_semispaces(per_heap_size_);
+  if (memory_raw_begin_ == NULL || heap_raw_begin_ == NULL) {
+    die("Cannot allocate the runtime memory.");
+  }
   memory_begin_ = roundup_aligned((intptr_t)memory_raw_begin_);
 
   runtime_reserved_seg_begin_ = memory_begin_;
@@ -39,18 +63,26 @@ void init_memory(size_t runtime_reserved_size, size_t stack_size,
 
   stacks_seg_begin_ = runtime_reserved_seg_begin_ + runtime_reserved_size_;
 
-  heap_seg_begin_ = stacks_seg_begin_ + per_stack_size_ * num_stacks;
-  from_heap_seg_begin_ = heap_seg_begin_;
-  to_heap_seg_begin_ = heap_seg_begin_ + per_heap_size_;
-  heap_cur_ = from_heap_seg_begin_;
-  heap_end_ = from_heap_seg_begin_ + per_heap_size_;
+  nursery_seg_begin_ = stacks_seg_begin_ + per_stack_size_ * num_stacks;
+  nursery_end_ = nursery_seg_begin_ + nursery_size_;
+  nursery_cur_ = nursery_seg_begin_;
+
+  set_semispaces(heap_raw_begin_, per_heap_size_);
 }
 
-void free_memory() { free(memory_raw_begin_); }
+static void free_gc_header_chunks();
+
+void free_memory() {
+  // The profile counters are in the runtime reserved segment.
+  dump_profile();
+  free_gc_header_chunks();
+  free(memory_raw_begin_);
+  free(heap_raw_begin_);
+}
 
 char* stack_top(int stack_i) {
   intptr_t result = stacks_seg_begin_ + per_stack_size_ * (stack_i + 1);
-  DCHECK(result <= heap_seg_begin_);
+  DCHECK(result <= nursery_seg_begin_);
   return (char*)result;
 }
 
@@ -84,23 +116,138 @@ char* alloc_heap(size_t size) {
   return (char*)result;
 }
 
-size_t heap_usage() { return heap_cur_ - from_heap_seg_begin_; }
+char* alloc_nursery(size_t size) {
+  size = roundup_aligned(size);
+  intptr_t result = nursery_cur_;
+  intptr_t next = result + size;
+  if (next > nursery_end_) {
+    return NULL;
+  }
+
+  nursery_cur_ = next;
+  return (char*)result;
+}
+
+void reset_nursery() { nursery_cur_ = nursery_seg_begin_; }
+
+bool is_in_nursery(const void* p) {
+  return (nursery_seg_begin_ <= (intptr_t)p) && ((intptr_t)p < nursery_end_);
+}
+
+// Whether |p| is in the semispace the objects are allocated in.
+static inline bool is_in_semispace(const void* p) {
+  return (from_heap_seg_begin_ <= (intptr_t)p) && ((intptr_t)p < heap_end_);
+}
+
+size_t heap_usage() {
+  return (heap_cur_ - from_heap_seg_begin_) + nursery_usage();
+}
+
+size_t nursery_usage() { return nursery_cur_ - nursery_seg_begin_; }
 
 // GC
+//
+// New objects are allocated in the nursery, and stay young until the next
+// collection. A minor collection, run_minor_gc(), only looks at the young
+// objects: it frees the young garbage cycles, and moves the survivors out of
+// the nursery into the semispace, where they are old. A major collection,
+// run_gc(), looks at all the objects and compacts them into the other
+// semispace.
+//
+// The old objects pointing to young ones are recorded by gc_write_barrier()
+// in the remembered set. A minor collection treats them as roots: the young
+// objects they point to are live, even if the old objects are part of a
+// garbage cycle that only a major collection can find.
+//
+// The collections run when an allocation runs out of headers or memory.
+// If the objects still occupy more than the occupancy target afterwards,
+// the header pool or the semispaces grow by the growth factor, see
+// set_gc_growth_policy().
 
 static const int32_t NONTRIVIAL_ROOT_MASK = (1 << 31);
 static const int32_t MARKED_AS_UNREACHABLE = (1 << 30);
 static const int32_t MAX_REF_COUNT = (1 << 28);
 static const int32_t REF_COUNT_MASK = (MAX_REF_COUNT - 1);
+// Set on the old objects in the remembered set.
+static const int32_t REMEMBERED_MASK = (1 << 28);
+// (1 << 29) is GC_STATIC_OBJ_MASK, see gc_header.h.
 
-// An array containing |num_gc_headers_|
-static size_t num_gc_headers_;
-static gc_header_t* all_gc_headers;
+static double growth_factor_ = DEFAULT_GC_GROWTH_FACTOR;
+static double occupancy_target_ = DEFAULT_GC_OCCUPANCY_TARGET;
+
+// The headers in use, or the objects with FO_INLINE_GC_HEADER.
 static size_t num_gc_headers_in_use_;
 
-static gc_header_t* gc_free;
 static gc_header_t* trivial_gc_roots;
 static gc_header_t* nontrivial_gc_roots;
+static gc_header_t* young_trivial_gc_roots;
+static gc_header_t* young_nontrivial_gc_roots;
+
+// The remembered set. It can hold stale entries, of the objects freed since
+// they were added, and duplicates: only the entries of the objects with
+// REMEMBERED_MASK set count, once.
+static gc_header_t** remembered_set_ = NULL;
+static size_t remembered_set_size_ = 0;
+static size_t remembered_set_capacity_ = 0;
+
+// The variables registered with gc_push_root().
+static gc_header_t*** roots_ = NULL;
+static size_t num_roots_ = 0;
+static size_t roots_capacity_ = 0;
+
+// The objects referenced from outside the collected ones, where the copy
+// starts, see move_survivors().
+static gc_header_t** scan_roots_ = NULL;
+static size_t num_scan_roots_ = 0;
+static size_t scan_roots_capacity_ = 0;
+
+// The objects moved by the running copy, in order.
+static gc_header_t* moved_trivial_;
+static gc_header_t* moved_trivial_tail_;
+static gc_header_t* moved_nontrivial_;
+static gc_header_t* moved_nontrivial_tail_;
+// The next moved nontrivial object whose pointers are to be moved.
+static gc_header_t* next_to_scan_;
+
+// Whether a minor collection is running. It only collects young objects.
+static bool minor_gc_running_ = false;
+
+static inline bool is_static_obj(const gc_header_t* g) {
+  return ((g->meta_ref_count & GC_STATIC_OBJ_MASK) == GC_STATIC_OBJ_MASK);
+}
+
+static inline bool is_nontrivial_gc(const gc_header_t* g) {
+  return ((g->meta_ref_count & NONTRIVIAL_ROOT_MASK) == NONTRIVIAL_ROOT_MASK);
+}
+
+static inline bool is_marked_unreachable(const gc_header_t* g) {
+  return ((g->meta_ref_count & MARKED_AS_UNREACHABLE) == MARKED_AS_UNREACHABLE);
+}
+
+static inline bool is_remembered(const gc_header_t* g) {
+  return ((g->meta_ref_count & REMEMBERED_MASK) == REMEMBERED_MASK);
+}
+
+static inline int32_t get_shadow_ref_count(const gc_header_t* g) {
+  return (g->meta_ref_count & REF_COUNT_MASK);
+}
+
+static inline bool is_young(const gc_header_t* g) {
+  return is_in_nursery(g->obj);
+}
+
+// Whether the running collection can free |g|.
+static inline bool is_collected(const gc_header_t* g) {
+  return is_nontrivial_gc(g) && (!minor_gc_running_ || is_young(g));
+}
+
+static gc_header_t** gc_roots_of(const gc_header_t* g) {
+  if (is_young(g)) {
+    return is_nontrivial_gc(g) ? &young_nontrivial_gc_roots
+                               : &young_trivial_gc_roots;
+  }
+  return is_nontrivial_gc(g) ? &nontrivial_gc_roots : &trivial_gc_roots;
+}
 
 static void gc_add_to_list(gc_header_t** list, gc_header_t* g) {
   gc_header_t* head = *list;
@@ -114,6 +261,19 @@ static void gc_add_to_list(gc_header_t** list, gc_header_t* g) {
   *list = g;
 }
 
+// Appends |g| to |*list|, whose last object is |*tail|.
+static void gc_append_to_list(gc_header_t** list, gc_header_t** tail,
+                              gc_header_t* g) {
+  g->prev = *tail;
+  g->next = NULL;
+  if (*tail != NULL) {
+    (*tail)->next = g;
+  } else {
+    *list = g;
+  }
+  *tail = g;
+}
+
 static void gc_remove_from_list(gc_header_t** list, gc_header_t* g) {
   if (g->prev) {
     g->prev->next = g->next;
@@ -128,21 +288,233 @@ static void gc_remove_from_list(gc_header_t** list, gc_header_t* g) {
   g->next = NULL;
 }
 
+// Prepends the list |from| to |to|.
+static void gc_move_list(gc_header_t** from, gc_header_t** to) {
+  gc_header_t* tail = *from;
+  if (tail == NULL) {
+    return;
+  }
+  while (tail->next != NULL) {
+    tail = tail->next;
+  }
+  tail->next = *to;
+  if (*to != NULL) {
+    (*to)->prev = tail;
+  }
+  *to = *from;
+  *from = NULL;
+}
+
+void set_gc_growth_policy(double growth_factor, double occupancy_target) {
+  CHECK(growth_factor > 1);
+  CHECK((0 < occupancy_target) && (occupancy_target <= 1));
+  growth_factor_ = growth_factor;
+  occupancy_target_ = occupancy_target;
+}
+
+#ifndef FO_INLINE_GC_HEADER
+// The headers are allocated in chunks of GC_HEADER_CHUNK_SIZE bytes,
+// aligned on their size, so that the chunk of a header is found by masking
+// its address. Every chunk has a free list of its own. The pool grows by
+// whole chunks. The empty chunks are released at the end of the
+// collections, when the remembered set cannot point into them anymore, as
+// long as the pool stays below the occupancy target.
+//
+// The size is large enough for malloc to map every chunk on its own, and
+// give it back to the OS when it is freed.
+#define GC_HEADER_CHUNK_SIZE (256 * 1024)
+
+typedef struct gc_header_chunk {
+  // All the chunks.
+  struct gc_header_chunk* next;
+  // The chunks with free headers.
+  struct gc_header_chunk* next_available;
+  gc_header_t* free;
+  size_t num_free;
+  gc_header_t headers[];
+} gc_header_chunk_t;
+
+#define GC_HEADERS_PER_CHUNK \
+  ((GC_HEADER_CHUNK_SIZE - sizeof(gc_header_chunk_t)) / sizeof(gc_header_t))
+
+static gc_header_chunk_t* gc_header_chunks_ = NULL;
+static gc_header_chunk_t* available_gc_header_chunks_ = NULL;
+static size_t num_gc_header_chunks_ = 0;
+// The pool never shrinks below the size given to init_gc().
+static size_t min_gc_headers_;
+static size_t num_gc_headers_;
+
+static inline gc_header_chunk_t* gc_header_chunk_of(gc_header_t* g) {
+  return (gc_header_chunk_t*)((intptr_t)g &
+                              ~(intptr_t)(GC_HEADER_CHUNK_SIZE - 1));
+}
+
+static bool add_gc_header_chunk() {
+  gc_header_chunk_t* chunk = (gc_header_chunk_t*)aligned_alloc(
+      GC_HEADER_CHUNK_SIZE, GC_HEADER_CHUNK_SIZE);
+  if (chunk == NULL) {
+    return false;
+  }
+  for (size_t i = 0; i < GC_HEADERS_PER_CHUNK; ++i) {
+    gc_header_t* g = &chunk->headers[i];
+    g->obj = NULL;
+    g->ref_count = 0;
+    g->meta_ref_count = 0;
+    g->obj_ops = NULL;
+    g->prev = NULL;
+    g->next = (g + 1);
+  }
+  chunk->headers[GC_HEADERS_PER_CHUNK - 1].next = NULL;
+  chunk->free = chunk->headers;
+  chunk->num_free = GC_HEADERS_PER_CHUNK;
+
+  chunk->next = gc_header_chunks_;
+  gc_header_chunks_ = chunk;
+  chunk->next_available = available_gc_header_chunks_;
+  available_gc_header_chunks_ = chunk;
+  ++num_gc_header_chunks_;
+  num_gc_headers_ += GC_HEADERS_PER_CHUNK;
+  return true;
+}
+
+static void grow_gc_headers() {
+  size_t target = (size_t)(num_gc_headers_ * growth_factor_);
+  do {
+    if (!add_gc_header_chunk()) {
+      return;
+    }
+  } while (num_gc_headers_ < target);
+}
+
+static void free_gc_header_chunks() {
+  while (gc_header_chunks_ != NULL) {
+    gc_header_chunk_t* next = gc_header_chunks_->next;
+    free(gc_header_chunks_);
+    gc_header_chunks_ = next;
+  }
+  available_gc_header_chunks_ = NULL;
+  num_gc_header_chunks_ = 0;
+  num_gc_headers_ = 0;
+}
+
+static bool can_release_gc_header_chunk() {
+  size_t n = num_gc_headers_ - GC_HEADERS_PER_CHUNK;
+  return (n >= min_gc_headers_) &&
+         (num_gc_headers_in_use_ < n * occupancy_target_);
+}
+
+// Frees the empty chunks the pool can do without, and rebuilds the list of
+// the available chunks.
+static void release_empty_gc_header_chunks() {
+  available_gc_header_chunks_ = NULL;
+  gc_header_chunk_t** p = &gc_header_chunks_;
+  while (*p != NULL) {
+    gc_header_chunk_t* chunk = *p;
+    if (chunk->num_free == GC_HEADERS_PER_CHUNK &&
+        can_release_gc_header_chunk()) {
+      *p = chunk->next;
+      free(chunk);
+      --num_gc_header_chunks_;
+      num_gc_headers_ -= GC_HEADERS_PER_CHUNK;
+      continue;
+    }
+    if (chunk->num_free > 0) {
+      chunk->next_available = available_gc_header_chunks_;
+      available_gc_header_chunks_ = chunk;
+    }
+    p = &chunk->next;
+  }
+}
+
+// Makes sure that a header is available, unless the pool cannot grow.
+static void reserve_gc_header() {
+  if (available_gc_header_chunks_ != NULL) {
+    return;
+  }
+  // The headers reference counting did not free are held by garbage cycles,
+  // most likely young ones.
+  run_minor_gc();
+  if (available_gc_header_chunks_ == NULL) {
+    run_gc();
+  }
+  if (num_gc_headers_in_use_ >= num_gc_headers_ * occupancy_target_) {
+    grow_gc_headers();
+  }
+}
+
+static gc_header_t* take_gc_header() {
+  gc_header_chunk_t* chunk = available_gc_header_chunks_;
+  gc_header_t* g = chunk->free;
+  chunk->free = g->next;
+  if (--chunk->num_free == 0) {
+    available_gc_header_chunks_ = chunk->next_available;
+  }
+  ++num_gc_headers_in_use_;
+  return g;
+}
+
+size_t num_gc_headers() { return num_gc_headers_; }
+
+size_t num_gc_header_chunks() { return num_gc_header_chunks_; }
+#else
+// The headers are part of the objects, there is no pool.
+static void release_empty_gc_header_chunks() {}
+
+static void free_gc_header_chunks() {}
+
+size_t num_gc_headers() { return num_gc_headers_in_use_; }
+
+size_t num_gc_header_chunks() { return 0; }
+#endif
+
+static void collect_all(size_t min_free);
+
+// Objects larger than this are allocated old, they would fill the nursery.
+static inline size_t max_young_obj_size() { return nursery_size_ / 4; }
+
+static val_t* alloc_obj(size_t size) {
+  val_t* o = NULL;
+  if (size <= max_young_obj_size()) {
+    o = (val_t*)alloc_nursery(size);
+    if (o == NULL) {
+      run_minor_gc();
+      o = (val_t*)alloc_nursery(size);
+    }
+    if (o != NULL) {
+      return o;
+    }
+  }
+  o = (val_t*)alloc_heap(size);
+  if (o == NULL) {
+    collect_all(size);
+    o = (val_t*)alloc_heap(size);
+  }
+  return o;
+}
+
 static gc_header_t* gc_alloc_common(size_t size, const obj_operators_t* ops) {
-  if (gc_free == NULL) {
+  size = roundup_aligned(size);
+#ifdef FO_INLINE_GC_HEADER
+  gc_header_t* g = (gc_header_t*)alloc_obj(sizeof(gc_header_t) + size);
+  if (g == NULL) {
     return NULL;
   }
-  size = roundup_aligned(size);
-  val_t* o = (val_t*)alloc_heap(size);
+  ++num_gc_headers_in_use_;
+#else
+  // Both can run the GC, the header is only taken once the memory is there.
+  reserve_gc_header();
+  if (available_gc_header_chunks_ == NULL) {
+    return NULL;
+  }
+  val_t* o = alloc_obj(size);
   if (o == NULL) {
     return NULL;
   }
-  gc_header_t* g = gc_free;
-  gc_free = gc_free->next;
-  ++num_gc_headers_in_use_;
-
-  memset((void*)o, 0, size);
+  gc_header_t* g = take_gc_header();
   g->obj = o;
+#endif
+
+  memset((void*)g->obj, 0, size);
   g->ref_count = 1;
   g->meta_ref_count = 0;
   g->obj_ops = ops;
@@ -162,7 +534,7 @@ gc_header_t* gc_alloc_trivial_ops(size_t size, const obj_operators_t* ops) {
   }
 
   g->meta_ref_count = 0;
-  gc_add_to_list(&trivial_gc_roots, g);
+  gc_add_to_list(gc_roots_of(g), g);
   return g;
 }
 
@@ -172,77 +544,111 @@ gc_header_t* gc_alloc_nontrivial(size_t size, const obj_operators_t* ops) {
     return NULL;
   }
   g->meta_ref_count = NONTRIVIAL_ROOT_MASK;
-  gc_add_to_list(&nontrivial_gc_roots, g);
+  gc_add_to_list(gc_roots_of(g), g);
   return g;
 }
 
-static inline bool is_nontrivial_gc(const gc_header_t* g) {
-  return ((g->meta_ref_count & NONTRIVIAL_ROOT_MASK) == NONTRIVIAL_ROOT_MASK);
+void gc_ref(gc_header_t* g) {
+  if (is_static_obj(g)) {
+    return;
+  }
+  g->ref_count += 1;
+  CHECK(g->ref_count < MAX_REF_COUNT);
 }
 
-static inline bool is_marked_unreachable(const gc_header_t* g) {
-  return ((g->meta_ref_count & MARKED_AS_UNREACHABLE) == MARKED_AS_UNREACHABLE);
+// Doubles the |*capacity| of |array|, of elements of |elem_size| bytes.
+static void* grow_array(void* array, size_t* capacity, size_t elem_size) {
+  size_t n = *capacity ? *capacity * 2 : 64;
+  array = realloc(array, elem_size * n);
+  if (array == NULL) {
+    die("Cannot allocate memory for GC.");
+  }
+  *capacity = n;
+  return array;
 }
 
-static inline int32_t get_shadow_ref_count(const gc_header_t* g) {
-  return (g->meta_ref_count & REF_COUNT_MASK);
+void gc_write_barrier(gc_header_t* g, gc_header_t* val) {
+  if (is_remembered(g) || is_static_obj(g) || is_young(g) || !is_young(val)) {
+    return;
+  }
+  if (remembered_set_size_ == remembered_set_capacity_) {
+    remembered_set_ = (gc_header_t**)grow_array(
+        remembered_set_, &remembered_set_capacity_, sizeof(gc_header_t*));
+  }
+  g->meta_ref_count |= REMEMBERED_MASK;
+  remembered_set_[remembered_set_size_++] = g;
 }
 
-void gc_ref(gc_header_t* g) {
-  g->ref_count += 1;
-  CHECK(g->ref_count < MAX_REF_COUNT);
+void gc_push_root(gc_header_t** root) {
+  if (num_roots_ == roots_capacity_) {
+    roots_ = (gc_header_t***)grow_array(roots_, &roots_capacity_,
+                                        sizeof(gc_header_t**));
+  }
+  roots_[num_roots_++] = root;
+}
+
+void gc_pop_roots(size_t n) {
+  CHECK(n <= num_roots_);
+  num_roots_ -= n;
 }
 
 static void gc_dealloc(gc_header_t* g) {
   CHECK(g->ref_count == 0);
 
-  g->obj = NULL;
   g->obj_ops = NULL;
   g->ref_count = 0;
+  // Also drops |g| from the remembered set.
   g->meta_ref_count = 0;
-  // Move back to free list
+#ifdef FO_INLINE_GC_HEADER
+  // The memory is reclaimed by the next copy.
   g->prev = NULL;
-  g->next = gc_free;
-  gc_free = g;
+  g->next = NULL;
+#else
+  g->obj = NULL;
+  // Move back to the free list of its chunk
+  gc_header_chunk_t* chunk = gc_header_chunk_of(g);
+  g->prev = NULL;
+  g->next = chunk->free;
+  chunk->free = g;
+  if (chunk->num_free++ == 0) {
+    chunk->next_available = available_gc_header_chunks_;
+    available_gc_header_chunks_ = chunk;
+  }
+#endif
   --num_gc_headers_in_use_;
 }
 
 void gc_unref(gc_header_t* g) {
+  if (is_static_obj(g)) {
+    return;
+  }
   CHECK(g->ref_count > 0);
   g->ref_count -= 1;
 
   if (g->ref_count == 0) {
-    if (is_nontrivial_gc(g)) {
-      gc_remove_from_list(&nontrivial_gc_roots, g);
-    } else {
-      gc_remove_from_list(&trivial_gc_roots, g);
-    }
+    gc_remove_from_list(gc_roots_of(g), g);
     g->obj_ops->gc_visitor(g->obj, gc_unref);
     gc_dealloc(g);
   }
 }
 
 void init_gc(size_t num_gc_headers) {
-  num_gc_headers_ = num_gc_headers;
-  all_gc_headers = (gc_header_t*)alloc_runtime_reserved(sizeof(gc_header_t) *
-                                                        num_gc_headers_);
-  if (all_gc_headers == NULL) {
-    die("Cannot allocate memory for GC.");
-  }
-  for (int i = 0; i < num_gc_headers_; ++i) {
-    gc_header_t* g = &all_gc_headers[i];
-    g->obj = NULL;
-    g->ref_count = 0;
-    g->meta_ref_count = 0;
-    g->obj_ops = NULL;
-    g->prev = NULL;
-    g->next = (g + 1);
+  free_gc_header_chunks();
+#ifndef FO_INLINE_GC_HEADER
+  min_gc_headers_ = num_gc_headers;
+  while (num_gc_headers_ < min_gc_headers_) {
+    if (!add_gc_header_chunk()) {
+      die("Cannot allocate memory for GC.");
+    }
   }
-  gc_free = all_gc_headers;
-  all_gc_headers[num_gc_headers_ - 1].next = NULL;
+#endif
 
   trivial_gc_roots = NULL;
   nontrivial_gc_roots = NULL;
+  young_trivial_gc_roots = NULL;
+  young_nontrivial_gc_roots = NULL;
+  remembered_set_size_ = 0;
+  num_roots_ = 0;
 
   num_gc_headers_in_use_ = 0;
 }
@@ -256,8 +662,23 @@ static void swap_heap_space() {
   heap_end_ = from_heap_seg_begin_ + per_heap_size_;
 }
 
-static void copy_refcount_to_shadow() {
-  gc_header_t* g = nontrivial_gc_roots;
+// Drops the stale entries and the duplicates from the remembered set, and
+// clears REMEMBERED_MASK on the remaining ones, so that the running
+// collection can forget them.
+static void take_remembered_set() {
+  size_t n = 0;
+  for (size_t i = 0; i < remembered_set_size_; ++i) {
+    gc_header_t* g = remembered_set_[i];
+    if (is_remembered(g)) {
+      g->meta_ref_count &= ~REMEMBERED_MASK;
+      remembered_set_[n++] = g;
+    }
+  }
+  remembered_set_size_ = n;
+}
+
+static void copy_refcount_to_shadow(gc_header_t* list) {
+  gc_header_t* g = list;
   for (; g != NULL; g = g->next) {
     int32_t ref_count = g->ref_count;
     CHECK(ref_count < MAX_REF_COUNT);
@@ -266,7 +687,7 @@ static void copy_refcount_to_shadow() {
 }
 
 static void visit_subtract_ref_count(gc_header_t* g) {
-  if (is_nontrivial_gc(g)) {
+  if (is_collected(g)) {
     int32_t shadow_ref_count = get_shadow_ref_count(g);
     CHECK(shadow_ref_count > 0);
     shadow_ref_count -= 1;
@@ -274,30 +695,47 @@ static void visit_subtract_ref_count(gc_header_t* g) {
   }
 }
 
-static void subtract_shadow_ref_count() {
-  gc_header_t* g = nontrivial_gc_roots;
+static void subtract_shadow_ref_count(gc_header_t* list) {
+  gc_header_t* g = list;
   for (; g != NULL; g = g->next) {
     g->obj_ops->gc_visitor(g->obj, visit_subtract_ref_count);
   }
 }
 
+// Records the objects of |list| that are still referenced once the
+// references among the collected objects are subtracted, from outside.
+static void record_scan_roots(gc_header_t* list) {
+  gc_header_t* g = list;
+  for (; g != NULL; g = g->next) {
+    if (get_shadow_ref_count(g) > 0) {
+      if (num_scan_roots_ == scan_roots_capacity_) {
+        scan_roots_ = (gc_header_t**)grow_array(
+            scan_roots_, &scan_roots_capacity_, sizeof(gc_header_t*));
+      }
+      scan_roots_[num_scan_roots_++] = g;
+    }
+  }
+}
+
 static void visit_recover_ref_count(gc_header_t* g) {
-  if (is_nontrivial_gc(g) && (get_shadow_ref_count(g) == 0)) {
+  if (is_collected(g) && (get_shadow_ref_count(g) == 0)) {
     // |g|'s shadow ref count is zero, bump it up.
     g->meta_ref_count = (NONTRIVIAL_ROOT_MASK | 1);
     g->obj_ops->gc_visitor(g->obj, visit_recover_ref_count);
   }
 }
 
-static void find_unreachable() {
-  gc_header_t* g = nontrivial_gc_roots;
+static void recover_reachable(gc_header_t* list) {
+  gc_header_t* g = list;
   for (; g != NULL; g = g->next) {
     if (get_shadow_ref_count(g) > 0) {
       g->obj_ops->gc_visitor(g->obj, visit_recover_ref_count);
     }
   }
+}
 
-  g = nontrivial_gc_roots;
+static void mark_unreachable(gc_header_t* list) {
+  gc_header_t* g = list;
   for (; g != NULL; g = g->next) {
     if (get_shadow_ref_count(g) == 0) {
       g->meta_ref_count = (NONTRIVIAL_ROOT_MASK | MARKED_AS_UNREACHABLE);
@@ -312,19 +750,21 @@ static void gc_unref_if_reachable(gc_header_t* g) {
   gc_unref(g);
 }
 
-static void dealloc_unreachable() {
-  gc_header_t* g = nontrivial_gc_roots;
+static void unref_from_unreachable(gc_header_t* list) {
+  gc_header_t* g = list;
   for (; g != NULL; g = g->next) {
     if (is_marked_unreachable(g)) {
       g->obj_ops->gc_visitor(g->obj, gc_unref_if_reachable);
     }
   }
+}
 
-  g = nontrivial_gc_roots;
+static void dealloc_unreachable(gc_header_t** list) {
+  gc_header_t* g = *list;
   while (g != NULL) {
     gc_header_t* next = g->next;
     if (is_marked_unreachable(g)) {
-      gc_remove_from_list(&nontrivial_gc_roots, g);
+      gc_remove_from_list(list, g);
       g->ref_count = 0;
       gc_dealloc(g);
     }
@@ -332,32 +772,234 @@ static void dealloc_unreachable() {
   }
 }
 
-static void copy_to_new_heap(gc_header_t* list) {
+// The bytes |g| takes in the heap.
+static inline size_t obj_alloc_size(gc_header_t* g) {
+  size_t size = roundup_aligned(g->obj_ops->get_bytes(g->obj));
+#ifdef FO_INLINE_GC_HEADER
+  size += sizeof(gc_header_t);
+#endif
+  return size;
+}
+
+// Moves |g| into the semispace, at the end of the moved objects, and
+// returns its new address.
+//
+// With FO_INLINE_GC_HEADER, the object moves with its header, and the old
+// copy keeps the new address in |prev|, the forwarding pointer.
+static gc_header_t* move_obj(gc_header_t* g) {
+  gc_remove_from_list(gc_roots_of(g), g);
+  size_t size = obj_alloc_size(g);
+#ifdef FO_INLINE_GC_HEADER
+  gc_header_t* moved = (gc_header_t*)alloc_heap(size);
+  CHECK(moved != NULL);
+  memcpy((void*)moved, (const void*)g, size);
+  g->prev = moved;
+#else
+  val_t* new_mem = (val_t*)alloc_heap(size);
+  CHECK(new_mem != NULL);
+  memcpy((void*)new_mem, (const void*)g->obj, size);
+  g->obj = new_mem;
+  gc_header_t* moved = g;
+#endif
+  if (is_nontrivial_gc(moved)) {
+    gc_append_to_list(&moved_nontrivial_, &moved_nontrivial_tail_, moved);
+    if (next_to_scan_ == NULL) {
+      next_to_scan_ = moved;
+    }
+  } else {
+    gc_append_to_list(&moved_trivial_, &moved_trivial_tail_, moved);
+  }
+  return moved;
+}
+
+// Moves |g| unless it is already in the semispace, and returns its new
+// address. The old objects are in the semispace during a minor collection.
+static gc_header_t* move_reachable(gc_header_t* g) {
+  if (is_static_obj(g) || is_in_semispace(g->obj)) {
+    return g;
+  }
+#ifdef FO_INLINE_GC_HEADER
+  if ((g->prev != NULL) && is_in_semispace(g->prev)) {
+    return g->prev;
+  }
+#endif
+  return move_obj(g);
+}
+
+// Moves the objects the moved nontrivial objects point to, until there are
+// no more. The moved objects are the queue: the copy is breadth first.
+#ifndef FO_INLINE_GC_HEADER
+// The headers do not move, the pointers stay the same.
+static void visit_move_reachable(gc_header_t* g) { move_reachable(g); }
+#endif
+
+static void scan_moved() {
+  while (next_to_scan_ != NULL) {
+    gc_header_t* g = next_to_scan_;
+#ifdef FO_INLINE_GC_HEADER
+    g->obj_ops->gc_updater(g->obj, move_reachable);
+#else
+    g->obj_ops->gc_visitor(g->obj, visit_move_reachable);
+#endif
+    next_to_scan_ = g->next;
+  }
+}
+
+// Moves all the objects of |*list|.
+static void move_all(gc_header_t** list) {
+  while (*list != NULL) {
+    move_obj(*list);
+    scan_moved();
+  }
+}
+
+// Moves the surviving objects into the semispace, the young ones only if
+// |young_only|. The copy starts from the objects referenced from outside
+// the moved ones, and goes breadth first, so that the objects end up next
+// to the ones they point to, whatever the order of the lists.
+static void move_survivors(bool young_only) {
+  moved_trivial_ = NULL;
+  moved_trivial_tail_ = NULL;
+  moved_nontrivial_ = NULL;
+  moved_nontrivial_tail_ = NULL;
+  next_to_scan_ = NULL;
+
+  for (size_t i = 0; i < num_roots_; ++i) {
+    if (*roots_[i] != NULL) {
+      *roots_[i] = move_reachable(*roots_[i]);
+    }
+  }
+  for (size_t i = 0; i < num_scan_roots_; ++i) {
+    move_reachable(scan_roots_[i]);
+  }
+  // Only set in a minor collection.
+  for (size_t i = 0; i < remembered_set_size_; ++i) {
+    gc_header_t* g = remembered_set_[i];
+    // Unless it was freed since.
+    if (g->obj_ops != NULL) {
+      g->obj_ops->gc_updater(g->obj, move_reachable);
+    }
+  }
+  scan_moved();
+  // The trivial objects only referenced from outside.
+  move_all(&young_trivial_gc_roots);
+  move_all(&young_nontrivial_gc_roots);
+  if (!young_only) {
+    move_all(&trivial_gc_roots);
+    move_all(&nontrivial_gc_roots);
+  }
+  gc_move_list(&moved_trivial_, &trivial_gc_roots);
+  gc_move_list(&moved_nontrivial_, &nontrivial_gc_roots);
+  reset_nursery();
+}
+
+void run_minor_gc() {
+  // process circular reference among the young objects
+  minor_gc_running_ = true;
+  take_remembered_set();
+  num_scan_roots_ = 0;
+  copy_refcount_to_shadow(young_nontrivial_gc_roots);
+  subtract_shadow_ref_count(young_nontrivial_gc_roots);
+  // The pointers from the remembered set are counted out too, and their
+  // targets recovered below, as roots.
+  for (size_t i = 0; i < remembered_set_size_; ++i) {
+    gc_header_t* g = remembered_set_[i];
+    g->obj_ops->gc_visitor(g->obj, visit_subtract_ref_count);
+  }
+  record_scan_roots(young_nontrivial_gc_roots);
+  for (size_t i = 0; i < remembered_set_size_; ++i) {
+    gc_header_t* g = remembered_set_[i];
+    g->obj_ops->gc_visitor(g->obj, visit_recover_ref_count);
+  }
+  recover_reachable(young_nontrivial_gc_roots);
+  mark_unreachable(young_nontrivial_gc_roots);
+  unref_from_unreachable(young_nontrivial_gc_roots);
+  dealloc_unreachable(&young_nontrivial_gc_roots);
+  minor_gc_running_ = false;
+
+  // The survivors take at most what the nursery uses.
+  if ((size_t)(heap_end_ - heap_cur_) < nursery_usage()) {
+    remembered_set_size_ = 0;
+    run_gc();
+    return;
+  }
+  move_survivors(true);
+  remembered_set_size_ = 0;
+  release_empty_gc_header_chunks();
+}
+
+static size_t list_bytes(gc_header_t* list) {
+  size_t result = 0;
   gc_header_t* g = list;
   for (; g != NULL; g = g->next) {
-    size_t size = g->obj_ops->get_bytes(g->obj);
-    val_t* new_mem = (val_t*)alloc_heap(size);
-    CHECK(new_mem != NULL);
-    memcpy((void*)new_mem, (const void*)g->obj, size);
-    g->obj = new_mem;
+    result += obj_alloc_size(g);
   }
+  return result;
 }
 
-void run_gc() {
+// The size of the semispaces for |live| bytes of objects, and |min_free|
+// more.
+static size_t next_heap_size(size_t live, size_t min_free) {
+  size_t needed = live + min_free;
+  if (needed <= per_heap_size_ * occupancy_target_) {
+    return per_heap_size_;
+  }
+  size_t grown = (size_t)(per_heap_size_ * growth_factor_);
+  size_t target = (size_t)(needed / occupancy_target_);
+  return roundup_aligned(grown > target ? grown : target);
+}
+
+void run_gc() { collect_all(0); }
+
+// A major collection, after which |min_free| bytes can be allocated in the
+// semispace.
+static void collect_all(size_t min_free) {
+  // The young objects are collected as well, they are all old afterwards.
+  take_remembered_set();
+  remembered_set_size_ = 0;
+  num_scan_roots_ = 0;
   // process circular reference
-  copy_refcount_to_shadow();
-  subtract_shadow_ref_count();
-  find_unreachable();
-  dealloc_unreachable();
+  copy_refcount_to_shadow(nontrivial_gc_roots);
+  copy_refcount_to_shadow(young_nontrivial_gc_roots);
+  subtract_shadow_ref_count(nontrivial_gc_roots);
+  subtract_shadow_ref_count(young_nontrivial_gc_roots);
+  record_scan_roots(nontrivial_gc_roots);
+  record_scan_roots(young_nontrivial_gc_roots);
+  recover_reachable(nontrivial_gc_roots);
+  recover_reachable(young_nontrivial_gc_roots);
+  mark_unreachable(nontrivial_gc_roots);
+  mark_unreachable(young_nontrivial_gc_roots);
+  unref_from_unreachable(nontrivial_gc_roots);
+  unref_from_unreachable(young_nontrivial_gc_roots);
+  dealloc_unreachable(&nontrivial_gc_roots);
+  dealloc_unreachable(&young_nontrivial_gc_roots);
   // move to new space
-  swap_heap_space();
-  copy_to_new_heap(trivial_gc_roots);
-  copy_to_new_heap(nontrivial_gc_roots);
+  size_t live = list_bytes(trivial_gc_roots) + list_bytes(nontrivial_gc_roots) +
+                list_bytes(young_trivial_gc_roots) +
+                list_bytes(young_nontrivial_gc_roots);
+  size_t heap_size = next_heap_size(live, min_free);
+  char* retired_heap = NULL;
+  if (heap_size != per_heap_size_) {
+    char* raw_begin = alloc_semispaces(heap_size);
+    if (raw_begin != NULL) {
+      retired_heap = heap_raw_begin_;
+      set_semispaces(raw_begin, heap_size);
+    }
+  }
+  if (retired_heap == NULL) {
+    swap_heap_space();
+  }
+  move_survivors(false);
+  free(retired_heap);
+  release_empty_gc_header_chunks();
 }
 
 size_t num_gc_headers_in_use() { return num_gc_headers_in_use_; }
 
 void print_gc_mem_stats() {
-  printf("num_gc_headers_in_use: %lu, heap_usage: %lu (bytes)\n",
-         num_gc_headers_in_use(), heap_usage());
-}
\ No newline at end of file
+  printf(
+      "num_gc_headers_in_use: %lu / %lu (%lu chunks), heap_usage: %lu "
+      "(bytes)\n",
+      num_gc_headers_in_use(), num_gc_headers(), num_gc_header_chunks(),
+      heap_usage());
+}
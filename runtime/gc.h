@@ -11,10 +11,33 @@ gc_header_t* gc_alloc_nontrivial(size_t size, const obj_operators_t* ops);
 
 void gc_ref(gc_header_t* g);
 void gc_unref(gc_header_t* g);
+// Must be called when a pointer to |val| is stored in the object of |g|.
+void gc_write_barrier(gc_header_t* g, gc_header_t* val);
+// Registers the variable |root|, which holds NULL or an object, for the GC
+// to update when it moves the object, see FO_INLINE_GC_HEADER. The roots
+// are a stack: gc_pop_roots() unregisters the |n| last ones.
+void gc_push_root(gc_header_t** root);
+void gc_pop_roots(size_t n);
+
+// The allocations run the GC when they run out of memory, so the objects
+// can move during any allocation: |obj| must be read again from the header
+// afterwards.
+//
+// When the objects occupy more than |occupancy_target| of the header pool
+// or of the heap after a collection, it grows by |growth_factor|.
+#define DEFAULT_GC_GROWTH_FACTOR 2.0
+#define DEFAULT_GC_OCCUPANCY_TARGET 0.5
+void set_gc_growth_policy(double growth_factor, double occupancy_target);
 
 void init_gc(size_t num_gc_headers);
+// Collects the young objects only, see gc.c.
+void run_minor_gc();
+// Collects all the objects.
 void run_gc();
 size_t num_gc_headers_in_use();
+// The size of the header pool, which grows and shrinks by chunks.
+size_t num_gc_headers();
+size_t num_gc_header_chunks();
 
 void print_gc_mem_stats();
 
@@ -2,9 +2,11 @@
 
 static size_t trivial_obj_get_bytes(val_t* o) { return sizeof(val_t); }
 static void trivial_obj_gc_visitor(val_t* o, gc_visit_func visit) {}
+static void trivial_obj_gc_updater(val_t* o, gc_update_func update) {}
 
 const obj_operators_t* get_trivial_obj_operators() {
   static obj_operators_t ops = {.get_bytes = trivial_obj_get_bytes,
-                                .gc_visitor = trivial_obj_gc_visitor};
+                                .gc_visitor = trivial_obj_gc_visitor,
+                                .gc_updater = trivial_obj_gc_updater};
   return &ops;
 }
\ No newline at end of file
@@ -6,6 +6,27 @@
 struct gc_header;
 struct obj_operators;
 
+// Object layouts:
+//
+// By default, the headers are allocated apart from the objects, and |obj|
+// points to the object in the heap. The GC moves the objects, never the
+// headers, so a gc_header_t* stays valid until the object is freed.
+//
+// With FO_INLINE_GC_HEADER, the header is a prefix of the object, and |obj|
+// is the rest of the allocation: reaching the object takes no extra load,
+// and the header shares its cache lines. The GC moves the objects with their
+// header, and updates the pointers to them: in the other objects, and in
+// the variables registered with gc_push_root(). Any other gc_header_t* is
+// stale after an allocation.
+#ifdef FO_INLINE_GC_HEADER
+#define GC_HEAD_FIELDS                 \
+  const struct obj_operators* obj_ops; \
+  struct gc_header* prev;              \
+  struct gc_header* next;              \
+  int32_t ref_count;                   \
+  int32_t meta_ref_count;              \
+  val_t obj[];
+#else
 #define GC_HEAD_FIELDS                 \
   val_t* obj;                          \
   const struct obj_operators* obj_ops; \
@@ -13,6 +34,7 @@ struct obj_operators;
   struct gc_header* next;              \
   int32_t ref_count;                   \
   int32_t meta_ref_count;
+#endif
 
 typedef struct gc_header {
   GC_HEAD_FIELDS
@@ -22,15 +44,25 @@ typedef struct gc_header {
 typedef size_t (*obj_bytes_getter)(val_t*);
 typedef void (*gc_visit_func)(gc_header_t*);
 typedef void (*obj_gc_visitor)(val_t*, gc_visit_func);
+// Returns the new address of a moved object.
+typedef gc_header_t* (*gc_update_func)(gc_header_t*);
+typedef void (*obj_gc_updater)(val_t*, gc_update_func);
 
 typedef struct obj_operators {
   obj_bytes_getter get_bytes;
   // a bunch of gc related operators
   obj_gc_visitor gc_visitor;
+  // Replaces every pointer to an object in the object, see
+  // FO_INLINE_GC_HEADER.
+  obj_gc_updater gc_updater;
 } obj_operators_t;
 
 const obj_operators_t* get_trivial_obj_operators();
 
+// Set in |meta_ref_count| of the statically allocated objects. They are
+// shared, and never refcounted, collected or moved.
+#define GC_STATIC_OBJ_MASK (1 << 29)
+
 #define GC_TO_OBJ(type, g) ((type*)((g)->obj))
 #define GC_TO_FUNC_PTR(func_type, g) ((func_type)((g)->obj))
 
@@ -6,18 +6,9 @@
 
 // Runtime memory layout:
 //
-// ------------
-// |          |
-// |          |
-// |          |
-// |          |
-// |  global  |
-// |   heap   |
-// |          |
-// |          |
-// |          |
-// |          |
-// ------------ stack_top(n) / heap_begin()
+// ------------ heap_begin()
+// | nursery  |
+// ------------ stack_top(n)
 // | cn stack |
 // ------------ stack_top(n - 1) / stack_bottom(n)
 // |          |
@@ -33,8 +24,12 @@
 // | /  /  /  |
 // ------------ runtime_reserved_begin()
 //
+// The global heap is made of a nursery of |nursery_size| bytes, where the
+// new objects are allocated, see gc.h, and of two semispaces of |heap_size|
+// bytes each. A |nursery_size| of 0 disables the nursery. The semispaces are
+// allocated apart, so that the GC can grow them.
 void init_memory(size_t runtime_reserved_size, size_t per_stack_size,
-                 int num_stacks, size_t heap_size);
+                 int num_stacks, size_t heap_size, size_t nursery_size);
 void free_memory();
 
 // Stack grows downward.
@@ -43,6 +38,12 @@ char* stack_bottom(int stack_i);
 
 char* alloc_runtime_reserved(size_t size);
 char* alloc_heap(size_t size);
+// Returns NULL when the nursery is full.
+char* alloc_nursery(size_t size);
+void reset_nursery();
+bool is_in_nursery(const void* p);
+// Bytes in use in the semispace and in the nursery.
 size_t heap_usage();
+size_t nursery_usage();
 
 #endif  // RUNTIME_MEMORY_H_
\ No newline at end of file
@@ -0,0 +1,79 @@
+#include "runtime/profile.h"
+
+#include <string.h>
+#include "runtime/memory.h"
+
+#define PROFILE_PATH_ENV "FO_PROFILE"
+#define DEFAULT_PROFILE_PATH "fo.profile"
+
+typedef struct profile_unit {
+  const char* const* names;
+  uint64_t* counters;
+  size_t num_counters;
+  struct profile_unit* next;
+} profile_unit_t;
+
+static profile_unit_t* profile_units_ = NULL;
+static bool dump_at_exit_ = false;
+
+uint64_t* register_profile_counters(const char* const* names,
+                                    size_t num_counters) {
+  profile_unit_t* unit =
+      (profile_unit_t*)alloc_runtime_reserved(sizeof(profile_unit_t));
+  uint64_t* counters =
+      (uint64_t*)alloc_runtime_reserved(sizeof(uint64_t) * num_counters);
+  CHECK(unit != NULL && counters != NULL);
+  memset(counters, 0, sizeof(uint64_t) * num_counters);
+
+  unit->names = names;
+  unit->counters = counters;
+  unit->num_counters = num_counters;
+  unit->next = profile_units_;
+  profile_units_ = unit;
+
+  if (!dump_at_exit_) {
+    atexit(dump_profile);
+    dump_at_exit_ = true;
+  }
+  return counters;
+}
+
+void count_profile_target(uint64_t* counters, profile_target_t* targets,
+                          size_t num_targets, val_t func) {
+  for (size_t i = 0; i < num_targets; ++i) {
+    if (targets[i].func == func) {
+      ++counters[targets[i].counter];
+      if (i > 0) {
+        profile_target_t target = targets[i];
+        targets[i] = targets[0];
+        targets[0] = target;
+      }
+      return;
+    }
+  }
+}
+
+void dump_profile() {
+  if (profile_units_ == NULL) {
+    return;
+  }
+  const char* path = getenv(PROFILE_PATH_ENV);
+  if (path == NULL) {
+    path = DEFAULT_PROFILE_PATH;
+  }
+  FILE* f = fopen(path, "w");
+  if (f == NULL) {
+    ERRLOG("Cannot write the profile to %s\n", path);
+  } else {
+    for (profile_unit_t* unit = profile_units_; unit != NULL;
+         unit = unit->next) {
+      for (size_t i = 0; i < unit->num_counters; ++i) {
+        fprintf(f, "%s %llu\n", unit->names[i],
+                (unsigned long long)unit->counters[i]);
+      }
+    }
+    fclose(f);
+  }
+  // The counters are gone with the runtime memory.
+  profile_units_ = NULL;
+}
@@ -0,0 +1,39 @@
+#ifndef RUNTIME_PROFILE_H_
+#define RUNTIME_PROFILE_H_
+
+#include "runtime/base.h"
+
+// Execution counters of the programs compiled with --instrument.
+//
+// Every translation unit registers its named counters the first time it
+// counts. They live in the runtime reserved segment, so counting must stop
+// before free_memory(). The counters are written out by free_memory(), or at
+// exit if it is never called, to $FO_PROFILE, or "fo.profile" if it is not
+// set. Every line of the file is "<counter name> <count>".
+
+uint64_t* register_profile_counters(const char* const* names,
+                                    size_t num_counters);
+void dump_profile();
+
+// The counter of a function that a call through closures may call.
+typedef struct profile_target {
+  val_t func;
+  size_t counter;
+} profile_target_t;
+
+// Counts the call of |func| in |counters|, which are registered, at a call
+// site that may call the |num_targets| |targets|. The table is reordered,
+// the last target called first, so that the search is short at the call
+// sites that mostly call one function.
+void count_profile_target(uint64_t* counters, profile_target_t* targets,
+                          size_t num_targets, val_t func);
+
+#define PROFILE_COUNT(counters, names, num_counters, i)               \
+  do {                                                                 \
+    if ((counters) == NULL) {                                          \
+      (counters) = register_profile_counters((names), (num_counters)); \
+    }                                                                  \
+    ++(counters)[(i)];                                                 \
+  } while (0)
+
+#endif  // RUNTIME_PROFILE_H_
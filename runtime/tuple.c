@@ -2,7 +2,7 @@
 #include "runtime/gc.h"
 
 static size_t tuple_bytes_by_num(size_t num) {
-  return (sizeof(size_t) * 2) + sizeof(val_t*) + (sizeof(val_t) * num);
+  return sizeof(tuple_t) + (sizeof(val_t) * num);
 }
 
 static size_t tuple_get_bytes(val_t* o) {
@@ -13,10 +13,20 @@ static size_t tuple_get_bytes(val_t* o) {
 static void tuple_gc_visitor(val_t* o, gc_visit_func visit) {
   tuple_t* t = (tuple_t*)o;
   size_t gc_mask = t->gc_mask;
-  val_t* begin = t->begin;
   for (int i = 0; i < t->num; ++i) {
     if (gc_mask & 1) {
-      visit((gc_header_t*)begin[i]);
+      visit((gc_header_t*)t->slots[i]);
+    }
+    gc_mask >>= 1;
+  }
+}
+
+static void tuple_gc_updater(val_t* o, gc_update_func update) {
+  tuple_t* t = (tuple_t*)o;
+  size_t gc_mask = t->gc_mask;
+  for (int i = 0; i < t->num; ++i) {
+    if (gc_mask & 1) {
+      t->slots[i] = (val_t)update((gc_header_t*)t->slots[i]);
     }
     gc_mask >>= 1;
   }
@@ -24,7 +34,8 @@ static void tuple_gc_visitor(val_t* o, gc_visit_func visit) {
 
 const obj_operators_t* get_tuple_operators() {
   static obj_operators_t ops = {.get_bytes = tuple_get_bytes,
-                                .gc_visitor = tuple_gc_visitor};
+                                .gc_visitor = tuple_gc_visitor,
+                                .gc_updater = tuple_gc_updater};
   return &ops;
 }
 
@@ -35,7 +46,6 @@ gc_header_t* alloc_tuple(size_t num) {
     tuple_t* t = GC_TO_OBJ(tuple_t, gt);
     t->num = num;
     t->gc_mask = 0;
-    t->begin = (val_t*)(((char*)t) + tuple_bytes_by_num(0));
   }
   return gt;
 }
@@ -47,16 +57,17 @@ void set_tuple_at(gc_header_t* gt, int i, val_t val, bool needs_gc) {
   if (needs_gc) {
     gc_header_t* g = (gc_header_t*)val;
     gc_ref(g);
+    gc_write_barrier(gt, g);
     t->gc_mask |= mask_i;
   } else {
     mask_i = (~mask_i);
     t->gc_mask &= mask_i;
   }
-  t->begin[i] = val;
+  t->slots[i] = val;
 }
 
 val_t get_tuple_at(gc_header_t* gt, int i) {
   tuple_t* t = GC_TO_OBJ(tuple_t, gt);
   CHECK((0 <= i) && (i < t->num));
-  return t->begin[i];
+  return t->slots[i];
 }
\ No newline at end of file
@@ -11,7 +11,9 @@ typedef struct tuple {
   // 1: needs gc
   // 0: trivially destructable
   size_t gc_mask;
-  val_t* begin;
+  // The elements are stored inline, so that the tuple stays valid when the
+  // GC moves it.
+  val_t slots[];
 } tuple_t;
 
 const obj_operators_t* get_tuple_operators();
@@ -20,4 +22,36 @@ gc_header_t* alloc_tuple(size_t num);
 void set_tuple_at(gc_header_t* gt, int i, val_t val, bool needs_gc);
 val_t get_tuple_at(gc_header_t* gt, int i);
 
+// The closure of a function without free variables is a 1-tuple holding the
+// function pointer. It is the same for all the uses of the function, so it
+// is allocated statically, as |name|, and never refcounted.
+//
+// DECLARE_STATIC_CLOSURE makes |name| usable before |func| is defined.
+#define DECLARE_STATIC_CLOSURE(name) static gc_header_t name
+
+#ifdef FO_INLINE_GC_HEADER
+// The object is laid out as a tuple_t with one slot.
+#define DEFINE_STATIC_CLOSURE(name, func)                               \
+  static gc_header_t name = {.obj_ops = NULL,                           \
+                             .prev = NULL,                              \
+                             .next = NULL,                              \
+                             .ref_count = 1,                            \
+                             .meta_ref_count = GC_STATIC_OBJ_MASK,      \
+                             .obj = {1, 0, (val_t)(func)}}
+#else
+// The object has the layout of a tuple_t with one slot.
+#define DEFINE_STATIC_CLOSURE(name, func)                               \
+  static struct {                                                       \
+    size_t num;                                                         \
+    size_t gc_mask;                                                     \
+    val_t slots[1];                                                     \
+  } name##_obj = {1, 0, {(val_t)(func)}};                               \
+  static gc_header_t name = {.obj = (val_t*)&name##_obj,                \
+                             .obj_ops = NULL,                           \
+                             .prev = NULL,                              \
+                             .next = NULL,                              \
+                             .ref_count = 1,                            \
+                             .meta_ref_count = GC_STATIC_OBJ_MASK}
+#endif
+
 #endif  // RUNTIME_TUPLE_H_
\ No newline at end of file
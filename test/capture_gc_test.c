@@ -0,0 +1,54 @@
+// Runs the code generated from capture_gc.fo with a heap small enough for
+// every few allocations to run the GC, which moves the boxes of the
+// captured variables while the values stored into them are computed.
+#include <stdio.h>
+
+#include "runtime/base.h"
+#include "runtime/gc.h"
+#include "runtime/memory.h"
+#include "runtime/tuple.h"
+
+#define RUNTIME_RESERVED_SIZE 1024 * 1024
+#define COROUTINE_STACK_SIZE 64 * 1024
+#define NUM_COROUTINES 1
+#define HEAP_SIZE 4096
+#define NURSERY_SIZE 1024
+#define NUM_GC_HEADERS 64
+
+#define NUM_RUNS 20000
+
+// Defined in the generated capture_gc.c.
+gc_header_t* store_call(gc_header_t* context_tuple, int64_t a);
+gc_header_t* store_temporary(gc_header_t* context_tuple, int64_t a);
+gc_header_t* store_closure(gc_header_t* context_tuple, int64_t a);
+
+typedef gc_header_t* (*make_func_t)(gc_header_t*, int64_t);
+typedef int64_t (*get_func_t)(gc_header_t*);
+
+static int64_t call_closure(gc_header_t* closure) {
+  get_func_t f = (get_func_t)get_tuple_at(closure, 0);
+  return f(closure);
+}
+
+static void test_store(const char* name, make_func_t make) {
+  printf(">>> test_%s begin\n", name);
+  int num_wrong = 0;
+  for (int64_t i = 0; i < NUM_RUNS; ++i) {
+    gc_header_t* get = make(NULL, i);
+    if (call_closure(get) != 3 * i) {
+      ++num_wrong;
+    }
+  }
+  CHECK(num_wrong == 0);
+  printf("<<< test_%s passed!\n\n", name);
+}
+
+int main() {
+  init_memory(RUNTIME_RESERVED_SIZE, COROUTINE_STACK_SIZE, NUM_COROUTINES,
+              HEAP_SIZE, NURSERY_SIZE);
+  init_gc(NUM_GC_HEADERS);
+  test_store("store_call", store_call);
+  test_store("store_temporary", store_temporary);
+  test_store("store_closure", store_closure);
+  free_memory();
+}
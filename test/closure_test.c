@@ -48,11 +48,12 @@ typedef val_t (*counter_closure1_t)(gc_header_t*);
 #define COROUTINE_STACK_SIZE 1024 * 1024
 #define NUM_COROUTINES 1
 #define HEAP_SIZE 4 * 1024 * 1024
+#define NURSERY_SIZE 256 * 1024
 #define NUM_GC_HEADERS 1000
 
 int main() {
   init_memory(RUNTIME_RESERVED_SIZE, COROUTINE_STACK_SIZE, NUM_COROUTINES,
-              HEAP_SIZE);
+              HEAP_SIZE, NURSERY_SIZE);
   init_gc(NUM_GC_HEADERS);
 
   gc_header_t* g_closure = counter(3);
@@ -108,11 +108,12 @@ void main_entry(gc_header_t* context_tuple) {
 #define COROUTINE_STACK_SIZE 1024 * 1024
 #define NUM_COROUTINES 1
 #define HEAP_SIZE 8 * 1024 * 1024
+#define NURSERY_SIZE 256 * 1024
 #define NUM_GC_HEADERS 10000
 
 int main() {
   init_memory(RUNTIME_RESERVED_SIZE, COROUTINE_STACK_SIZE, NUM_COROUTINES,
-              HEAP_SIZE);
+              HEAP_SIZE, NURSERY_SIZE);
   init_gc(NUM_GC_HEADERS);
 
   main_entry(NULL);
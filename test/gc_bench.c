@@ -0,0 +1,128 @@
+// Compares the object layouts, see runtime/gc_header.h: it is built as
+// gc_bench with the headers apart, and as gc_bench_inline with
+// FO_INLINE_GC_HEADER.
+//
+// It measures the throughput of the tuple accesses along a list, and the
+// pauses of the major and minor collections.
+#include <stdio.h>
+#include <time.h>
+
+#include "runtime/base.h"
+#include "runtime/gc.h"
+#include "runtime/memory.h"
+#include "runtime/tuple.h"
+
+#define RUNTIME_RESERVED_SIZE 1024 * 1024
+#define COROUTINE_STACK_SIZE 1024 * 1024
+#define NUM_COROUTINES 1
+#define HEAP_SIZE 16 * 1024 * 1024
+#define NURSERY_SIZE 1024 * 1024
+#define NUM_GC_HEADERS 1000
+
+// Freeing the list recurses through it.
+#define LIST_LENGTH 20000
+#define NUM_SLOTS 8
+#define NUM_TRAVERSALS 200
+#define NUM_COLLECTIONS 20
+#define NUM_YOUNG_NODES 1000
+
+#ifdef FO_INLINE_GC_HEADER
+#define LAYOUT_NAME "inline"
+#else
+#define LAYOUT_NAME "separate"
+#endif
+
+static double now_ns() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec * 1e9 + ts.tv_nsec;
+}
+
+// The head of the list, registered with the GC.
+static gc_header_t* head;
+
+// Prepends a node holding |value| to the list, and a garbage cycle.
+static void push_node(val_t value) {
+  gc_header_t* garbage = alloc_tuple(1);
+  set_tuple_at(garbage, 0, (val_t)garbage, true);
+  gc_unref(garbage);
+
+  gc_header_t* node = alloc_tuple(NUM_SLOTS);
+  CHECK(node != NULL);
+  set_tuple_at(node, 1, value, false);
+  if (head != NULL) {
+    set_tuple_at(node, 0, (val_t)head, true);
+    gc_unref(head);
+  }
+  head = node;
+}
+
+static val_t sum_list() {
+  val_t sum = 0;
+  gc_header_t* node = head;
+  while (node != NULL) {
+    sum += get_tuple_at(node, 1);
+    node = (gc_header_t*)get_tuple_at(node, 0);
+  }
+  return sum;
+}
+
+static val_t expected_sum(val_t n) { return n * (n - 1) / 2; }
+
+static void bench_access() {
+  val_t sum = 0;
+  double start = now_ns();
+  for (int i = 0; i < NUM_TRAVERSALS; ++i) {
+    sum += sum_list();
+  }
+  double elapsed = now_ns() - start;
+  CHECK(sum == NUM_TRAVERSALS * expected_sum(LIST_LENGTH));
+  printf("access: %.2f ns per tuple\n",
+         elapsed / ((double)NUM_TRAVERSALS * LIST_LENGTH));
+}
+
+static void bench_major_gc() {
+  double start = now_ns();
+  for (int i = 0; i < NUM_COLLECTIONS; ++i) {
+    run_gc();
+  }
+  double elapsed = now_ns() - start;
+  CHECK(sum_list() == expected_sum(LIST_LENGTH));
+  printf("major gc: %.1f us per pause\n", elapsed / NUM_COLLECTIONS / 1e3);
+}
+
+static void bench_minor_gc() {
+  val_t n = LIST_LENGTH;
+  double elapsed = 0;
+  for (int i = 0; i < NUM_COLLECTIONS; ++i) {
+    for (int j = 0; j < NUM_YOUNG_NODES; ++j) {
+      push_node(n++);
+    }
+    double start = now_ns();
+    run_minor_gc();
+    elapsed += now_ns() - start;
+  }
+  CHECK(sum_list() == expected_sum(n));
+  printf("minor gc: %.1f us per pause\n", elapsed / NUM_COLLECTIONS / 1e3);
+}
+
+int main() {
+  init_memory(RUNTIME_RESERVED_SIZE, COROUTINE_STACK_SIZE, NUM_COROUTINES,
+              HEAP_SIZE, NURSERY_SIZE);
+  init_gc(NUM_GC_HEADERS);
+  head = NULL;
+  gc_push_root(&head);
+  for (val_t i = 0; i < LIST_LENGTH; ++i) {
+    push_node(i);
+  }
+  run_gc();
+
+  printf("layout: %s\n", LAYOUT_NAME);
+  bench_access();
+  bench_major_gc();
+  bench_minor_gc();
+
+  gc_pop_roots(1);
+  free_memory();
+  return 0;
+}
@@ -1,3 +1,6 @@
+// Built as gc_test, and as gc_test_inline with FO_INLINE_GC_HEADER: the
+// pointers held across the allocations and collections are registered with
+// gc_push_root().
 #include <execinfo.h>
 #include <signal.h>
 #include <stdio.h>
@@ -13,6 +16,7 @@
 #define COROUTINE_STACK_SIZE 1024 * 1024
 #define NUM_COROUTINES 1
 #define HEAP_SIZE 4 * 1024 * 1024
+#define NURSERY_SIZE 256 * 1024
 #define NUM_GC_HEADERS 1000
 
 void sig_handler(int sig) {
@@ -32,13 +36,23 @@ void setup() {
   signal(SIGSEGV, sig_handler);
 
   init_memory(RUNTIME_RESERVED_SIZE, COROUTINE_STACK_SIZE, NUM_COROUTINES,
-              HEAP_SIZE);
+              HEAP_SIZE, NURSERY_SIZE);
   init_gc(NUM_GC_HEADERS);
   // init_runtime_tuple();
 }
 
 void tear_down() { free_memory(); }
 
+// The bytes |g| takes in the heap: with FO_INLINE_GC_HEADER, its header is
+// there too, see runtime/gc_header.h.
+static size_t heap_bytes(gc_header_t* g) {
+  size_t bytes = roundup_aligned(g->obj_ops->get_bytes(g->obj));
+#ifdef FO_INLINE_GC_HEADER
+  bytes += sizeof(gc_header_t);
+#endif
+  return bytes;
+}
+
 void test_gc_basic() {
   printf(">>> test_gc_basic begin\n");
   gc_header_t* gc_t = alloc_tuple(4);
@@ -98,9 +112,11 @@ void test_gc_circular_reference2() {
   gc_unref(gc_t2);
   CHECK(num_gc_headers_in_use() == 3);
 
+  gc_push_root(&gc_t3);
   run_gc();
-  CHECK(heap_usage() == get_tuple_operators()->get_bytes(gc_t3->obj));
+  CHECK(heap_usage() == heap_bytes(gc_t3));
   CHECK(num_gc_headers_in_use() == 1);
+  gc_pop_roots(1);
   printf("<<< test_gc_circular_reference2 passed!\n\n");
 }
 
@@ -120,6 +136,286 @@ void test_gc_circular_reference3() {
   printf("<<< test_gc_circular_reference3 passed!\n\n");
 }
 
+static val_t static_closure_func(gc_header_t* context_tuple, val_t x) {
+  return x + 1;
+}
+
+DEFINE_STATIC_CLOSURE(static_closure, static_closure_func);
+
+void test_gc_static_closure() {
+  printf(">>> test_gc_static_closure begin\n");
+  typedef val_t (*func_t)(gc_header_t*, val_t);
+  func_t f = (func_t)get_tuple_at(&static_closure, 0);
+  CHECK(f(&static_closure, 41) == 42);
+
+  gc_header_t* gc_t1 = alloc_tuple(2);
+  const bool needs_gc = true;
+  set_tuple_at(gc_t1, 0, (val_t)&static_closure, needs_gc);
+  set_tuple_at(gc_t1, 1, (val_t)gc_t1, needs_gc);
+  CHECK(static_closure.ref_count == 1);
+  CHECK(num_gc_headers_in_use() == 1);
+
+  gc_unref(gc_t1);
+  run_gc();
+  CHECK(num_gc_headers_in_use() == 0);
+  CHECK(heap_usage() == 0);
+  CHECK(static_closure.ref_count == 1);
+  CHECK(get_tuple_at(&static_closure, 0) == (val_t)static_closure_func);
+  printf("<<< test_gc_static_closure passed!\n\n");
+}
+
+void test_gc_minor() {
+  printf(">>> test_gc_minor begin\n");
+  gc_header_t* old_t = alloc_tuple(2);
+  gc_push_root(&old_t);
+  set_tuple_at(old_t, 1, 7, false);
+  CHECK(is_in_nursery(old_t->obj));
+  run_minor_gc();
+  CHECK(!is_in_nursery(old_t->obj));
+  CHECK(nursery_usage() == 0);
+  CHECK(get_tuple_at(old_t, 1) == 7);
+
+  // Only the old tuple points to |box|.
+  gc_header_t* box = gc_alloc_trivial(sizeof(val_t));
+  gc_push_root(&box);
+  *GC_TO_OBJ(val_t, box) = 42;
+  set_tuple_at(old_t, 0, (val_t)box, true);
+  gc_unref(box);
+  // A young garbage cycle.
+  gc_header_t* gc_t1 = alloc_tuple(1);
+  gc_header_t* gc_t2 = alloc_tuple(1);
+  set_tuple_at(gc_t1, 0, (val_t)gc_t2, true);
+  set_tuple_at(gc_t2, 0, (val_t)gc_t1, true);
+  gc_unref(gc_t1);
+  gc_unref(gc_t2);
+  CHECK(num_gc_headers_in_use() == 4);
+
+  run_minor_gc();
+  CHECK(num_gc_headers_in_use() == 2);
+  CHECK(nursery_usage() == 0);
+  CHECK(!is_in_nursery(box->obj));
+  CHECK(*GC_TO_OBJ(val_t, (gc_header_t*)get_tuple_at(old_t, 0)) == 42);
+
+  gc_pop_roots(2);
+  gc_unref(old_t);
+  CHECK(num_gc_headers_in_use() == 0);
+  run_gc();
+  CHECK(heap_usage() == 0);
+  printf("<<< test_gc_minor passed!\n\n");
+}
+
+void test_gc_growth() {
+  printf(">>> test_gc_growth begin\n");
+  // Far more than NUM_GC_HEADERS and HEAP_SIZE: a live list, and garbage
+  // cycles in between. Freeing the list recurses through it.
+  const int n = 20000;
+  const int num_slots = 32;
+  gc_header_t* head = alloc_tuple(num_slots);
+  gc_push_root(&head);
+  for (int i = 1; i < n; ++i) {
+    gc_header_t* garbage = alloc_tuple(1);
+    set_tuple_at(garbage, 0, (val_t)garbage, true);
+    gc_unref(garbage);
+
+    gc_header_t* node = alloc_tuple(num_slots);
+    CHECK(node != NULL);
+    set_tuple_at(node, 0, (val_t)head, true);
+    set_tuple_at(node, 1, i, false);
+    gc_unref(head);
+    head = node;
+  }
+  run_gc();
+  CHECK(num_gc_headers_in_use() == n);
+  CHECK(heap_usage() == n * heap_bytes(head));
+  gc_header_t* node = head;
+  for (int i = n - 1; i > 0; --i) {
+    CHECK(get_tuple_at(node, 1) == i);
+    node = (gc_header_t*)get_tuple_at(node, 0);
+  }
+
+  gc_pop_roots(1);
+  gc_unref(head);
+  CHECK(num_gc_headers_in_use() == 0);
+  printf("<<< test_gc_growth passed!\n\n");
+}
+
+void test_gc_roots_major() {
+  printf(">>> test_gc_roots_major begin\n");
+  // |shared| is reached from both tuples, and from |root|.
+  gc_header_t* shared = gc_alloc_trivial(sizeof(val_t));
+  *GC_TO_OBJ(val_t, shared) = 42;
+  gc_header_t* gc_t1 = alloc_tuple(1);
+  gc_header_t* gc_t2 = alloc_tuple(1);
+  set_tuple_at(gc_t1, 0, (val_t)shared, true);
+  set_tuple_at(gc_t2, 0, (val_t)shared, true);
+  gc_header_t* root = shared;
+  gc_header_t* none = NULL;
+  gc_push_root(&gc_t1);
+  gc_push_root(&gc_t2);
+  gc_push_root(&root);
+  gc_push_root(&none);
+  val_t* old_obj = shared->obj;
+  gc_unref(shared);
+
+  run_gc();
+  // Moved once: every pointer to it is updated to the same copy.
+  CHECK(root->obj != old_obj);
+  CHECK(get_tuple_at(gc_t1, 0) == (val_t)root);
+  CHECK(get_tuple_at(gc_t2, 0) == (val_t)root);
+  CHECK(*GC_TO_OBJ(val_t, root) == 42);
+  CHECK(none == NULL);
+  CHECK(heap_usage() == heap_bytes(gc_t1) + heap_bytes(gc_t2) +
+                            heap_bytes(root));
+
+  // And again, from the other semispace.
+  run_gc();
+  CHECK(get_tuple_at(gc_t1, 0) == (val_t)root);
+  CHECK(get_tuple_at(gc_t2, 0) == (val_t)root);
+  CHECK(*GC_TO_OBJ(val_t, root) == 42);
+
+  gc_pop_roots(4);
+  gc_unref(gc_t1);
+  gc_unref(gc_t2);
+  CHECK(num_gc_headers_in_use() == 0);
+  run_gc();
+  CHECK(heap_usage() == 0);
+  printf("<<< test_gc_roots_major passed!\n\n");
+}
+
+void test_gc_roots_minor() {
+  printf(">>> test_gc_roots_minor begin\n");
+  gc_header_t* old_t = alloc_tuple(2);
+  gc_push_root(&old_t);
+  run_minor_gc();
+  CHECK(!is_in_nursery(old_t->obj));
+
+  // |young| is reached from the old tuple, through the remembered set, from
+  // the young tuple, and from |root|.
+  gc_header_t* young = gc_alloc_trivial(sizeof(val_t));
+  *GC_TO_OBJ(val_t, young) = 42;
+  gc_header_t* young_t = alloc_tuple(1);
+  set_tuple_at(old_t, 0, (val_t)young, true);
+  set_tuple_at(young_t, 0, (val_t)young, true);
+  gc_header_t* root = young;
+  gc_push_root(&young_t);
+  gc_push_root(&root);
+  gc_unref(young);
+  CHECK(is_in_nursery(root->obj));
+
+  run_minor_gc();
+  CHECK(nursery_usage() == 0);
+  CHECK(!is_in_nursery(root->obj));
+  CHECK(!is_in_nursery(young_t->obj));
+  CHECK(get_tuple_at(old_t, 0) == (val_t)root);
+  CHECK(get_tuple_at(young_t, 0) == (val_t)root);
+  CHECK(*GC_TO_OBJ(val_t, root) == 42);
+
+  gc_pop_roots(3);
+  gc_unref(young_t);
+  gc_unref(old_t);
+  CHECK(num_gc_headers_in_use() == 0);
+  printf("<<< test_gc_roots_minor passed!\n\n");
+}
+
+void test_gc_roots_growth() {
+  printf(">>> test_gc_roots_growth begin\n");
+  // The list outgrows HEAP_SIZE: the allocations collect and grow the heap
+  // while |tail| and |head| point into it.
+  const int n = 20000;
+  const int num_slots = 32;
+  gc_header_t* tail = alloc_tuple(num_slots);
+  gc_header_t* head = tail;
+  gc_ref(head);
+  gc_push_root(&tail);
+  gc_push_root(&head);
+  for (int i = 1; i < n; ++i) {
+    gc_header_t* node = alloc_tuple(num_slots);
+    set_tuple_at(node, 0, (val_t)head, true);
+    set_tuple_at(node, 1, i, false);
+    gc_unref(head);
+    head = node;
+  }
+  CHECK(heap_usage() >= n * heap_bytes(head));
+
+  gc_header_t* node = head;
+  for (int i = n - 1; i > 0; --i) {
+    CHECK(get_tuple_at(node, 1) == i);
+    node = (gc_header_t*)get_tuple_at(node, 0);
+  }
+  CHECK(node == tail);
+
+  gc_pop_roots(2);
+  gc_unref(tail);
+  gc_unref(head);
+  CHECK(num_gc_headers_in_use() == 0);
+  printf("<<< test_gc_roots_growth passed!\n\n");
+}
+
+#ifndef FO_INLINE_GC_HEADER
+// There are no header chunks with FO_INLINE_GC_HEADER.
+void test_gc_header_chunks() {
+  printf(">>> test_gc_header_chunks begin\n");
+  CHECK(num_gc_headers() >= NUM_GC_HEADERS);
+  size_t num_chunks = num_gc_header_chunks();
+
+  const int n = 3 * num_gc_headers();
+  gc_header_t** boxes = (gc_header_t**)malloc(sizeof(gc_header_t*) * n);
+  for (int i = 0; i < n; ++i) {
+    boxes[i] = gc_alloc_trivial(sizeof(val_t));
+    CHECK(boxes[i] != NULL);
+  }
+  CHECK(num_gc_headers_in_use() == n);
+  CHECK(num_gc_headers() >= n);
+  CHECK(num_gc_header_chunks() > num_chunks);
+
+  for (int i = 0; i < n; ++i) {
+    gc_unref(boxes[i]);
+  }
+  free(boxes);
+  CHECK(num_gc_headers_in_use() == 0);
+  // The empty chunks are released by the collections.
+  run_gc();
+  CHECK(num_gc_header_chunks() == num_chunks);
+  CHECK(num_gc_headers() >= NUM_GC_HEADERS);
+  printf("<<< test_gc_header_chunks passed!\n\n");
+}
+#endif
+
+void test_gc_copy_order() {
+  printf(">>> test_gc_copy_order begin\n");
+  // The children of |parent| are allocated between unrelated objects, and
+  // only referenced from it.
+  const int num_children = 4;
+  gc_header_t* parent = alloc_tuple(num_children);
+  gc_push_root(&parent);
+  gc_header_t* others[num_children];
+  for (int i = 0; i < num_children; ++i) {
+    others[i] = alloc_tuple(2);
+    gc_push_root(&others[i]);
+    gc_header_t* child = alloc_tuple(2);
+    set_tuple_at(child, 0, i, false);
+    set_tuple_at(parent, i, (val_t)child, true);
+    gc_unref(child);
+  }
+
+  // The copy moves them together, in order.
+  run_gc();
+  for (int i = 1; i < num_children; ++i) {
+    gc_header_t* prev = (gc_header_t*)get_tuple_at(parent, i - 1);
+    gc_header_t* child = (gc_header_t*)get_tuple_at(parent, i);
+    CHECK((char*)child->obj == (char*)prev->obj + heap_bytes(prev));
+    CHECK(get_tuple_at(child, 0) == i);
+  }
+
+  gc_pop_roots(num_children + 1);
+  gc_unref(parent);
+  for (int i = 0; i < num_children; ++i) {
+    gc_unref(others[i]);
+  }
+  CHECK(num_gc_headers_in_use() == 0);
+  printf("<<< test_gc_copy_order passed!\n\n");
+}
+
 int main() {
   setup();
   test_gc_basic();
@@ -136,4 +432,38 @@ int main() {
   setup();
   test_gc_circular_reference3();
   tear_down();
-}
\ No newline at end of file
+
+  setup();
+  test_gc_static_closure();
+  tear_down();
+
+  setup();
+  test_gc_minor();
+  tear_down();
+
+  setup();
+  test_gc_growth();
+  tear_down();
+
+  setup();
+  test_gc_roots_major();
+  tear_down();
+
+  setup();
+  test_gc_roots_minor();
+  tear_down();
+
+  setup();
+  test_gc_roots_growth();
+  tear_down();
+
+#ifndef FO_INLINE_GC_HEADER
+  setup();
+  test_gc_header_chunks();
+  tear_down();
+#endif
+
+  setup();
+  test_gc_copy_order();
+  tear_down();
+}
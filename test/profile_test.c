@@ -0,0 +1,89 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#include "runtime/base.h"
+#include "runtime/memory.h"
+#include "runtime/profile.h"
+
+#define RUNTIME_RESERVED_SIZE 1024 * 1024
+#define COROUTINE_STACK_SIZE 1024 * 1024
+#define NUM_COROUTINES 1
+#define HEAP_SIZE 4 * 1024 * 1024
+#define NURSERY_SIZE 256 * 1024
+
+void setup() {
+  init_memory(RUNTIME_RESERVED_SIZE, COROUTINE_STACK_SIZE, NUM_COROUTINES,
+              HEAP_SIZE, NURSERY_SIZE);
+}
+
+void tear_down() { free_memory(); }
+
+// Writes the profile, and returns its content in |buf|.
+static void read_profile(char* buf, size_t size) {
+  char path[] = "/tmp/fo_profile_XXXXXX";
+  int fd = mkstemp(path);
+  CHECK(fd >= 0);
+  close(fd);
+  setenv("FO_PROFILE", path, 1);
+  dump_profile();
+  unsetenv("FO_PROFILE");
+
+  FILE* f = fopen(path, "r");
+  CHECK(f != NULL);
+  size_t n = fread(buf, 1, size - 1, f);
+  buf[n] = '\0';
+  fclose(f);
+  remove(path);
+}
+
+void test_profile_counters() {
+  printf(">>> test_profile_counters begin\n");
+  static const char* const names[] = {"f", "f#0", "f#0>g"};
+  uint64_t* counters = NULL;
+  for (int i = 0; i < 3; ++i) {
+    PROFILE_COUNT(counters, names, 3, 0);
+  }
+  PROFILE_COUNT(counters, names, 3, 2);
+
+  char buf[128];
+  read_profile(buf, sizeof(buf));
+  CHECK(strcmp(buf, "f 3\nf#0 0\nf#0>g 1\n") == 0);
+  printf("<<< test_profile_counters passed!\n\n");
+}
+
+static val_t target_f(val_t x) { return x; }
+static val_t target_g(val_t x) { return x + 1; }
+
+void test_profile_targets() {
+  printf(">>> test_profile_targets begin\n");
+  static const char* const names[] = {"s", "s>f", "s>g"};
+  static profile_target_t targets[] = {{(val_t)target_f, 1},
+                                       {(val_t)target_g, 2}};
+  uint64_t* counters = NULL;
+  for (int i = 0; i < 3; ++i) {
+    PROFILE_COUNT(counters, names, 3, 0);
+    count_profile_target(counters, targets, 2, (val_t)target_g);
+  }
+  // The last target called comes first.
+  CHECK(targets[0].func == (val_t)target_g);
+  PROFILE_COUNT(counters, names, 3, 0);
+  count_profile_target(counters, targets, 2, (val_t)target_f);
+  CHECK(targets[0].func == (val_t)target_f);
+
+  char buf[128];
+  read_profile(buf, sizeof(buf));
+  CHECK(strcmp(buf, "s 4\ns>f 1\ns>g 3\n") == 0);
+  printf("<<< test_profile_targets passed!\n\n");
+}
+
+int main() {
+  setup();
+  test_profile_counters();
+  tear_down();
+
+  setup();
+  test_profile_targets();
+  tear_down();
+}